@@ -0,0 +1,373 @@
+"""Benchmark the DNS model component plugins on synthetic experiment graphs.
+
+The plugins are run in the order FIREWHEEL runs them (``PopulateZones``,
+``InsertRecords``, ``ConfigureBind`` and then ``SetNameservers``) against a
+generated topology, using the in-process graph from :py:mod:`stand_in`. For
+each plugin, the wall time, peak memory and the size of the vm_resource
+payloads it scheduled are reported, along with the number of zones and records
+handed to BIND. Results can be saved as JSON and compared with a previous run,
+for example one made on another commit::
+
+    python benchmarks/bench_dns.py --hosts 20000 --servers 8 --output base.json
+    python benchmarks/bench_dns.py --hosts 20000 --servers 8 --compare base.json
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from pathlib import Path
+
+import stand_in
+
+PLUGIN_CLASSES = (
+    ("populate_zones", "PopulateZones"),
+    ("insert_records", "InsertRecords"),
+    ("configure_bind", "ConfigureBind"),
+    ("set_nameservers", "SetNameservers"),
+)
+TLDS = ("com", "net", "org", "gov", "edu")
+HOSTS_PER_SWITCH = 250
+
+
+def build_topology(modules, args):
+    """Generate a synthetic experiment graph.
+
+    Hosts are spread over ``args.domains`` registrable domains, each nested
+    ``args.depth`` labels below a top-level domain, and over switches of up to
+    :py:data:`HOSTS_PER_SWITCH` hosts, each with its own ``/24`` network. The
+    last ``args.servers`` hosts are DNS servers. Each server tracks a random
+    ``args.tracked`` fraction of the domains, and has ``args.addon_records``
+    extra records to insert.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+        args (argparse.Namespace): The topology parameters.
+
+    Returns:
+        stand_in.Graph: The experiment graph.
+    """
+    rng = random.Random(args.seed)
+    dns_server = modules["dns_objects"].DNSServer
+    graph = stand_in.Graph()
+
+    domains = []
+    for index in range(args.domains):
+        labels = [f"domain{index}"]
+        labels.extend(f"sub{rng.randrange(4)}" for _ in range(args.depth - 2))
+        labels.reverse()
+        domains.append(".".join((*labels, TLDS[index % len(TLDS)])))
+
+    switch = None
+    for index in range(args.hosts):
+        if index % HOSTS_PER_SWITCH == 0:
+            switch = stand_in.Vertex(graph, f"switch-{index // HOSTS_PER_SWITCH}")
+            switch.decorate(stand_in.Switch)
+        network, host = divmod(index, HOSTS_PER_SWITCH)
+        address = f"10.{network // 256}.{network % 256}.{host + 1}"
+        vertex = stand_in.Vertex(graph, f"host{index}.{domains[index % len(domains)]}")
+        vertex.decorate(stand_in.Ubuntu1604Server)
+        vertex.connect(switch, address, "255.255.255.0")
+
+        server_number = index - (args.hosts - args.servers)
+        if server_number < 0:
+            continue
+        vertex.decorate(dns_server, init_args=[address])
+        tracked = rng.sample(domains, max(1, round(len(domains) * args.tracked)))
+        if args.tracked < 1:
+            vertex.dns_data["hosts_tracked"] = [f"*.{domain}" for domain in tracked]
+        if args.addon_records:
+            vertex.dns_data["addon_records"] = {
+                "com": {
+                    f"addon{server_number}": {
+                        f"rr{record}": [
+                            ("A", f"192.168.{record // 250}.{record % 250}")
+                        ]
+                        for record in range(args.addon_records)
+                    }
+                }
+            }
+    return graph
+
+
+def render_bundles(modules, args, **dns_data):
+    """Render the zone bundle of each DNS server of a generated topology.
+
+    The plugins before ``SetNameservers`` are run on a topology built by
+    :py:func:`build_topology`, after the given ``dns_data`` settings are
+    applied to every DNS server.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+        args (argparse.Namespace): The topology parameters.
+        **dns_data: Settings for the ``dns_data`` of every DNS server.
+
+    Returns:
+        dict: The zone bundle scheduled on each DNS server, keyed by the
+        server's name, in graph order.
+    """
+    log = logging.getLogger("bench_dns")
+    graph = build_topology(modules, args)
+    dns_server = modules["dns_objects"].DNSServer
+    servers = [v for v in graph.get_vertices() if v.is_decorated_by(dns_server)]
+    for vertex in servers:
+        vertex.dns_data.update(dns_data)
+    for module_name, class_name in PLUGIN_CLASSES:
+        if module_name != "set_nameservers":
+            getattr(modules[module_name], class_name)(graph, log).run()
+    return {
+        vertex.name: resource[2]
+        for vertex in servers
+        for resource in vertex.vm_resources
+        if resource[1] == "configure_bind_agent.py"
+    }
+
+
+def count_zones(zones):
+    """Count the zones and records BIND will serve for a zone tree.
+
+    Arguments:
+        zones (dns.dns_objects.ZoneTree): The zone tree of a DNS server.
+
+    Returns:
+        tuple: The number of zones (including the root zone) and records.
+    """
+    domains, records = zones.count() if zones is not None else (0, 0)
+    return domains + 1, records
+
+
+def payload_stats(graph, scheduled):
+    """Measure the vm_resource payloads scheduled since a previous snapshot.
+
+    Arguments:
+        graph (stand_in.Graph): The experiment graph.
+        scheduled (dict): The number of vm_resources each vertex had before the
+            plugin ran, keyed by vertex name.
+
+    Returns:
+        dict: The number of payloads, the total number of bytes scheduled and
+        the number of bytes held by distinct payload objects.
+    """
+    count = 0
+    total = 0
+    distinct = {}
+    for vertex in graph.get_vertices():
+        for resource in vertex.vm_resources[scheduled.get(vertex.name, 0) :]:
+            payload = resource[2]
+            if payload is None:
+                continue
+            size = len(payload.encode("utf-8"))
+            count += 1
+            total += size
+            distinct[id(payload)] = size
+    return {
+        "payloads": count,
+        "payload_bytes": total,
+        "distinct_payload_bytes": sum(distinct.values()),
+    }
+
+
+def run_benchmark(modules, args):
+    """Run each plugin on a freshly generated graph and measure it.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+        args (argparse.Namespace): The benchmark parameters.
+
+    Returns:
+        dict: The measurements of each plugin, keyed by plugin name.
+    """
+    log = logging.getLogger("bench_dns")
+    graph = build_topology(modules, args)
+    dns_server = modules["dns_objects"].DNSServer
+    servers = [v for v in graph.get_vertices() if v.is_decorated_by(dns_server)]
+
+    results = {}
+    for module_name, class_name in PLUGIN_CLASSES:
+        plugin = getattr(modules[module_name], class_name)(graph, log)
+        scheduled = {v.name: len(v.vm_resources) for v in graph.get_vertices()}
+        if args.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        plugin.run()
+        elapsed = time.perf_counter() - start
+        peak = None
+        if args.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        result = {"seconds": round(elapsed, 6), "peak_bytes": peak}
+        result.update(payload_stats(graph, scheduled))
+        if module_name in {"populate_zones", "insert_records"}:
+            counts = [count_zones(v.dns_data.get("zones")) for v in servers]
+            result["zones"] = sum(count[0] for count in counts)
+            result["records"] = sum(count[1] for count in counts)
+        metrics = getattr(plugin, "metrics", None)
+        if metrics is not None:
+            # The plugin's own instrumentation (see PluginMetrics)
+            result["metrics"] = metrics.summary()
+        results[module_name] = result
+    return results
+
+
+def git_revision():
+    """Get the commit of the working tree, if it is a git repository.
+
+    Returns:
+        str: The abbreviated commit hash, or :py:data:`None`.
+    """
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],  # noqa: S607
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def format_report(report, baseline=None):
+    """Format benchmark results as a table.
+
+    Arguments:
+        report (dict): The benchmark report.
+        baseline (dict): An optional previous report to compare against.
+
+    Returns:
+        str: The table.
+    """
+    columns = (
+        ("seconds", "time (s)"),
+        ("peak_bytes", "peak mem"),
+        ("zones", "zones"),
+        ("records", "records"),
+        ("payload_bytes", "payload B"),
+        ("distinct_payload_bytes", "distinct B"),
+    )
+    lines = [
+        "{:<16}".format("plugin") + "".join(f"{title:>22}" for _, title in columns)
+    ]
+    for plugin, result in report["results"].items():
+        cells = []
+        for key, _ in columns:
+            value = result.get(key)
+            if value is None:
+                cell = "-"
+            elif isinstance(value, float):
+                cell = f"{value:.4f}"
+            else:
+                cell = f"{value:,}"
+            previous = (baseline or {}).get("results", {}).get(plugin, {}).get(key)
+            if value and previous:
+                cell += f" ({(value - previous) / previous:+.1%})"
+            cells.append(f"{cell:>22}")
+        lines.append(f"{plugin:<16}" + "".join(cells))
+    return "\n".join(lines)
+
+
+def add_topology_arguments(parser):
+    """Add the options which control the generated topology to a parser.
+
+    Arguments:
+        parser (argparse.ArgumentParser): The parser to extend.
+    """
+    parser.add_argument("--hosts", type=int, default=5000, help="number of hosts")
+    parser.add_argument(
+        "--domains", type=int, default=100, help="number of registrable domains"
+    )
+    parser.add_argument(
+        "--depth", type=int, default=3, help="number of labels in each domain name"
+    )
+    parser.add_argument("--servers", type=int, default=4, help="number of DNS servers")
+    parser.add_argument(
+        "--tracked",
+        type=float,
+        default=1.0,
+        help="fraction of the domains each DNS server tracks",
+    )
+    parser.add_argument(
+        "--addon-records",
+        type=int,
+        default=0,
+        help="number of addon records inserted on each DNS server",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+
+
+def check_topology_arguments(parser, args):
+    """Reject topology options which can not be generated.
+
+    Arguments:
+        parser (argparse.ArgumentParser): The parser which reports the error.
+        args (argparse.Namespace): The parsed arguments.
+    """
+    if not 0 < args.servers <= args.hosts:
+        parser.error("--servers must be between 1 and --hosts")
+    if args.depth < 2:
+        parser.error("--depth must be at least 2")
+    if not 0 < args.tracked <= 1:
+        parser.error("--tracked must be in (0, 1]")
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments.
+
+    Arguments:
+        argv (list): The arguments, defaulting to :py:data:`sys.argv`.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    add_topology_arguments(parser)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="do not trace memory allocations (which slows the plugins down)",
+    )
+    parser.add_argument("--output", type=Path, help="write the report as JSON")
+    parser.add_argument("--compare", type=Path, help="a previous JSON report")
+    args = parser.parse_args(argv)
+    check_topology_arguments(parser, args)
+    return args
+
+
+def main(argv=None):
+    """Run the benchmark and report the results.
+
+    Arguments:
+        argv (list): The command line arguments.
+    """
+    args = parse_args(argv)
+    modules = stand_in.install()
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in {"output", "compare", "memory"}
+        },
+        "results": run_benchmark(modules, args),
+    }
+    baseline = None
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))
+        if baseline.get("parameters") != report["parameters"]:
+            print("WARNING: the baseline was run with different parameters")
+    print(format_report(report, baseline))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+"""Check the output of the DNS model component plugins for known regressions.
+
+Each check runs the plugins on a small topology generated by
+:py:mod:`bench_dns`, using the in-process graph from :py:mod:`stand_in`, and
+inspects what they scheduled. The checks which fail are reported, and the exit
+status is non-zero if any failed::
+
+    python benchmarks/check_dns.py
+"""
+
+import io
+import os
+import sys
+import tempfile
+import subprocess
+import importlib.util
+
+import stand_in
+import bench_dns
+
+
+def zone_names(modules, zone_bundle):
+    """List the zones of a zone bundle.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+        zone_bundle (str): The zone bundle.
+
+    Returns:
+        list: The fully qualified zone names, in the order they were bundled.
+    """
+    iter_bundle = modules["dns_objects"].iter_zone_bundle
+    return [zone for zone, _ in iter_bundle(io.StringIO(zone_bundle))]
+
+
+def check_reverse_zones_kept(modules):
+    """Flattening the forward zones keeps the reverse zones of every network.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+    """
+    args = bench_dns.parse_args(["--hosts", "600", "--servers", "1"])
+    for zone_depth in ("domain", "tld"):
+        bundles = bench_dns.render_bundles(modules, args, zone_depth=zone_depth)
+        for bundle in bundles.values():
+            zones = zone_names(modules, bundle)
+            for network in range(3):
+                zone = f"{network}.0.10.in-addr.arpa."
+                assert zone in zones, f"{zone} is missing with zone_depth={zone_depth}"
+
+
+def check_context_rebuilt(modules):
+    """The shared DNS context is rebuilt when a host's address changes.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+    """
+    dns_context = modules["dns_objects"].DNSContext
+    args = bench_dns.parse_args(["--hosts", "20", "--servers", "1"])
+    graph = bench_dns.build_topology(modules, args)
+    host = dns_context.get(graph).index.hosts[0]
+    vertex = next(v for v in graph.get_vertices() if v.name == host.name)
+    vertex.interfaces.interfaces[0]["address"] = "192.0.2.1"
+    context = dns_context.get(graph)
+    assert not context.reused, "the context was reused after an address changed"
+    assert context.index.hosts[0].address == "192.0.2.1", "the index is stale"
+    assert dns_context.get(graph).reused, "an unchanged context was rebuilt"
+
+
+def cache_key(modules, hosts_tracked):
+    """Compute the zone cache key of the first DNS server of a small topology.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+        hosts_tracked (object): The ``hosts_tracked`` of the DNS server.
+
+    Returns:
+        str: The key.
+    """
+    args = bench_dns.parse_args(["--hosts", "20", "--servers", "1"])
+    graph = bench_dns.build_topology(modules, args)
+    plugin = modules["populate_zones"].PopulateZones(graph)
+    plugin.build_index()
+    server = plugin.index.servers[0]
+    server.dns_data["hosts_tracked"] = hosts_tracked
+    return plugin.get_cache_key(server)
+
+
+def check_cache_key_stable(modules):  # noqa: ARG001
+    """The zone cache key of a set valued setting is the same in every process.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+    """
+    code = (
+        "import stand_in, check_dns; "
+        "print(check_dns.cache_key(stand_in.install(), "
+        "{f'*.domain{n}.com' for n in range(20)}))"
+    )
+    keys = set()
+    for seed in ("1", "2", "3"):
+        keys.add(
+            subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=dict(os.environ, PYTHONHASHSEED=seed),
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+    assert len(keys) == 1, f"the key differs between processes: {sorted(keys)}"
+
+
+def check_serial_ignored(modules):
+    """The BIND agent keeps zone files whose records are unchanged on a primary.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+    """
+    path = stand_in.MC_DIR / "configure_bind" / "vm_resources"
+    spec = importlib.util.spec_from_file_location(
+        "configure_bind_agent", path / "configure_bind_agent.py"
+    )
+    agent = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(agent)
+    serial = modules["dns_objects"].ZONE_CONFIG["boilerplate_serial"]
+    args = bench_dns.parse_args(["--hosts", "20", "--servers", "1"])
+    bundle = next(iter(bench_dns.render_bundles(modules, args).values()))
+    iter_bundle = modules["dns_objects"].iter_zone_bundle
+    with tempfile.TemporaryDirectory() as directory:
+        for zone, text in iter_bundle(io.StringIO(bundle)):
+            digests = []
+            for number, new_serial in enumerate((serial, str(int(serial) + 1))):
+                zone_file = os.path.join(directory, f"{number}.zone")
+                with open(zone_file, "w", encoding="utf-8") as fhand:
+                    fhand.write(text.replace(serial, new_serial))
+                digests.append(agent.zone_digest(zone_file))
+            assert digests[0] == digests[1], f"the serial of {zone} is compared"
+
+
+CHECKS = (
+    check_reverse_zones_kept,
+    check_context_rebuilt,
+    check_cache_key_stable,
+    check_serial_ignored,
+)
+
+
+def main():
+    """Run every check and report the failures.
+
+    Returns:
+        int: The number of checks which failed.
+    """
+    modules = stand_in.install()
+    failed = 0
+    for check in CHECKS:
+        try:
+            check(modules)
+        except AssertionError as exp:
+            failed += 1
+            print(f"FAIL {check.__name__}: {exp}")
+        else:
+            print(f"ok   {check.__name__}")
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(main())
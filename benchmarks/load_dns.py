@@ -0,0 +1,962 @@
+"""Load test the zones of a DNS server with an in-process authoritative stand-in.
+
+The zones are read from a zone bundle (the vm_resource ``ConfigureBind`` hands
+to ``configure_bind_agent.py``, see ``ConfigureBind.get_metadata``), either a
+bundle saved to a file or one rendered by :py:func:`bench_dns.render_bundles`.
+They are served over UDP and TCP on localhost by a small asyncio
+authoritative server, and a mix of queries is replayed against it::
+
+    python benchmarks/load_dns.py --hosts 20000 --zone-depth domain
+    python benchmarks/load_dns.py --bundle zone_bundle --replay queries.txt
+
+The queries per second, the latency percentiles of the queries and of each
+kind of resolution, and the number of queries each resolution needed are
+reported. Results can be saved as JSON.
+"""
+
+import io
+import re
+import sys
+import json
+import math
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from collections import Counter
+
+import stand_in
+import bench_dns
+
+RECORD_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "AAAA": 28}
+NAME_TYPES = {RECORD_TYPES["NS"], RECORD_TYPES["CNAME"], RECORD_TYPES["PTR"]}
+RCODES = {0: "noerror", 1: "formerr", 2: "servfail", 3: "nxdomain", 4: "notimp"}
+NXDOMAIN = 3
+REFUSED = 5
+MAX_CNAME_CHAIN = 8
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+# The kinds of resolutions, and the outcome each one should have
+QUERY_KINDS = {
+    "forward": "answer",
+    "reverse": "answer",
+    "nxdomain": "nxdomain",
+    "walk": "answer",
+}
+DEFAULT_MIX = "forward=70,reverse=20,nxdomain=5,walk=5"
+PERCENTILES = (50, 90, 99)
+
+
+def parse_duration(text):
+    """Convert a BIND duration (e.g. ``3W12h`` or ``300``) to seconds.
+
+    Arguments:
+        text (str): The duration.
+
+    Returns:
+        int: The number of seconds.
+
+    Raises:
+        ValueError: If the duration is malformed.
+    """
+    parts = re.findall(r"(\d+)([smhdw]?)", text.lower())
+    if not parts or "".join(a + b for a, b in parts) != text.lower():
+        raise ValueError(f"Invalid duration: {text}")
+    return sum(int(value) * DURATION_UNITS[unit] for value, unit in parts)
+
+
+def parse_rdata(record_type, data, origin):
+    """Parse the data of a record into the form it is encoded from.
+
+    Arguments:
+        record_type (str): The record type.
+        data (str): The record data, as written in a zone file.
+        origin (str): The zone the record belongs to.
+
+    Returns:
+        object: The packed address or the absolute target name, or
+        :py:data:`None` if the stand-in does not serve the record.
+    """
+    data = data.strip()
+    try:
+        if record_type == "A":
+            return socket.inet_pton(socket.AF_INET, data)
+        if record_type == "AAAA":
+            return socket.inet_pton(socket.AF_INET6, data)
+    except OSError:
+        return None
+    if record_type not in {"NS", "CNAME", "PTR"} or not data:
+        return None
+    name = data.split()[0].lower()
+    if name.endswith("."):
+        return name[:-1]
+    return origin if name == "@" else f"{name}.{origin}".rstrip(".")
+
+
+class Zone:
+    """The records of one zone, as served by :py:class:`StandInServer`.
+
+    Names are stored lowercase and without a trailing dot. The zone also
+    remembers its empty non-terminals (names which only exist because a name
+    below them owns records), which are answered with NODATA rather than
+    NXDOMAIN, as a resolver walking down the names needs.
+    """
+
+    def __init__(self, name, soa, ttl):
+        """
+        Arguments:
+            name (str): The name of the zone.
+            soa (tuple): The ``(mname, rname, serial, refresh, retry, expire,
+                minimum)`` of the zone's SOA record.
+            ttl (int): The TTL of the zone's records.
+        """
+        self.name = name
+        self.soa = soa
+        self.ttl = ttl
+        self.names = {}
+        self.nonterminals = set()
+        self.records = 0
+
+    def add(self, owner, record_type, value):
+        """Add a record to the zone.
+
+        Arguments:
+            owner (str): The name owning the record.
+            record_type (int): The numeric record type.
+            value (object): The data returned by :py:func:`parse_rdata`.
+        """
+        self.names.setdefault(owner, {}).setdefault(record_type, []).append(value)
+        self.records += 1
+        parent = owner
+        while parent != self.name and "." in parent:
+            parent = parent.partition(".")[2]
+            self.nonterminals.add(parent)
+
+    def lookup(self, name, qtype):
+        """Look up the records of a name within the zone.
+
+        Arguments:
+            name (str): The queried name.
+            qtype (int): The queried record type.
+
+        Returns:
+            tuple: The response code and the ``(type, values)`` record sets
+            owned by the name, which hold a CNAME record for the resolver to
+            follow if the name is an alias.
+        """
+        node = self.names.get(name)
+        if node is None:
+            return 0 if name in self.nonterminals else NXDOMAIN, []
+        for record_type in (qtype, RECORD_TYPES["CNAME"]):
+            if record_type in node:
+                return 0, [(record_type, node[record_type])]
+        return 0, []
+
+
+def parse_soa(text):
+    """Read the SOA record and default TTL of a zone file.
+
+    Arguments:
+        text (str): The zone file.
+
+    Returns:
+        tuple: The SOA fields (see :py:class:`Zone`) and the default TTL.
+
+    Raises:
+        ValueError: If the zone file has no SOA record.
+    """
+    match = re.search(
+        r"\sSOA\s+(\S+)\s+(\S+)\s*\(?\s*(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+([^\s)]+)",
+        text,
+        re.IGNORECASE,
+    )
+    if match is None:
+        raise ValueError("The zone file has no SOA record")
+    mname, rname, serial, *timers = match.groups()
+    soa = (
+        mname.lower().rstrip("."),
+        rname.lower().rstrip("."),
+        int(serial),
+        *map(parse_duration, timers),
+    )
+    ttl = re.search(r"^\$TTL\s+(\S+)", text, re.MULTILINE)
+    return soa, parse_duration(ttl.group(1)) if ttl else soa[-1]
+
+
+def load_zones(modules, zone_bundle):
+    """Load the zones of a zone bundle.
+
+    The zone files are parsed with ``iter_zone_file_records`` of
+    ``dns.insert_records``, so the stand-in serves the same records that
+    plugin would import from them.
+
+    Arguments:
+        modules (dict): The modules returned by :py:func:`stand_in.install`.
+        zone_bundle (str): The zone bundle.
+
+    Returns:
+        tuple: The zones keyed by name, and the number of records of each
+        type the stand-in does not serve.
+    """
+    iter_records = modules["insert_records"].iter_zone_file_records
+    zones = {}
+    skipped = Counter()
+    with tempfile.TemporaryDirectory() as directory:
+        bundle = modules["dns_objects"].iter_zone_bundle(io.StringIO(zone_bundle))
+        for number, (zone_name, text) in enumerate(bundle):
+            name = zone_name.lower().rstrip(".")
+            zone = zones[name] = Zone(name, *parse_soa(text))
+            zone.add(name, RECORD_TYPES["SOA"], zone.soa)
+            path = Path(directory) / f"{number}.zone"
+            path.write_text(text, encoding="utf-8")
+            for owner, record_type, data in iter_records(str(path), name):
+                value = parse_rdata(record_type, data, name)
+                if value is None:
+                    skipped[record_type] += 1
+                    continue
+                zone.add(owner.lower(), RECORD_TYPES[record_type], value)
+    return zones, skipped
+
+
+def encode_name(name):
+    """Encode a domain name, without compression.
+
+    Arguments:
+        name (str): The name, without a trailing dot.
+
+    Returns:
+        bytes: The encoded name.
+    """
+    labels = [label.encode("utf-8") for label in name.split(".") if label]
+    return b"".join(bytes((len(label),)) + label for label in labels) + b"\0"
+
+
+def encode_record(owner, record_type, ttl, value):
+    """Encode a resource record.
+
+    Arguments:
+        owner (str): The name owning the record.
+        record_type (int): The numeric record type.
+        ttl (int): The TTL of the record.
+        value (object): The data returned by :py:func:`parse_rdata`, or the
+            SOA fields of a :py:class:`Zone`.
+
+    Returns:
+        bytes: The encoded record.
+    """
+    if record_type == RECORD_TYPES["SOA"]:
+        rdata = encode_name(value[0]) + encode_name(value[1])
+        rdata += struct.pack(">IIIII", *value[2:])
+    elif record_type in NAME_TYPES:
+        rdata = encode_name(value)
+    else:
+        rdata = value
+    header = struct.pack(">HHIH", record_type, 1, ttl, len(rdata))
+    return encode_name(owner) + header + rdata
+
+
+def encode_query(name, qtype):
+    """Encode a query with a zero ID.
+
+    Arguments:
+        name (str): The queried name.
+        qtype (int): The queried record type.
+
+    Returns:
+        bytes: The query.
+    """
+    header = struct.pack(">HHHHHH", 0, 0, 1, 0, 0, 0)
+    return header + encode_name(name) + struct.pack(">HH", qtype, 1)
+
+
+def read_name(message, offset):
+    """Decode a (possibly compressed) domain name.
+
+    Arguments:
+        message (bytes): The DNS message.
+        offset (int): The offset of the name.
+
+    Returns:
+        tuple: The lowercase name, without a trailing dot, and the offset
+        following it.
+
+    Raises:
+        ValueError: If the name is malformed.
+    """
+    labels = []
+    end = None
+    for _ in range(128):
+        length = message[offset]
+        if length >= 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from(">H", message, offset)[0] & 0x3FFF
+        elif length:
+            labels.append(message[offset + 1 : offset + 1 + length])
+            offset += 1 + length
+        else:
+            name = b".".join(labels).decode("utf-8", "replace").lower()
+            return name, offset + 1 if end is None else end
+    raise ValueError("The domain name has too many labels or a pointer loop")
+
+
+def parse_response(message):
+    """Decode the parts of a response a resolver acts upon.
+
+    Arguments:
+        message (bytes): The response.
+
+    Returns:
+        tuple: The response code and the answer section as ``(owner, type,
+        target)`` tuples, where the target is the name of CNAME records.
+    """
+    _, flags, questions, answers = struct.unpack_from(">HHHH", message)
+    offset = 12
+    for _ in range(questions):
+        offset = read_name(message, offset)[1] + 4
+    records = []
+    for _ in range(answers):
+        owner, offset = read_name(message, offset)
+        rtype, _, _, length = struct.unpack_from(">HHIH", message, offset)
+        offset += 10
+        target = None
+        if rtype == RECORD_TYPES["CNAME"]:
+            target = read_name(message, offset)[0]
+        records.append((owner, rtype, target))
+        offset += length
+    return flags & 0xF, records
+
+
+class StandInServer(asyncio.DatagramProtocol):
+    """A minimal authoritative DNS server for the zones of a zone bundle.
+
+    Each query is answered from the closest enclosing zone, with the requested
+    records, the CNAME record of an alias (which the resolver follows), or
+    NODATA or NXDOMAIN and the zone's SOA record. Names outside every zone are
+    refused.
+    """
+
+    def __init__(self, zones):
+        """
+        Arguments:
+            zones (dict): The :py:class:`Zone` objects keyed by name.
+        """
+        self.zones = zones
+        self.transport = None
+
+    def find_zone(self, name):
+        """Find the closest zone enclosing a name.
+
+        Arguments:
+            name (str): The queried name.
+
+        Returns:
+            Zone: The zone, or :py:data:`None`.
+        """
+        labels = name.split(".") if name else []
+        for index in range(len(labels) + 1):
+            zone = self.zones.get(".".join(labels[index:]))
+            if zone is not None:
+                return zone
+        return None
+
+    def respond(self, message):
+        """Answer a query.
+
+        Arguments:
+            message (bytes): The query.
+
+        Returns:
+            bytes: The response, or :py:data:`None` if the query is malformed.
+        """
+        try:
+            ident, flags, questions = struct.unpack_from(">HHH", message)
+            if flags & 0x8000 or questions != 1:
+                return None
+            name, offset = read_name(message, 12)
+            (qtype,) = struct.unpack_from(">H", message, offset)
+        except (ValueError, IndexError, struct.error):
+            return None
+        question = message[12 : offset + 4]
+        zone = self.find_zone(name)
+        if zone is None:
+            header = struct.pack(">HHHHHH", ident, 0x8000 | REFUSED, 1, 0, 0, 0)
+            return header + question
+        rcode, rrsets = zone.lookup(name, qtype)
+        answer = [
+            encode_record(name, record_type, zone.ttl, value)
+            for record_type, values in rrsets
+            for value in values
+        ]
+        authority = []
+        if not answer:
+            ttl = min(zone.ttl, zone.soa[-1])
+            authority.append(
+                encode_record(zone.name, RECORD_TYPES["SOA"], ttl, zone.soa)
+            )
+        header = struct.pack(
+            ">HHHHHH",
+            ident,
+            0x8400 | (flags & 0x0100) | rcode,
+            1,
+            len(answer),
+            len(authority),
+            0,
+        )
+        return b"".join((header, question, *answer, *authority))
+
+    def connection_made(self, transport):
+        """Keep the UDP transport to send responses with.
+
+        Arguments:
+            transport (asyncio.DatagramTransport): The UDP socket.
+        """
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        """Answer a UDP query.
+
+        Arguments:
+            data (bytes): The query.
+            addr (tuple): The address of the client.
+        """
+        response = self.respond(data)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+    async def handle_stream(self, reader, writer):
+        """Answer the queries of a TCP connection.
+
+        Arguments:
+            reader (asyncio.StreamReader): The incoming stream.
+            writer (asyncio.StreamWriter): The outgoing stream.
+        """
+        try:
+            while True:
+                (length,) = struct.unpack(">H", await reader.readexactly(2))
+                response = self.respond(await reader.readexactly(length))
+                if response is None:
+                    break
+                writer.write(struct.pack(">H", len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1"):
+        """Listen for queries over UDP and TCP on the same free port.
+
+        Arguments:
+            host (str): The address to listen on.
+
+        Returns:
+            tuple: The UDP transport, the TCP server and the port.
+
+        Raises:
+            OSError: If no port is free for both UDP and TCP.
+        """
+        loop = asyncio.get_running_loop()
+        for _ in range(10):
+            tcp = await asyncio.start_server(self.handle_stream, host, 0)
+            port = tcp.sockets[0].getsockname()[1]
+            try:
+                udp, _ = await loop.create_datagram_endpoint(
+                    lambda: self, local_addr=(host, port)
+                )
+            except OSError:
+                tcp.close()
+                continue
+            return udp, tcp, port
+        raise OSError("No port is free for both UDP and TCP")
+
+
+class Client:
+    """Send queries one at a time over a UDP socket or a TCP connection."""
+
+    def __init__(self, address, timeout, tcp=False):
+        """
+        Arguments:
+            address (tuple): The host and port of the server.
+            timeout (float): The seconds to wait for each response.
+            tcp (bool): Whether to query over TCP rather than UDP.
+        """
+        self.address = address
+        self.timeout = timeout
+        self.tcp = tcp
+        self.sock = None
+        self.ident = 0
+
+    async def _read(self, size):
+        loop = asyncio.get_running_loop()
+        data = b""
+        while len(data) < size:
+            chunk = await loop.sock_recv(self.sock, size - len(data))
+            if not chunk:
+                raise ConnectionError("The server closed the connection")
+            data += chunk
+        return data
+
+    async def _exchange(self, query):
+        loop = asyncio.get_running_loop()
+        if self.sock is None:
+            kind = socket.SOCK_STREAM if self.tcp else socket.SOCK_DGRAM
+            self.sock = socket.socket(socket.AF_INET, kind)
+            self.sock.setblocking(False)
+            await loop.sock_connect(self.sock, self.address)
+        self.ident = (self.ident + 1) & 0xFFFF
+        query = struct.pack(">H", self.ident) + query[2:]
+        if self.tcp:
+            await loop.sock_sendall(self.sock, struct.pack(">H", len(query)) + query)
+            (length,) = struct.unpack(">H", await self._read(2))
+            return await self._read(length)
+        await loop.sock_sendall(self.sock, query)
+        while True:
+            response = await loop.sock_recv(self.sock, 0xFFFF)
+            if response[:2] == query[:2]:
+                return response
+
+    async def exchange(self, query):
+        """Send a query and wait for its response.
+
+        Arguments:
+            query (bytes): The query, whose ID is replaced.
+
+        Returns:
+            bytes: The response, or :py:data:`None` if it timed out or the
+            connection failed.
+        """
+        try:
+            return await asyncio.wait_for(self._exchange(query), self.timeout)
+        except (asyncio.TimeoutError, OSError):
+            self.close()
+            return None
+
+    def close(self):
+        """Close the socket, if it is open."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def percentiles(latencies):
+    """Summarize latencies in milliseconds.
+
+    Arguments:
+        latencies (list): The latencies, in seconds.
+
+    Returns:
+        dict: The nearest-rank percentiles and the maximum.
+    """
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    summary = {
+        f"p{rank}": ordered[max(0, math.ceil(rank / 100 * len(ordered)) - 1)]
+        for rank in PERCENTILES
+    }
+    summary["max"] = ordered[-1]
+    return {key: round(value * 1000, 3) for key, value in summary.items()}
+
+
+async def resolve(client, latencies, rcodes, kind, name, qtype):
+    """Resolve a name the way a stub of a recursive resolver would.
+
+    CNAME records are chased with further queries. A ``walk`` resolution
+    first queries the NS records of every ancestor of the name, from the
+    top-level domain down, as a resolver using QNAME minimisation (RFC 9156)
+    would on its way down the delegation chain.
+
+    Arguments:
+        client (Client): The client to query with.
+        latencies (list): Collects the latency of each answered query.
+        rcodes (collections.Counter): Counts the response code of each query.
+        kind (str): The kind of resolution.
+        name (str): The name to resolve.
+        qtype (int): The record type to resolve.
+
+    Returns:
+        tuple: The outcome of the last query (``"answer"``, ``"nodata"``,
+        ``"timeout"`` or the name of the response code) and the number of
+        queries sent.
+    """
+    steps = []
+    if kind == "walk":
+        labels = name.split(".")
+        steps = [
+            (".".join(labels[index:]), RECORD_TYPES["NS"])
+            for index in range(len(labels) - 1, 0, -1)
+        ]
+    steps.append((name, qtype))
+    for queries in range(1, len(steps) + MAX_CNAME_CHAIN + 1):
+        step_name, step_type = steps.pop(0)
+        start = time.perf_counter()
+        raw = await client.exchange(encode_query(step_name, step_type))
+        if raw is None:
+            rcodes["timeout"] += 1
+            return "timeout", queries
+        latencies.append(time.perf_counter() - start)
+        rcode, answer = parse_response(raw)
+        outcome = RCODES.get(rcode, "refused") if rcode else "nodata"
+        rcodes[RCODES.get(rcode, "refused")] += 1
+        for owner, record_type, target in answer:
+            if owner != step_name:
+                continue
+            if record_type == step_type:
+                outcome = "answer"
+            elif record_type == RECORD_TYPES["CNAME"] and not steps:
+                steps.append((target, step_type))
+        if not steps:
+            return outcome, queries
+    return "cname_loop", queries
+
+
+async def run_load(address, workload, concurrency, timeout, tcp=False):
+    """Replay a workload against a DNS server.
+
+    Arguments:
+        address (tuple): The host and port of the server.
+        workload (list): The ``(kind, name, qtype)`` resolutions to make.
+        concurrency (int): The number of resolutions in flight at a time.
+        timeout (float): The seconds to wait for each response.
+        tcp (bool): Whether to query over TCP rather than UDP (with one
+            socket per concurrent resolution either way).
+
+    Returns:
+        dict: The queries per second, the query latency percentiles, the
+        response codes, and per kind of resolution, their number, latency
+        percentiles, outcomes and the queries they needed.
+    """
+    latencies = []
+    rcodes = Counter()
+    kinds = {kind: ([], Counter(), Counter()) for kind, _, _ in workload}
+    resolutions = iter(workload)
+
+    async def worker():
+        client = Client(address, timeout, tcp)
+        for kind, name, qtype in resolutions:
+            start = time.perf_counter()
+            outcome, queries = await resolve(
+                client, latencies, rcodes, kind, name, qtype
+            )
+            kinds[kind][0].append(time.perf_counter() - start)
+            kinds[kind][1][outcome] += 1
+            kinds[kind][2][queries] += 1
+        client.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    total = sum(rcodes.values())
+    results = {
+        "seconds": round(seconds, 4),
+        "queries": total,
+        "qps": round(total / seconds, 1) if seconds else None,
+        "latency_ms": percentiles(latencies),
+        "rcodes": dict(rcodes),
+        "kinds": {},
+    }
+    for kind, (durations, outcomes, queries) in kinds.items():
+        expected = QUERY_KINDS.get(kind)
+        results["kinds"][kind] = {
+            "resolutions": len(durations),
+            "queries_per_resolution": round(
+                sum(count * number for count, number in queries.items())
+                / len(durations),
+                3,
+            ),
+            "max_queries": max(queries),
+            "latency_ms": percentiles(durations),
+            "outcomes": dict(outcomes),
+            "unexpected": len(durations) - outcomes[expected] if expected else None,
+        }
+    return results
+
+
+def build_workload(zones, mix, count, seed=0):
+    """Generate a synthetic mix of resolutions for the served zones.
+
+    Forward and walk resolutions look up the address of a random name which
+    owns A (or AAAA) records, other than the ``ns`` glue of each zone. Reverse
+    resolutions look up a random PTR record, and NXDOMAIN resolutions look up
+    a random name below the domain of a forward name.
+
+    Arguments:
+        zones (dict): The served :py:class:`Zone` objects keyed by name.
+        mix (dict): The relative weight of each kind of resolution.
+        count (int): The number of resolutions.
+        seed (int): The random seed.
+
+    Returns:
+        tuple: The ``(kind, name, qtype)`` resolutions, and the kinds which
+        were dropped because the zones have no names for them.
+    """
+    rng = random.Random(seed)
+    forward = []
+    reverse = []
+    for zone in zones.values():
+        glue = f"ns.{zone.name}" if zone.name else "ns"
+        for name, node in zone.names.items():
+            if RECORD_TYPES["PTR"] in node:
+                reverse.append((name, RECORD_TYPES["PTR"]))
+            if name == glue:
+                continue
+            for record_type in (RECORD_TYPES["A"], RECORD_TYPES["AAAA"]):
+                if record_type in node:
+                    forward.append((name, record_type))
+                    break
+    forward.sort()
+    reverse.sort()
+    candidates = {
+        "forward": forward,
+        "walk": forward,
+        "reverse": reverse,
+        "nxdomain": [
+            (f"nx{index}.{name.partition('.')[2]}".rstrip("."), RECORD_TYPES["A"])
+            for index, (name, _) in enumerate(forward)
+        ],
+    }
+    dropped = [kind for kind in mix if not candidates[kind]]
+    kinds = [kind for kind in mix if candidates[kind]]
+    if not kinds:
+        return [], dropped
+    chosen = rng.choices(kinds, [mix[kind] for kind in kinds], k=count)
+    return [(kind, *rng.choice(candidates[kind])) for kind in chosen], dropped
+
+
+def load_replay(path):
+    """Read recorded queries, in the ``<name> [<type>]`` format of dnsperf.
+
+    Arguments:
+        path (pathlib.Path): The file of queries, one per line. Empty lines
+            and lines starting with ``#`` are skipped, and the type defaults
+            to ``A``.
+
+    Returns:
+        list: The ``("replay", name, qtype)`` resolutions.
+
+    Raises:
+        ValueError: If a query has an unsupported record type.
+    """
+    workload = []
+    with path.open(encoding="utf-8") as queries:
+        for number, line in enumerate(queries, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith("#"):
+                continue
+            record_type = fields[1].upper() if len(fields) > 1 else "A"
+            if record_type not in RECORD_TYPES:
+                raise ValueError(f"{path}:{number}: Unsupported type {record_type}")
+            name = fields[0].lower().rstrip(".")
+            workload.append(("replay", name, RECORD_TYPES[record_type]))
+    return workload
+
+
+def parse_mix(text):
+    """Parse a query mix such as ``forward=70,reverse=20,nxdomain=10``.
+
+    Arguments:
+        text (str): The comma separated ``kind=weight`` pairs.
+
+    Returns:
+        dict: The weight of each kind of resolution.
+
+    Raises:
+        argparse.ArgumentTypeError: If a kind or weight is invalid.
+    """
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in QUERY_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind of query: {kind}")
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid weight: {part}") from None
+        if mix[kind] < 0:
+            raise argparse.ArgumentTypeError(f"invalid weight: {part}")
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix has no queries")
+    return mix
+
+
+def format_report(report):
+    """Format the results of a load test as a table.
+
+    Arguments:
+        report (dict): The load test report.
+
+    Returns:
+        str: The table.
+    """
+    results = report["results"]
+    lines = [
+        f"{report['zones']:,} zones, {report['records']:,} records",
+        f"{results['queries']:,} queries in {results['seconds']:.2f}s: "
+        f"{results['qps']:,.0f} QPS",
+        "query latency (ms): "
+        + ", ".join(f"{key} {value:.3f}" for key, value in results["latency_ms"].items()),
+        "rcodes: "
+        + ", ".join(f"{key} {value:,}" for key, value in results["rcodes"].items()),
+        "",
+        "{:<10}{:>12}{:>12}{:>12}{:>12}{:>12}{:>12}  {}".format(
+            "kind", "resolutions", "queries/res", "p50 ms", "p99 ms", "max ms",
+            "unexpected", "outcomes",
+        ),
+    ]  # fmt: skip
+    for kind, stats in results["kinds"].items():
+        unexpected = stats["unexpected"]
+        latency = stats["latency_ms"]
+        outcomes = ", ".join(
+            f"{key} {value:,}" for key, value in stats["outcomes"].items()
+        )
+        lines.append(
+            f"{kind:<10}{stats['resolutions']:>12,}"
+            f"{stats['queries_per_resolution']:>12.2f}"
+            f"{latency['p50']:>12.3f}{latency['p99']:>12.3f}{latency['max']:>12.3f}"
+            f"{'-' if unexpected is None else unexpected:>12}  {outcomes}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments.
+
+    Arguments:
+        argv (list): The arguments, defaulting to :py:data:`sys.argv`.
+
+    Returns:
+        argparse.Namespace: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument(
+        "--bundle",
+        type=Path,
+        help="a zone bundle file to serve, instead of rendering a topology's",
+    )
+    bench_dns.add_topology_arguments(parser)
+    parser.set_defaults(servers=1)
+    parser.add_argument(
+        "--zone-depth", help="the zone_depth of the DNS server (e.g. 'domain')"
+    )
+    parser.add_argument(
+        "--reverse-prefix", type=int, help="the reverse_prefix of the DNS server"
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=parse_mix(DEFAULT_MIX),
+        help=f"the weight of each kind of resolution (default: {DEFAULT_MIX})",
+    )
+    parser.add_argument(
+        "--replay",
+        type=Path,
+        help="replay the '<name> [<type>]' queries of a file instead of the mix",
+    )
+    parser.add_argument(
+        "--count", type=int, default=10000, help="number of resolutions"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="resolutions in flight at once"
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=2.0, help="seconds to wait for a response"
+    )
+    parser.add_argument("--tcp", action="store_true", help="query over TCP")
+    parser.add_argument("--output", type=Path, help="write the report as JSON")
+    args = parser.parse_args(argv)
+    bench_dns.check_topology_arguments(parser, args)
+    if args.count < 1 or args.concurrency < 1:
+        parser.error("--count and --concurrency must be positive")
+    return args
+
+
+async def load_test(zones, workload, args):
+    """Serve the zones on localhost and replay the workload against them.
+
+    Arguments:
+        zones (dict): The :py:class:`Zone` objects keyed by name.
+        workload (list): The ``(kind, name, qtype)`` resolutions to make.
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        dict: The measurements (see :py:func:`run_load`).
+    """
+    udp, tcp, port = await StandInServer(zones).start()
+    try:
+        return await run_load(
+            ("127.0.0.1", port), workload, args.concurrency, args.timeout, args.tcp
+        )
+    finally:
+        udp.close()
+        tcp.close()
+        await tcp.wait_closed()
+
+
+def main(argv=None):
+    """Run the load test and report the results.
+
+    Arguments:
+        argv (list): The command line arguments.
+
+    Returns:
+        int: The exit status.
+    """
+    args = parse_args(argv)
+    modules = stand_in.install()
+    if args.bundle:
+        zone_bundle = args.bundle.read_text(encoding="utf-8")
+    else:
+        settings = {
+            key: value
+            for key, value in (
+                ("zone_depth", args.zone_depth),
+                ("reverse_prefix", args.reverse_prefix),
+            )
+            if value is not None
+        }
+        bundles = bench_dns.render_bundles(modules, args, **settings)
+        if not bundles:
+            print("ERROR: no zone bundle was scheduled")
+            return 1
+        zone_bundle = next(iter(bundles.values()))
+    zones, skipped = load_zones(modules, zone_bundle)
+    if skipped:
+        print(f"WARNING: not serving {dict(skipped)} records")
+
+    if args.replay:
+        workload = load_replay(args.replay)
+    else:
+        workload, dropped = build_workload(zones, args.mix, args.count, args.seed)
+        if dropped:
+            print(f"WARNING: the zones have no names for {', '.join(dropped)}")
+    if not workload:
+        print("ERROR: there are no queries to make")
+        return 1
+
+    report = {
+        "revision": bench_dns.git_revision(),
+        "python": platform.python_version(),
+        "parameters": {
+            key: str(value) if isinstance(value, Path) else value
+            for key, value in vars(args).items()
+            if key != "output"
+        },
+        "zones": len(zones),
+        "records": sum(zone.records for zone in zones.values()),
+        "results": asyncio.run(load_test(zones, workload, args)),
+    }
+    print(format_report(report))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+"""A lightweight, in-process stand-in for the parts of FIREWHEEL used by the DNS
+model components.
+
+The stand-in registers minimal versions of ``firewheel.control.experiment_graph``,
+``base_objects``, ``linux.base_objects`` and ``linux.ubuntu1604`` in
+:py:data:`sys.modules` and then loads the model component objects and plugins of
+this repository from their source files, under the same module names FIREWHEEL
+uses (e.g. ``dns.dns_objects`` and ``dns.populate_zones_plugin``). This allows
+the plugins to be exercised without a FIREWHEEL installation or minimega.
+"""
+
+import sys
+import types
+import logging
+import importlib.util
+from pathlib import Path
+
+MC_DIR = Path(__file__).resolve().parent.parent / "src" / "firewheel_repo_dns"
+PLUGINS = (
+    "populate_zones",
+    "insert_records",
+    "configure_bind",
+    "set_nameservers",
+    "hosts_file",
+)
+
+
+def require_class(required):
+    """Stand-in for :py:func:`firewheel.control.experiment_graph.require_class`.
+
+    Arguments:
+        required (type): The graph object class which must also decorate a vertex.
+
+    Returns:
+        callable: A class decorator recording the requirement.
+    """
+
+    def decorator(cls):
+        cls.required_classes = (*getattr(cls, "required_classes", ()), required)
+        return cls
+
+    return decorator
+
+
+class AbstractPlugin:
+    """Stand-in for :py:class:`firewheel.control.experiment_graph.AbstractPlugin`."""
+
+    def __init__(self, graph, log=None):
+        """
+        Arguments:
+            graph (Graph): The experiment graph.
+            log (logging.Logger): The logger for the plugin.
+        """
+        self.g = graph
+        self.log = log or logging.getLogger(type(self).__name__)
+
+
+class Switch:
+    """Stand-in for :py:class:`base_objects.Switch`."""
+
+
+class VMEndpoint:
+    """Stand-in for :py:class:`base_objects.VMEndpoint`."""
+
+
+@require_class(VMEndpoint)
+class LinuxHost:
+    """Stand-in for :py:class:`linux.base_objects.LinuxHost`."""
+
+
+@require_class(LinuxHost)
+class Ubuntu1604Server:
+    """Stand-in for :py:class:`linux.ubuntu1604.Ubuntu1604Server`."""
+
+    def install_debs(self, start_time, debs):
+        """Schedule the installation of debian packages.
+
+        Arguments:
+            start_time (int): The schedule time.
+            debs (str): The name of the tarball of packages.
+        """
+        self.add_vm_resource(start_time, "install_debs.sh", None, debs)
+
+
+class Interfaces:
+    """Stand-in for the ``interfaces`` attribute of a connected vertex."""
+
+    def __init__(self):
+        """Create an empty list of interfaces."""
+        self.interfaces = []
+
+
+class Vertex:
+    """Stand-in for :py:class:`firewheel.control.experiment_graph.Vertex`.
+
+    Decorating a vertex mixes the graph object class (and the classes it
+    requires) into the vertex's class and calls the object's constructor, which
+    mirrors how FIREWHEEL decorates vertices.
+    """
+
+    def __init__(self, graph, name):
+        """
+        Arguments:
+            graph (Graph): The graph to add the vertex to.
+            name (str): The name of the vertex.
+        """
+        self.name = name
+        self.decorators = set()
+        self.vm_resources = []
+        self.attributes = {}
+        graph.add_vertex(self)
+
+    def __setitem__(self, key, value):
+        self.attributes[key] = value
+
+    def __getitem__(self, key):
+        return self.attributes[key]
+
+    def decorate(self, cls, init_args=None):
+        """Decorate the vertex with a graph object class.
+
+        Arguments:
+            cls (type): The graph object class.
+            init_args (list): The arguments for the class constructor.
+        """
+        pending = [cls]
+        added = []
+        while pending:
+            current = pending.pop()
+            if current in self.decorators:
+                continue
+            self.decorators.add(current)
+            added.append(current)
+            pending.extend(getattr(current, "required_classes", ()))
+        self.__class__ = type(
+            f"{type(self).__name__}+{cls.__name__}", (*added, type(self)), {}
+        )
+        if "__init__" in vars(cls):
+            cls.__init__(self, *(init_args or []))  # noqa: PLC2801
+
+    def is_decorated_by(self, cls):
+        """Check whether the vertex is decorated by a graph object class.
+
+        Arguments:
+            cls (type): The graph object class.
+
+        Returns:
+            bool: :py:data:`True` if the vertex is decorated by ``cls``.
+        """
+        return cls in self.decorators
+
+    def connect(self, switch, address, netmask):
+        """Connect the vertex to a switch.
+
+        Arguments:
+            switch (Vertex): The switch.
+            address (str): The address of the new interface.
+            netmask (str): The netmask of the new interface.
+        """
+        if not hasattr(self, "interfaces"):
+            self.interfaces = Interfaces()
+        self.interfaces.interfaces.append(
+            {
+                "name": f"eth{len(self.interfaces.interfaces)}",
+                "address": address,
+                "netmask": netmask,
+                "switch": switch,
+            }
+        )
+
+    def add_vm_resource(self, start_time, vm_resource_name, dynamic_arg, static_arg):
+        """Record a scheduled vm_resource.
+
+        Arguments:
+            start_time (int): The schedule time.
+            vm_resource_name (str): The name of the vm_resource.
+            dynamic_arg (str): The content passed to the vm_resource.
+            static_arg (str): The name of a file passed to the vm_resource.
+        """
+        self.vm_resources.append(
+            (start_time, vm_resource_name, dynamic_arg, static_arg)
+        )
+
+
+class Graph:
+    """Stand-in for :py:class:`firewheel.control.experiment_graph.ExperimentGraph`."""
+
+    def __init__(self):
+        """Create an empty graph."""
+        self.vertices = []
+
+    def add_vertex(self, vertex):
+        """Add a vertex to the graph.
+
+        Arguments:
+            vertex (Vertex): The vertex.
+        """
+        self.vertices.append(vertex)
+
+    def get_vertices(self):
+        """Get every vertex in the graph.
+
+        Returns:
+            list: The vertices.
+        """
+        return list(self.vertices)
+
+
+def _register_module(name, **attributes):
+    """Create a module and register it in :py:data:`sys.modules`.
+
+    Arguments:
+        name (str): The module name.
+        **attributes: The contents of the module.
+
+    Returns:
+        types.ModuleType: The module.
+    """
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def _load_source(name, path):
+    """Load a Python source file as a module.
+
+    Arguments:
+        name (str): The module name.
+        path (pathlib.Path): The source file.
+
+    Returns:
+        types.ModuleType: The module.
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install(mc_dir=MC_DIR):
+    """Install the stand-in modules and load the DNS model components.
+
+    Arguments:
+        mc_dir (pathlib.Path): The directory holding the DNS model components.
+
+    Returns:
+        dict: The loaded modules, keyed by ``"dns_objects"`` and plugin name.
+    """
+    _register_module("firewheel")
+    _register_module("firewheel.control")
+    _register_module(
+        "firewheel.control.experiment_graph",
+        AbstractPlugin=AbstractPlugin,
+        Vertex=Vertex,
+        require_class=require_class,
+    )
+    _register_module("base_objects", Switch=Switch, VMEndpoint=VMEndpoint)
+    _register_module("linux")
+    _register_module("linux.base_objects", LinuxHost=LinuxHost)
+    _register_module("linux.ubuntu1604", Ubuntu1604Server=Ubuntu1604Server)
+    _register_module("dns")
+
+    mc_dir = Path(mc_dir)
+    modules = {
+        "dns_objects": _load_source(
+            "dns.dns_objects", mc_dir / "dns_objects" / "model_component_objects.py"
+        )
+    }
+    for plugin in PLUGINS:
+        modules[plugin] = _load_source(
+            f"dns.{plugin}_plugin", mc_dir / plugin / "plugin.py"
+        )
+    return modules
@@ -1,22 +1,689 @@
+import io
 import os
-import pickle
-import pprint
+import time
+import queue
+import base64
 import shutil
+import tarfile
+import tempfile
+import functools
+import threading
+import multiprocessing
+import concurrent.futures
 
-from dns.dns_objects import DNSServer
+from dns.dns_objects import (
+    ZONE_CONFIG,
+    ZoneTree,
+    ZoneCache,
+    DNSContext,
+    PayloadCache,
+    PluginMetrics,
+    ZoneTransfers,
+    ZoneBundleWriter,
+    iter_zone_bundle,
+)
 
 from firewheel.control.experiment_graph import AbstractPlugin
 
-CONFIG = {
-    "dns_name": "DNS",
-    "boilerplate_serial": "2014080800",
-    "boilerplate_refresh": "3h",
-    "boilerplate_retry": "15M",
-    "boilerplate_expire": "3W12h",
-    "boilerplate_minimum": "2h20M",
+# Shared with dns.populate_zones, which includes it in the zone cache keys
+CONFIG = ZONE_CONFIG
+
+RELOAD_MODES = ("incremental", "restart")
+# The boilerplate serial as a Unix time, so that serials derived from the
+# current time are always newer than it
+SERIAL_EPOCH = 1407456000
+ZONE_DEPTHS = {"tld": 1, "domain": 2}
+# The zones below this domain are laid out by the reverse_prefix of the server
+REVERSE_ZONES = ".in-addr.arpa."
+# Presets for the bind_profile of a DNS server. Each setting is a statement of
+# the options block of named.conf.options, except for "threads" (the -n option
+# of named). Rate limiting is left off, since it would drop the legitimate
+# bursts of lookups made while the VMs of an experiment boot.
+BIND_PROFILES = {
+    "authoritative": {
+        "recursion": False,
+        "minimal-responses": True,
+        "max-cache-size": "16m",
+        "tcp-clients": 1000,
+        "notify": "explicit",
+    },
+    "caching": {
+        "recursion": True,
+        "allow-recursion": ["any"],
+        "minimal-responses": True,
+        "max-cache-size": "256m",
+        "recursive-clients": 10000,
+        "tcp-clients": 1000,
+        "notify": False,
+    },
 }
 
 
+class ZoneRenderer:
+    """Render the BIND zone files for a single DNS server.
+
+    By default, every domain of the zone tree (and the root) becomes a zone.
+    When ``zone_depth`` is given, the zone tree is flattened: only names with
+    at most ``zone_depth`` labels (e.g. ``1`` for one zone per top-level domain
+    or ``2`` for one zone per registrable domain) become zones, and the records
+    of every deeper name are written into the zone above them after an
+    ``$ORIGIN`` directive for that name. Any deeper name which has its own NS
+    records (i.e. an ``"@"`` record of type NS) remains a separate zone, since
+    it is a real delegation. Reverse zones below ``in-addr.arpa`` also remain
+    separate, since their layout is chosen by the server's ``reverse_prefix``.
+
+    All state is held by the renderer, so a new renderer should be used for
+    each DNS server. Zone files are written to writable text streams, which
+    allows them to be accumulated in memory (see :py:meth:`render`) or written
+    straight to disk (see :py:meth:`write_zone_files`) without building each
+    file up as a single string.
+
+    Attributes:
+        zones_written (int): The number of zone files written so far.
+        records_written (int): The number of records (excluding the SOA and
+            glue records) written so far.
+    """
+
+    def __init__(self, zones, dns_server, zone_depth=None, serial=None):
+        """
+        Arguments:
+            zones (dns.dns_objects.ZoneTree or dict): The zone tree (or zone
+                dictionary) containing information on all zones in the topology.
+            dns_server (str): The IP address of the dns server in the topology.
+            zone_depth (int): The maximum number of labels in a zone name, or
+                :py:data:`None` to create a zone for every domain.
+            serial (str): The SOA serial of every zone, which defaults to
+                ``CONFIG["boilerplate_serial"]``.
+        """
+        self.zones = ZoneTree.coerce(zones)
+        self.dns_server = dns_server
+        self.zone_depth = zone_depth
+        self.serial = serial or CONFIG["boilerplate_serial"]
+        self.zones_written = 0
+        self.records_written = 0
+
+    @staticmethod
+    def has_apex_ns(subtree):
+        """Check whether a domain defines its own NS records.
+
+        Arguments:
+            subtree (dns.dns_objects.ZoneTree): The domain.
+
+        Returns:
+            bool: :py:data:`True` if the domain has an ``"@"`` NS record.
+        """
+        for record in subtree.records:
+            if record.type == "NS" and record.owner in {None, "@"}:
+                return True
+        for entries in subtree.children.values():
+            if isinstance(entries, ZoneTree):
+                continue
+            for record in entries:
+                if record.type == "NS" and record.owner == "@":
+                    return True
+        return False
+
+    def is_zone_apex(self, subtree, depth, domain=""):
+        """Check whether a domain should be rendered as its own zone.
+
+        Arguments:
+            subtree (dns.dns_objects.ZoneTree): The domain.
+            depth (int): The number of labels in the domain name.
+            domain (str): The fully qualified domain name.
+
+        Returns:
+            bool: :py:data:`True` if the domain is a zone.
+        """
+        return (
+            self.zone_depth is None
+            or depth <= self.zone_depth
+            or domain.endswith(REVERSE_ZONES)
+            or self.has_apex_ns(subtree)
+        )
+
+    def find_inlined(self, subtree, domain, depth):
+        """Find the domains whose records are written into a zone.
+
+        Arguments:
+            subtree (dns.dns_objects.ZoneTree): The zone's domain.
+            domain (str): The fully qualified domain name of the zone.
+            depth (int): The number of labels in the zone name.
+
+        Returns:
+            list: The fully qualified name and subtree of every descendant
+            domain which is not a zone itself, depth first.
+        """
+        inlined = []
+        if self.zone_depth is None:
+            return inlined
+        stack = [(iter(subtree.items()), domain, depth)]
+        while stack:
+            items, parent, parent_depth = stack[-1]
+            for label, child in items:
+                if not isinstance(child, ZoneTree):
+                    continue
+                # Reverse zone keys such as "0.0.10" hold several labels
+                child_depth = parent_depth + label.count(".") + 1
+                base_domain = f"{label}.{parent}"
+                if not self.is_zone_apex(child, child_depth, base_domain):
+                    inlined.append((base_domain, child))
+                    stack.append((iter(child.items()), base_domain, child_depth))
+                    break
+            else:
+                stack.pop()
+        return inlined
+
+    def walk_zones(self):
+        """Walk the zone tree, finding every zone which must be created.
+
+        Zones are yielded depth first, in the order of the zone tree, followed
+        by the root zone.
+
+        Yields:
+            tuple: The fully qualified zone name (``""`` for the root zone),
+            the domain of the zone tree which belongs to it and the domains
+            which are written into the zone (see :py:meth:`find_inlined`).
+        """
+        stack = [(iter(self.zones.items()), "", 0)]
+        while stack:
+            items, domain, depth = stack[-1]
+            for label, subtree in items:
+                if isinstance(subtree, ZoneTree):
+                    base_domain = f"{label}.{domain}"
+                    subtree_depth = depth + label.count(".") + 1
+                    if self.is_zone_apex(subtree, subtree_depth, base_domain):
+                        inlined = self.find_inlined(subtree, base_domain, subtree_depth)
+                        yield base_domain, subtree, inlined
+                    stack.append((iter(subtree.items()), base_domain, subtree_depth))
+                    break
+            else:
+                stack.pop()
+        yield "", self.zones, self.find_inlined(self.zones, "", 0)
+
+    def write_boilerplate(self, stream, zone):
+        """Writes the boiler plate (``$ORIGIN``, ``$TTL`` and SOA) of a zone file.
+
+        Arguments:
+            stream (io.TextIOBase): The stream to write to.
+            zone (str): The fully qualified domain name for this zone.
+        """
+        stream.write("$ORIGIN .\n" if not zone else f"$ORIGIN {zone}\n")
+        stream.write("$TTL 5m\n")
+        stream.write(f"@ IN SOA ns.{zone} noemail.noreply.org (\n")
+        stream.write(f"\t\t\t{self.serial}\n")
+        stream.write(f"\t\t\t{CONFIG['boilerplate_refresh']}\n")
+        stream.write(f"\t\t\t{CONFIG['boilerplate_retry']}\n")
+        stream.write(f"\t\t\t{CONFIG['boilerplate_expire']}\n")
+        stream.write(f"\t\t\t{CONFIG['boilerplate_minimum']} )\n")
+
+    def write_glue_record(self, stream, base_domain):
+        """Writes the glue record for a zone.
+
+        Arguments:
+            stream (io.TextIOBase): The stream to write to.
+            base_domain (str): The fully qualified domain name of the zone.
+        """
+        fqdn = f"ns.{base_domain}"
+        stream.write(f"{base_domain}\tIN\tNS\t{fqdn}\n")
+        stream.write(f"{fqdn}\tIN\tA\t{self.dns_server}\n\n")
+
+    def write_root_glue_record(self, stream):
+        """Writes the glue record for the root zone.
+
+        Arguments:
+            stream (io.TextIOBase): The stream to write to.
+        """
+        stream.write(". IN NS ns.\n")
+        stream.write(f"ns. IN A {self.dns_server}\n")
+        for zone, subtree in self.zones.items():
+            if isinstance(subtree, ZoneTree):
+                fqdn = f"ns.{zone}."
+                stream.write(f"{zone}.\tIN\tNS\t{fqdn}\n")
+                stream.write(f"{fqdn}\tIN\tA\t{self.dns_server}\n\n")
+
+    def write_records(self, stream, subtree, separator=""):
+        """Writes the records for the machines directly within a zone.
+
+        The records of the domain itself are written first, followed by the
+        records of each host in the domain.
+
+        Arguments:
+            stream (io.TextIOBase): The stream to write to.
+            subtree (dns.dns_objects.ZoneTree): The zone's domain.
+            separator (str): Text written before the first record, if any.
+
+        Returns:
+            int: The number of records written.
+        """
+        count = 0
+        for zone, entries in (("@", subtree.records), *subtree.items()):
+            if isinstance(entries, ZoneTree):
+                continue
+            for resource_type, resource_record, subdomain in entries:
+                # Records may have a special subdomain to add to the zone,
+                # otherwise the subdomain is the name they are stored under
+                if not count:
+                    stream.write(separator)
+                stream.write(
+                    f"{subdomain or zone}\tIN\t{resource_type}\t{resource_record}\n"
+                )
+                count += 1
+        return count
+
+    def write_zone(self, stream, zone, subtree, inlined=()):
+        """Writes a complete zone file.
+
+        Arguments:
+            stream (io.TextIOBase): The stream to write to.
+            zone (str): The fully qualified domain name for this zone.
+            subtree (dns.dns_objects.ZoneTree): The zone's domain.
+            inlined (list): The fully qualified name and subtree of each domain
+                whose records are also written into this zone.
+
+        Returns:
+            int: The number of records written, excluding the SOA and glue.
+        """
+        self.write_boilerplate(stream, zone)
+        stream.write("\n")
+        if zone:
+            self.write_glue_record(stream, zone)
+        else:
+            self.write_root_glue_record(stream)
+        count = self.write_records(stream, subtree, separator="\n")
+        for domain, domain_subtree in inlined:
+            separator = f"$ORIGIN {domain}\n"
+            count += self.write_records(
+                stream, domain_subtree, separator if count else f"\n{separator}"
+            )
+        self.zones_written += 1
+        self.records_written += count
+        return count
+
+    def render(self):
+        """Render every zone file in memory.
+
+        Returns:
+            dict: A mapping of zone names to the contents of their zone files.
+        """
+        zone_files = {}
+        for zone, subtree, inlined in self.walk_zones():
+            buffer = io.StringIO()
+            self.write_zone(buffer, zone, subtree, inlined)
+            zone_files[zone] = buffer.getvalue()
+        return zone_files
+
+    def render_chunk(self, chunk=0, chunks=1):
+        """Render an interleaved share of the zone files in memory.
+
+        The zones are taken in the order they are bundled, so the shares of
+        ``chunks`` renderers can be merged into the same bundle as
+        :py:meth:`write_bundle` (see :py:class:`ParallelRenderer`).
+
+        Arguments:
+            chunk (int): Which share of the zones to render, from ``0`` to
+                ``chunks - 1``.
+            chunks (int): The number of shares.
+
+        Returns:
+            list: The name and zone file of every ``chunks``-th zone, starting
+            with zone number ``chunk``.
+        """
+        zone_files = []
+        for position, (zone, subtree, inlined) in enumerate(self.walk_zones()):
+            if position % chunks == chunk:
+                buffer = io.StringIO()
+                self.write_zone(buffer, zone, subtree, inlined)
+                zone_files.append((zone, buffer.getvalue()))
+        return zone_files
+
+    def write_bundle(self, stream, options=None):
+        """Write every zone file into a zone bundle, one zone at a time.
+
+        Arguments:
+            stream (io.TextIOBase): The writable text stream for the bundle.
+            options (dict): The options to place in the bundle header.
+
+        Returns:
+            int: The number of zones which were written.
+        """
+        with ZoneBundleWriter(stream, options=options) as bundle:
+            for zone, subtree, inlined in self.walk_zones():
+                buffer = io.StringIO()
+                self.write_zone(buffer, zone, subtree, inlined)
+                bundle.add(zone, buffer.getvalue())
+        return bundle.entries
+
+    def write_zone_files(self, directory):
+        """Write every zone file to a directory, one zone at a time.
+
+        The root zone is written to a file named ``dot.``, and every other zone
+        to a file named after the zone.
+
+        Arguments:
+            directory (str): The directory in which to write the zone files.
+
+        Returns:
+            list: The names of the zones which were written.
+        """
+        written = []
+        for zone, subtree, inlined in self.walk_zones():
+            path = os.path.join(directory, zone or "dot.")
+            with open(path, "w", encoding="utf-8") as zone_file:
+                self.write_zone(zone_file, zone, subtree, inlined)
+            written.append(zone)
+        return written
+
+
+# The jobs of the active ParallelRenderer, which its forked workers inherit
+_RENDER_JOBS = []
+
+
+def _render_job(job, chunk, chunks):
+    """Render a job of the active :py:class:`ParallelRenderer` in a worker.
+
+    Arguments:
+        job (int): The position of the job in ``_RENDER_JOBS``.
+        chunk (int): Which share of the job's zones to render.
+        chunks (int): The number of shares the job is split into.
+
+    Returns:
+        tuple: The zone bundle (or, if the job is split, the zone files of the
+        share), the number of zones and the number of records rendered.
+    """
+    zones, dns_server, options, zone_depth = _RENDER_JOBS[job]
+    renderer = ZoneRenderer(zones, dns_server, zone_depth, options.get("serial"))
+    if chunks == 1:
+        buffer = io.StringIO()
+        renderer.write_bundle(buffer, options)
+        rendered = buffer.getvalue()
+    else:
+        rendered = renderer.render_chunk(chunk, chunks)
+    return rendered, renderer.zones_written, renderer.records_written
+
+
+class ParallelRenderer:
+    """Render the zone bundles of several DNS servers in worker processes.
+
+    Jobs are added with :py:meth:`add` and then rendered by a pool of
+    workers, which are forked by :py:meth:`start`. The zone trees are not
+    pickled: the workers inherit the list of jobs from the parent process,
+    and only send back the rendered bundles. When there are fewer jobs than
+    workers, each job is split into interleaved shares of its zones (see
+    :py:meth:`ZoneRenderer.render_chunk`), which are bundled in order by
+    :py:meth:`result`. Either way, the bundles are identical to those
+    rendered by :py:meth:`ConfigureBind.render_payload`.
+    """
+
+    def __init__(self, workers):
+        """
+        Arguments:
+            workers (int): The number of worker processes.
+        """
+        self.workers = workers
+        self.jobs = []
+        self._keys = {}
+        self._futures = {}
+        self._pool = None
+
+    @staticmethod
+    def available():
+        """Check whether worker processes can be forked on this platform.
+
+        Returns:
+            bool: :py:data:`True` if the ``fork`` start method is available.
+        """
+        return "fork" in multiprocessing.get_all_start_methods()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key, zones, dns_server, options, zone_depth):
+        """Add a zone bundle to render, unless it has already been added.
+
+        Arguments:
+            key (str): The payload key of the bundle.
+            zones (dns.dns_objects.ZoneTree): The zone tree of the DNS server.
+            dns_server (str): The IP address of the DNS server.
+            options (dict): The options to place in the zone bundle header.
+            zone_depth (int): The maximum number of labels in a zone name.
+        """
+        if key not in self._keys:
+            self._keys[key] = len(self.jobs)
+            self.jobs.append((zones, dns_server, options or {}, zone_depth))
+
+    def start(self):
+        """Fork the workers and submit every job.
+
+        This should be called before the parent process starts any threads.
+        """
+        if not self.jobs:
+            return
+        chunks = max(1, self.workers // len(self.jobs))
+        _RENDER_JOBS[:] = self.jobs
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            min(self.workers, len(self.jobs) * chunks),
+            mp_context=multiprocessing.get_context("fork"),
+        )
+        for key, job in self._keys.items():
+            self._futures[key] = [
+                self._pool.submit(_render_job, job, chunk, chunks)
+                for chunk in range(chunks)
+            ]
+
+    def result(self, key, counts=None):
+        """Wait for a zone bundle to be rendered.
+
+        Arguments:
+            key (str): The payload key of the bundle.
+            counts (dict): If given, the number of zones and records which were
+                rendered are stored in it under ``"zones"`` and ``"records"``.
+
+        Returns:
+            str: The zone bundle.
+        """
+        results = [future.result() for future in self._futures.pop(key)]
+        if len(results) == 1:
+            bundle = results[0][0]
+        else:
+            buffer = io.StringIO()
+            options = self.jobs[self._keys[key]][2]
+            shares = [iter(zone_files) for zone_files, _, _ in results]
+            with ZoneBundleWriter(buffer, options=options) as writer:
+                for position in range(
+                    sum(len(zone_files) for zone_files, _, _ in results)
+                ):
+                    writer.add(*next(shares[position % len(shares)]))
+            bundle = buffer.getvalue()
+        if counts is not None:
+            counts["zones"] = sum(zones for _, zones, _ in results)
+            counts["records"] = sum(records for _, _, records in results)
+        return bundle
+
+    def close(self):
+        """Stop the workers and release the jobs."""
+        for futures in self._futures.values():
+            for future in futures:
+                future.cancel()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        self._futures = {}
+        _RENDER_JOBS.clear()
+
+
+class DebugArchiveWriter:
+    """Save the debugging output of :py:class:`ConfigureBind` on a background thread.
+
+    Everything saved for a DNS server (its zone files, its zone bundle and its
+    zone tree) is written into a single ``<server>.tar.gz`` archive in
+    the debug directory, rather than into one file per zone. The archives are
+    written by a worker thread, which is handed each server's zone bundle and
+    zone tree through a bounded queue. When the worker falls behind,
+    :py:meth:`submit` blocks, which limits the number of payloads held in memory.
+
+    Any previous debug directory is moved aside when the writer starts and is
+    deleted by the worker once every archive has been written.
+    """
+
+    def __init__(self, dirname, log, max_pending=4):
+        """
+        Arguments:
+            dirname (str): The debug directory.
+            log (logging.Logger): Reports archives which could not be written.
+            max_pending (int): The number of servers which may be waiting to be
+                written before :py:meth:`submit` blocks.
+        """
+        self.dirname = dirname
+        self.log = log
+        self.written = []
+        self._queue = queue.Queue(max_pending)
+        self._thread = None
+        self._stale = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """Create an empty debug directory and start the worker thread."""
+        if os.path.exists(self.dirname):
+            parent = os.path.dirname(os.path.abspath(self.dirname))
+            self._stale = tempfile.mkdtemp(prefix=".dns_debug_old-", dir=parent)
+            os.rename(self.dirname, os.path.join(self._stale, "old"))
+        os.mkdir(self.dirname)
+        self._thread = threading.Thread(
+            target=self._work, name="dns-debug-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, name, zones, zone_bundle):
+        """Queue the debugging output of a DNS server to be written.
+
+        Arguments:
+            name (str): The name of the DNS server.
+            zones (dns.dns_objects.ZoneTree): The zone tree of the DNS server.
+                It must not be modified until :py:meth:`close` returns.
+            zone_bundle (str): The zone bundle passed to the DNS server.
+        """
+        self._queue.put((name, zones, zone_bundle))
+
+    def close(self):
+        """Wait for every queued archive to be written and stop the worker."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _work(self):
+        """Write queued archives until :py:meth:`close` is called."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self.write_archive(*item)
+            except Exception:
+                self.log.exception(
+                    "Unable to save the DNS debug output for %s", item[0]
+                )
+        if self._stale:
+            shutil.rmtree(self._stale, ignore_errors=True)
+
+    def write_archive(self, name, zones, zone_bundle):
+        """Write the debugging output of a DNS server into its archive.
+
+        The archive holds ``<server>/zone_bundle``, ``<server>/zone_dictionary``
+        (see :py:meth:`format_zone_dictionary`) and one ``<server>/zones/<zone>``
+        file per zone, where the root zone is named ``dot.``.
+
+        Arguments:
+            name (str): The name of the DNS server.
+            zones (dns.dns_objects.ZoneTree): The zone tree of the DNS server, or
+                :py:data:`None` if its bundle was taken from the zone cache.
+            zone_bundle (str): The zone bundle passed to the DNS server.
+
+        Returns:
+            str: The path of the archive.
+        """
+        path = os.path.join(self.dirname, f"{name}.tar.gz")
+        with tarfile.open(path, "w:gz", compresslevel=1) as archive:
+            self._add_member(archive, f"{name}/zone_bundle", zone_bundle)
+            # The zone files are taken from the bundle rather than rendered again
+            for zone, text in iter_zone_bundle(io.StringIO(zone_bundle)):
+                self._add_member(archive, f"{name}/zones/{zone or 'dot.'}", text)
+            # Save the zone data for easy reading, unless the bundle was cached
+            if zones is not None:
+                self._add_member(
+                    archive,
+                    f"{name}/zone_dictionary",
+                    self.format_zone_dictionary(zones),
+                )
+        self.written.append(path)
+        return path
+
+    @staticmethod
+    def format_zone_dictionary(zones):
+        """Format a zone tree as an indented outline.
+
+        Each domain is written on its own line, followed by its children
+        indented beneath it, and each host (and the domain itself, as ``@``) is
+        written with its records on a single line, as in a zone dictionary.
+        This is much faster than :py:func:`pprint.pformat` for large zone trees.
+
+        Arguments:
+            zones (dns.dns_objects.ZoneTree or dict): The zone tree.
+
+        Returns:
+            str: The formatted zone tree.
+        """
+
+        def format_records(indent, label, records):
+            entries = [record.as_entry() for record in records]
+            return f"{indent}{label}: {entries!r}"
+
+        zones = ZoneTree.coerce(zones)
+        lines = []
+        if zones.records:
+            lines.append(format_records("", "@", zones.records))
+        stack = [(iter(zones.items()), "")]
+        while stack:
+            items, indent = stack[-1]
+            for label, subtree in items:
+                if isinstance(subtree, ZoneTree):
+                    lines.append(f"{indent}{label}:")
+                    if subtree.records:
+                        lines.append(
+                            format_records(f"{indent}  ", "@", subtree.records)
+                        )
+                    stack.append((iter(subtree.items()), f"{indent}  "))
+                    break
+                lines.append(format_records(indent, label, subtree))
+            else:
+                stack.pop()
+        lines.append("")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _add_member(archive, member, text):
+        """Add a text file to an archive.
+
+        Arguments:
+            archive (tarfile.TarFile): The archive.
+            member (str): The path of the file within the archive.
+            text (str): The contents of the file.
+        """
+        data = text.encode("utf-8")
+        info = tarfile.TarInfo(member)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        archive.addfile(info, io.BytesIO(data))
+
+
 class ConfigureBind(AbstractPlugin):
     """This plugin configures DNS for the experiment.
 
@@ -41,236 +708,577 @@ class ConfigureBind(AbstractPlugin):
             **kwargs: extra keyword args to pass to AbstractPlugin constructor
         """
         super(ConfigureBind, self).__init__(*args, **kwargs)
-        self.bind_zones = {}
-        self.zonedir = None
         self.dirname = None
         self.DEBUG = False
+        self.debug_writer = None
+        self.payloads = PayloadCache()
+        self.metrics = None
+        self._zone_digests = {}
+        self._payload_counts = {}
+        self.transfers = None
+        self.transfer_serial = None
+        self.parallel = None
 
-    def run(self, debug=""):
+    def run(self, debug="", report="", workers=""):
         """Function to invoke the ConfigureDNS plugin.
 
         Arguments:
             debug(str): Enable debugging information to see everything the
-                parser gathers. Value should be 'True' or 'true' to enable
+                parser gathers (see :py:class:`DebugArchiveWriter`). Value
+                should be 'True' or 'true' to enable
+            report(str): Write the plugin's timers and counters to a JSON file
+                (see :py:class:`dns.dns_objects.PluginMetrics`). Value should be
+                'True' or 'true' to enable
+            workers(str): The number of worker processes which render zone
+                bundles (see :py:class:`ParallelRenderer`), or 'auto' for one
+                per CPU. By default, every bundle is rendered by the plugin's
+                own process.
         """
         self.DEBUG = debug.startswith("T") or debug.startswith("t")
+        self.metrics = PluginMetrics("configure_bind")
+
+        try:
+            self.configure_servers(self.get_workers(workers))
+        finally:
+            if self.debug_writer is not None:
+                with self.metrics.timer("debug_output"):
+                    self.debug_writer.close()
+                self.debug_writer = None
+            if self.parallel is not None:
+                self.parallel.close()
+                self.parallel = None
+
+        self.log.debug(
+            "Rendered %d distinct zone payloads, reused %d",
+            self.payloads.misses,
+            self.payloads.hits,
+        )
+        self.metrics.count("payloads_rendered", self.payloads.misses)
+        self.metrics.count("payloads_reused", self.payloads.hits)
+        self.metrics.finish(self.log, report)
+
+    def get_workers(self, workers=""):
+        """Get the number of worker processes requested by the plugin's arguments.
+
+        Invalid values are logged and rendering stays in the plugin's process.
+
+        Arguments:
+            workers (str): The number of worker processes, or ``"auto"``.
+
+        Returns:
+            int: The number of worker processes, where ``1`` renders every
+            bundle in the plugin's process.
+        """
+        if not workers:
+            return 1
+        if str(workers).lower() == "auto":
+            return os.cpu_count() or 1
+        try:
+            count = int(workers)
+        except ValueError:
+            count = 0
+        if count < 1:
+            self.log.warning("Invalid number of workers %s, using 1", workers)
+            return 1
+        if count > 1 and not ParallelRenderer.available():
+            self.log.warning("Worker processes can not be forked, using 1")
+            return 1
+        return count
+
+    def configure_servers(self, workers=1):
+        """Render the zone bundle of each DNS server and schedule it to be applied.
 
+        Secondary DNS servers (see :py:class:`dns.dns_objects.ZoneTransfers`)
+        are configured after every other server, since they only need the
+        names of their primary's zones (see :py:meth:`configure_secondary`).
+
+        Arguments:
+            workers (int): The number of worker processes which render zone
+                bundles (see :py:meth:`start_workers`).
+        """
+        context = DNSContext.get(self.g, self.log)
+        if context.reused:
+            self.metrics.count("context_reused")
+        else:
+            self.metrics.count("vertices_scanned", context.vertices_scanned)
+        servers = context.servers
+        # dns.populate_zones has already warned about any invalid primaries
+        self.transfers = ZoneTransfers(servers)
+
+        if workers > 1:
+            with self.metrics.timer("start_workers"):
+                self.start_workers(servers, workers)
+        # The workers must be forked before the debug writer's thread starts
         if self.DEBUG:
             self.dirname = "dns_zones"
-            if os.path.exists(self.dirname):
-                shutil.rmtree(self.dirname)
-            os.mkdir(self.dirname)
-
-        # Create zones for dns servers
-        for vertex in self.g.get_vertices():
-            # Look for key like {'dns':{"domains" [".ssn.gov"]}}
-            if vertex.is_decorated_by(DNSServer):
-                name = vertex.name
-                if self.DEBUG:
-                    self.zonedir = os.path.join(self.dirname, name)
-                    os.mkdir(self.zonedir)
-                zones = vertex.dns_data.get("zones")
-                dns_address = vertex.dns_data.get("dns_address")
-                self.generate_zone_files(zones, dns_address)
-                pickled_metadata = self.get_metadata(self.bind_zones)
-                vertex.add_vm_resource(
-                    -2, "configure_bind_agent.py", pickled_metadata, None
-                )
-                if self.DEBUG:
-                    pickle_file = open(
-                        os.path.join(self.zonedir, "pickled_metadata"), "w", encoding="utf-8"
-                    )
-                    pickle_file.write(pickled_metadata)
-                    pickle_file.close()
-                    # Save the zone data dictionary for easy reading
-                    pickle_file = open(
-                        os.path.join(self.zonedir, "zone_dictionary"), "w", encoding="utf-8"
-                    )
-                    pickle_file.write(pprint.pformat(zones))
-                    pickle_file.close()
+            self.debug_writer = DebugArchiveWriter(self.dirname, self.log)
+            self.debug_writer.start()
+
+        bundles = {}
+        for vertex in servers:
+            if not self.transfers.is_secondary(vertex):
+                bundles[id(vertex)] = self.configure_server(vertex)
+        for vertex in servers:
+            if self.transfers.is_secondary(vertex):
+                primary = self.transfers.primaries(vertex)[0]
+                self.configure_secondary(vertex, bundles[id(primary)])
+
+    def start_workers(self, servers, workers):
+        """Start rendering the distinct zone bundles in worker processes.
+
+        :py:meth:`configure_server` then collects each bundle in graph order,
+        so the servers are configured exactly as if the bundles had been
+        rendered in this process.
+
+        Arguments:
+            servers (list): The DNS server vertices.
+            workers (int): The number of worker processes.
+        """
+        self.parallel = ParallelRenderer(workers)
+        for vertex in servers:
+            if self.transfers.is_secondary(vertex):
+                continue
+            if vertex.dns_data.get("zone_cache_key") and (
+                vertex.dns_data.get("zone_bundle") is not None
+            ):
+                continue
+            zones = vertex.dns_data.get("zones")
+            dns_address = vertex.dns_data.get("dns_address")
+            options = self.get_agent_options(vertex)
+            zone_depth = self.get_zone_depth(vertex)
+            key = self.get_payload_key(zones, dns_address, options, zone_depth)
+            self.parallel.add(key, zones, dns_address, options, zone_depth)
+        self.metrics.count("render_jobs", len(self.parallel.jobs))
+        self.parallel.start()
 
-    def get_metadata(self, zones):
-        """Concatenates glue and a records together to make a single zone file
+    def configure_server(self, vertex):
+        """Render the zone bundle of a DNS server and schedule it to be applied.
 
-        Once a single file for each zone is generated, pickle and encode them
-        so they can be distributed by the metadata server.
+        DNS servers with a ``zone_cache`` directory in their ``dns_data`` reuse
+        the bundle ``dns.populate_zones`` found in the cache (in the
+        ``zone_bundle`` key of their ``dns_data``). Otherwise, the rendered
+        bundle is stored in the cache under the server's ``zone_cache_key``.
 
         Arguments:
-            zones (dict): All generated zone files for the topology
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
 
         Returns:
-            str: The pickled zone metadata.
+            str: The zone bundle of the server.
         """
-        metadata = {}
-        for zone in zones:
-            zone_file_contents = f"{self.get_boilerplate(zone)}"
-            if "glue" in zones[zone]:
-                zone_file_contents += f"\n{zones[zone]['glue']}"
-            if "%RR%" in zones[zone]:
-                zone_file_contents += f"\n{zones[zone]['%RR%']}"
-            metadata[zone] = zone_file_contents
+        name = vertex.name
+        zones = vertex.dns_data.get("zones")
+        dns_address = vertex.dns_data.get("dns_address")
+        cache_key = vertex.dns_data.get("zone_cache_key")
+        cached_bundle = vertex.dns_data.get("zone_bundle")
+        rendered = self.payloads.misses
+        with self.metrics.timer("render", server=name):
+            if cache_key and cached_bundle is not None:
+                self.metrics.count("cache_hits", server=name)
+                counts = {}
+                zone_bundle = cached_bundle
+            else:
+                options = self.get_agent_options(vertex)
+                zone_depth = self.get_zone_depth(vertex)
+                key = self.get_payload_key(zones, dns_address, options, zone_depth)
+                counts = self._payload_counts.setdefault(key, {})
+                if self.parallel is not None and key in self.parallel:
+                    render = functools.partial(self.parallel.result, key, counts)
+                else:
+                    render = functools.partial(
+                        self.render_payload,
+                        zones,
+                        dns_address,
+                        options,
+                        zone_depth,
+                        counts,
+                    )
+                zone_bundle = self.payloads.get(key, render)
+        if cache_key and cached_bundle is None:
+            with self.metrics.timer("cache_store", server=name):
+                ZoneCache(vertex.dns_data["zone_cache"]).put(cache_key, zone_bundle)
+            self.metrics.count("cache_stores")
+        self.schedule_agent(vertex, zone_bundle)
+        self.metrics.count("servers")
+        if counts:
+            self.metrics.count("zones", counts["zones"], server=name)
+            self.metrics.count("records", counts["records"], server=name)
+        self.metrics.count("payload_bytes", len(zone_bundle), server=name)
+        if self.payloads.misses > rendered:
+            self.metrics.count("distinct_payload_bytes", len(zone_bundle))
+        if self.debug_writer is not None:
+            # Blocks only while the writer is behind by several servers
+            with self.metrics.timer("debug_output", server=name):
+                self.debug_writer.submit(name, zones, zone_bundle)
+        return zone_bundle
+
+    def configure_secondary(self, vertex, primary_bundle):
+        """Schedule a secondary DNS server to transfer its zones from its primaries.
+
+        The secondary's bundle lists the zones of its first primary without
+        their zone files, and its header tells ``configure_bind_agent.py`` to
+        configure each zone as ``type slave`` of every primary (see
+        :py:meth:`get_agent_options`). Secondaries with the same primaries
+        share a single bundle.
 
-            if self.DEBUG:
-                if not zone:
-                    zone = "dot."
-                zone_file = open(os.path.join(self.zonedir, zone), "w", encoding="utf-8")
-                zone_file.write(zone_file_contents)
-                zone_file.close()
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The secondary.
+            primary_bundle (str): The zone bundle of its first primary.
+        """
+        name = vertex.name
+        with self.metrics.timer("render", server=name):
+            options = self.get_agent_options(vertex)
+            zone_bundle = self.payloads.get(
+                PayloadCache.digest(primary_bundle, repr(sorted(options.items()))),
+                functools.partial(self.render_secondary, primary_bundle, options),
+            )
+        self.schedule_agent(vertex, zone_bundle)
+        self.metrics.count("servers")
+        self.metrics.count("secondaries")
+        self.metrics.count("payload_bytes", len(zone_bundle), server=name)
+        if self.debug_writer is not None:
+            with self.metrics.timer("debug_output", server=name):
+                self.debug_writer.submit(name, None, zone_bundle)
 
-        pickled_metadata = pickle.dumps(metadata, protocol=0).decode()
-        return pickled_metadata
+    def schedule_agent(self, vertex, zone_bundle):
+        """Schedule ``configure_bind_agent.py`` on a DNS server.
 
-    def generate_zone_files(self, zones, dns_server):
-        """Function to seed the recursion of the dictionary.
+        The agent runs at the ``configure_bind`` time of the server's
+        ``dns_data["start_times"]`` (see
+        :py:meth:`dns.dns_objects.DNSServer.get_start_time`). Since negative
+        times run one after another, it must come after bind is installed.
 
         Arguments:
-            zones(dict): Dictionary containing information on all
-                zones in the topology.
-            dns_server(str): The IP address of the dns server in the topology
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+            zone_bundle (str): The zone bundle of the server.
         """
-        self.walk_zones(zones, "", dns_server)
-        self.generate_root_glue_record(zones, dns_server)
+        start_time = vertex.get_start_time("configure_bind")
+        if start_time <= vertex.get_start_time("install_bind"):
+            self.log.warning(
+                "configure_bind time %s of %s is not after its install_bind time",
+                start_time,
+                vertex.name,
+            )
+        vertex.add_vm_resource(start_time, "configure_bind_agent.py", zone_bundle, None)
 
-    def walk_zones(self, zones, domain, dns_server):
-        """Walks the dictionary creating a records and glue records
+    @staticmethod
+    def render_secondary(primary_bundle, options):
+        """Render the zone bundle of a secondary DNS server.
 
         Arguments:
-            zones(dict): Dictionary containing information on all zones in the
-                topology.
-            domain(str): The base for the current machine's fully qualified
-                domain name
-            dns_server(str): The IP address of the dns server in the topology
+            primary_bundle (str): The zone bundle of the secondary's first primary.
+            options (dict): The options to place in the zone bundle header.
+
+        Returns:
+            str: A zone bundle with an empty zone file for each of the
+            primary's zones.
         """
+        buffer = io.StringIO()
+        with ZoneBundleWriter(buffer, options=options) as bundle:
+            for zone, _ in iter_zone_bundle(io.StringIO(primary_bundle)):
+                bundle.add(zone, "")
+        return buffer.getvalue()
 
-        for zone in zones:
-            base_domain = f"{zone}.{domain}"
-            if isinstance(zones[zone], dict):
-                self.generate_glue_record(zone, base_domain, dns_server)
-                self.walk_zones(zones[zone], base_domain, dns_server)
+    def get_transfer_serial(self):
+        """Get the SOA serial of the zones of primary DNS servers.
 
-        self.generate_records(zones, domain)
+        Secondaries only transfer a zone when its serial increases, so the
+        zones of primaries are given a serial which increases every second:
+        the boilerplate serial plus the seconds elapsed since the date it
+        encodes. The serial is chosen once per run, so every primary uses the
+        same serial and identical primaries still share their bundle.
+        ``configure_bind_agent.py`` compares each zone file without its serial,
+        so only the zones whose records changed take the new serial, and
+        unchanged zones keep the serial of the run which last changed them.
+
+        Returns:
+            str: The serial.
+        """
+        if self.transfer_serial is None:
+            elapsed = max(int(time.time()) - SERIAL_EPOCH, 0)
+            self.transfer_serial = str(int(CONFIG["boilerplate_serial"]) + elapsed)
+        return self.transfer_serial
 
-    def generate_glue_record(self, zone_name, base_domain, dns_server):
-        """Creates a glue record for the current zone
+    def get_bind_profile(self, vertex):
+        """Get the BIND tuning profile of a DNS server.
 
-        Looks for all branches stemming from this point in the tree.
-        Skips any definitions of singular machines.
+        The ``bind_profile`` key of a DNS server's ``dns_data`` may be
+        :py:data:`None` (the default) to keep the distribution's
+        ``named.conf.options``, the name of a preset in :py:data:`BIND_PROFILES`
+        (``"authoritative"`` or ``"caching"``), or a dictionary of settings.
+        A dictionary may name a preset to start from under its ``"preset"``
+        key, and settings of :py:data:`None` remove the preset's setting.
 
         Arguments:
-            zone_name(str): Current zone in the dictionary
-            base_domain(str): Base name for the fully qualified domain name
-            dns_server(str): The IP address of the dns_server
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            dict: The settings, or :py:data:`None` to keep the default options.
         """
-        glue_record = ""
-        zone_name += "."
-        fqdn = f"ns.{base_domain}"
-        glue_record += f"{base_domain}\tIN\tNS\t{fqdn}\n"
-        glue_record += f"{fqdn}\tIN\tA\t{dns_server}\n\n"
+        profile = vertex.dns_data.get("bind_profile")
+        if not profile:
+            return None
+        if not isinstance(profile, dict):
+            profile = {"preset": profile}
+        settings = {}
+        preset = profile.get("preset")
+        if preset is not None:
+            if preset not in BIND_PROFILES:
+                self.log.warning(
+                    "Unknown bind_profile preset %s for %s, ignoring it",
+                    preset,
+                    vertex.name,
+                )
+            settings.update(BIND_PROFILES.get(preset, {}))
+        settings.update(profile)
+        settings.pop("preset", None)
+        return {key: value for key, value in settings.items() if value is not None}
 
-        if glue_record:
-            if base_domain not in self.bind_zones:
-                self.bind_zones[base_domain] = {}
-            self.bind_zones[base_domain]["glue"] = glue_record
+    @classmethod
+    def format_option_value(cls, value):
+        """Format the value of a ``named.conf`` statement.
 
-        if self.DEBUG:
-            if glue_record:
-                gr_file = open(
-                    os.path.join(self.zonedir, f"{base_domain}{'glue'}"), "w", encoding="utf-8"
-                )
-                gr_file.write(glue_record)
-                gr_file.close()
+        Arguments:
+            value: A boolean (``yes`` or ``no``), a list (an address match list
+                such as ``{ any; }``), a dictionary (a block of statements) or
+                any other value, which is written as is.
 
-    def generate_root_glue_record(self, root_zone, dns_server):
+        Returns:
+            str: The formatted value.
         """
-        Creates a glue record for the root zone.
+        if isinstance(value, bool):
+            return "yes" if value else "no"
+        if isinstance(value, dict):
+            statements = " ".join(
+                f"{key} {cls.format_option_value(item)};" for key, item in value.items()
+            )
+            return f"{{ {statements} }}"
+        if isinstance(value, (list, tuple)):
+            return "{ " + " ".join(f"{item};" for item in value) + " }"
+        return str(value)
+
+    @classmethod
+    def render_named_options(cls, settings):
+        """Render ``named.conf.options`` from the settings of a BIND profile.
+
+        The distribution's defaults for the cache directory and IPv6 listeners
+        are kept, and every setting except ``threads`` becomes a statement of
+        the options block, in order.
 
         Arguments:
-            root_zone(dict): The root zone for which to create a glue record
-            dns_server(str): IP address of the dns_server in the topology
+            settings (dict): The settings (see :py:meth:`get_bind_profile`).
+
+        Returns:
+            str: The contents of ``named.conf.options``.
         """
-        base_domain = ""
-        glue_record = ""
+        lines = [
+            "options {",
+            '\tdirectory "/var/cache/bind";',
+            "\tlisten-on-v6 { any; };",
+        ]
+        for key, value in settings.items():
+            if key != "threads":
+                lines.append(f"\t{key} {cls.format_option_value(value)};")
+        lines.append("};\n")
+        return "\n".join(lines)
 
-        glue_record += ". IN NS ns.\n"
-        glue_record += f"ns. IN A {dns_server}\n"
+    def get_agent_options(self, vertex):
+        """Get the options which tell configure_bind_agent.py how to apply zones.
 
-        for zone in root_zone:
-            if isinstance(root_zone[zone], dict):
-                fqdn = f"ns.{zone}."
-                glue_record += f"{zone}.\tIN\tNS\t{fqdn}\n"
-                glue_record += f"{fqdn}\tIN\tA\t{dns_server}\n\n"
+        The ``bind_reload`` key of a DNS server's ``dns_data`` selects how BIND
+        picks up the zones. With ``"incremental"`` (the default), the agent only
+        rewrites zone files whose contents changed and reloads them with
+        ``rndc``, restarting ``bind9`` only if ``named`` is not running. With
+        ``"restart"``, ``bind9`` is always restarted.
 
-        if glue_record:
-            if base_domain not in self.bind_zones:
-                self.bind_zones[base_domain] = {}
-            self.bind_zones[base_domain]["glue"] = glue_record
+        Secondary DNS servers are given the comma separated addresses of their
+        primaries in the ``masters`` option. Primaries are given the addresses
+        of their secondaries in the ``notify`` option, which the agent allows to
+        transfer its zones and notifies of changes, and the ``serial`` of their
+        zones (see :py:meth:`get_transfer_serial`).
 
-        if self.DEBUG:
-            if glue_record:
-                gr_file = open(os.path.join(self.zonedir, f"{'dot.'}{'glue'}"), "w", encoding="utf-8")
-                gr_file.write(glue_record)
-                gr_file.close()
+        Servers with a BIND profile (see :py:meth:`get_bind_profile`) are given
+        the base64 encoded ``named.conf.options`` in the ``named_options``
+        option, and the number of worker threads in the ``threads`` option.
 
-    def generate_records(self, zones, base_domain):
-        """Creates the records for a single machine in the topology
+        The ``ready_timeout`` key of a DNS server's ``dns_data`` sets the
+        ``ready`` option: how many seconds the agent waits for ``named`` to
+        answer the SOA query of a zone after applying the bundle (``0``
+        disables the check). Without it, the agent waits its default of 30
+        seconds and the bundle header is unchanged.
 
         Arguments:
-            zones (dict): Current subtree of the total zones dictionary
-            base_domain (str): The base name for the fully qualified domain name
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            dict: The options to place in the zone bundle header.
         """
-        found_node = False
-        record = ""
-        for zone in zones:
-            if not isinstance(zones[zone], list):
-                continue
-            found_node = True
-            for entry in zones[zone]:
-                if len(entry) == 3:
-                    # We have a special subdomain to add to the zone
-                    (subdomain, resource_type, resource_record) = entry
+        reload_mode = vertex.dns_data.get("bind_reload", "incremental")
+        if reload_mode not in RELOAD_MODES:
+            self.log.warning(
+                "Unknown bind_reload mode %s for %s, using incremental",
+                reload_mode,
+                vertex.name,
+            )
+            reload_mode = "incremental"
+        options = {"reload": reload_mode}
+        if self.transfers is not None:
+            primaries = self.transfers.primaries(vertex)
+            if primaries:
+                options["masters"] = ",".join(
+                    str(primary.dns_data.get("dns_address")) for primary in primaries
+                )
+            secondaries = self.transfers.secondary_addresses(vertex)
+            if secondaries:
+                options["notify"] = ",".join(secondaries)
+                options["serial"] = self.get_transfer_serial()
+        profile = self.get_bind_profile(vertex)
+        if profile is not None:
+            named_options = self.render_named_options(profile).encode("utf-8")
+            options["named_options"] = base64.b64encode(named_options).decode("ascii")
+            threads = profile.get("threads")
+            if threads:
+                try:
+                    count = int(threads)
+                except (TypeError, ValueError):
+                    count = 0
+                if count > 0:
+                    options["threads"] = count
                 else:
-                    # The subdomain to add to the zone is the zone origin
-                    (resource_type, resource_record) = entry
-                    subdomain = zone
-                record += f"{subdomain}\tIN\t{resource_type}\t{resource_record}\n"
+                    self.log.warning(
+                        "Invalid bind_profile threads %s for %s, ignoring it",
+                        threads,
+                        vertex.name,
+                    )
+        ready_timeout = vertex.dns_data.get("ready_timeout")
+        if ready_timeout is not None:
+            try:
+                timeout = int(ready_timeout)
+            except (TypeError, ValueError):
+                timeout = -1
+            if timeout >= 0:
+                options["ready"] = timeout
+            else:
+                self.log.warning(
+                    "Invalid ready_timeout %s for %s, ignoring it",
+                    ready_timeout,
+                    vertex.name,
+                )
+        return options
 
-        if not found_node:
-            return
+    def get_zone_depth(self, vertex):
+        """Get how far a DNS server's zone tree should be flattened.
 
-        # Save the record for later, when it will be concatenated with other
-        # records
-        if record:
-            if base_domain not in self.bind_zones:
-                self.bind_zones[base_domain] = {}
-            self.bind_zones[base_domain]["%RR%"] = record
+        The ``zone_depth`` key of a DNS server's ``dns_data`` may be
+        :py:data:`None` (the default) to create a zone for every domain,
+        ``"tld"`` for one zone per top-level domain, ``"domain"`` for one zone
+        per registrable domain, or the maximum number of labels in a zone name.
+        See :py:class:`ZoneRenderer`.
 
-        if self.DEBUG:
-            if not base_domain:
-                base_domain = "dot."
-            ar_file = open(os.path.join(self.zonedir, f"{base_domain}{'a'}"), "w", encoding="utf-8")
-            ar_file.write(record)
-            ar_file.close()
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            int: The maximum number of labels in a zone name, or :py:data:`None`.
+        """
+        zone_depth = vertex.dns_data.get("zone_depth")
+        if zone_depth is None:
+            return None
+        try:
+            # Lists and dictionaries can not be looked up or converted
+            zone_depth = int(ZONE_DEPTHS.get(zone_depth, zone_depth))
+        except (TypeError, ValueError):
+            zone_depth = 0
+        if zone_depth < 1:
+            self.log.warning(
+                "Invalid zone_depth %s for %s, creating a zone for every domain",
+                vertex.dns_data["zone_depth"],
+                vertex.name,
+            )
+            return None
+        return zone_depth
+
+    def get_payload_key(self, zones, dns_server, options=None, zone_depth=None):
+        """Compute the content digest which identifies a DNS server's payload.
 
-    def get_boilerplate(self, zone):
-        """Creates a boiler plate for the combined record files.
+        DNS servers whose zone data and address are identical render the same
+        zone files, so they can share a single payload. The digest of each
+        domain of the zone trees is remembered, because servers which track the
+        same hosts share the same tree objects (or subtrees).
 
         Arguments:
-            zone(str): The fully qualified domain name for this zone
+            zones(dns.dns_objects.ZoneTree): The zone tree containing
+                information on all zones in the topology.
+            dns_server(str): The IP address of the dns server in the topology
+            options(dict): The options placed in the zone bundle header.
+            zone_depth(int): The maximum number of labels in a zone name.
 
         Returns:
-            str: The boiler plate string that is created.
+            str: The digest of the payload's inputs.
         """
-        bp_str = ""
-        if not zone:
-            bp_str += "$ORIGIN .\n"
-        else:
-            bp_str += f"$ORIGIN {zone}\n"
-        bp_str += "$TTL 5m\n"
-        bp_str += f"@ IN SOA ns.{zone} noemail.noreply.org (\n"
-        bp_str += f"\t\t\t{CONFIG['boilerplate_serial']}\n"
-        bp_str += f"\t\t\t{CONFIG['boilerplate_refresh']}\n"
-        bp_str += f"\t\t\t{CONFIG['boilerplate_retry']}\n"
-        bp_str += f"\t\t\t{CONFIG['boilerplate_expire']}\n"
-        bp_str += f"\t\t\t{CONFIG['boilerplate_minimum']} )\n"
-
-        return bp_str
+        return PayloadCache.digest(
+            ZoneTree.coerce(zones).digest(self._zone_digests),
+            str(dns_server),
+            repr(sorted((options or {}).items())),
+            repr(zone_depth),
+        )
+
+    def generate_zone_files(self, zones, dns_server, zone_depth=None):
+        """Render the zone files for a single DNS server.
+
+        Arguments:
+            zones(dns.dns_objects.ZoneTree): The zone tree containing
+                information on all zones in the topology.
+            dns_server(str): The IP address of the dns server in the topology
+            zone_depth(int): The maximum number of labels in a zone name.
+
+        Returns:
+            dict: A mapping of zone names to the contents of their zone files.
+        """
+        return ZoneRenderer(zones, dns_server, zone_depth).render()
+
+    def render_payload(
+        self, zones, dns_server, options=None, zone_depth=None, counts=None
+    ):
+        """Render the configure_bind_agent.py payload for a single DNS server.
+
+        Arguments:
+            zones(dns.dns_objects.ZoneTree): The zone tree containing
+                information on all zones in the topology.
+            dns_server(str): The IP address of the dns server in the topology
+            options(dict): The options to place in the zone bundle header. Its
+                ``serial`` option, if any, is the SOA serial of the zones.
+            zone_depth(int): The maximum number of labels in a zone name.
+            counts(dict): If given, the number of zones and records which were
+                rendered are stored in it under ``"zones"`` and ``"records"``.
+
+        Returns:
+            str: The zone bundle containing every zone file.
+        """
+        buffer = io.StringIO()
+        renderer = ZoneRenderer(
+            zones, dns_server, zone_depth, (options or {}).get("serial")
+        )
+        renderer.write_bundle(buffer, options)
+        if counts is not None:
+            counts["zones"] = renderer.zones_written
+            counts["records"] = renderer.records_written
+        return buffer.getvalue()
+
+    def get_metadata(self, zone_files, options=None):
+        """Bundle the zone files so they can be distributed by the
+        metadata server.
+
+        See :py:class:`dns.dns_objects.ZoneBundleWriter` for the format.
+
+        Arguments:
+            zone_files (dict): All generated zone files for a DNS server.
+            options (dict): The options to place in the zone bundle header.
+
+        Returns:
+            str: The zone bundle containing every zone file.
+        """
+        buffer = io.StringIO()
+        with ZoneBundleWriter(buffer, options=options) as bundle:
+            for zone, text in zone_files.items():
+                bundle.add(zone, text)
+        return buffer.getvalue()
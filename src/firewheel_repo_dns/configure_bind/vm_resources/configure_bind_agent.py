@@ -1,8 +1,250 @@
 #!/usr/bin/env python
+import os
 import sys
+import time
+import zlib
+import random
+import socket
+import base64
 import pickle
+import struct
+import hashlib
 from subprocess import call
 
+BUNDLE_MAGIC = b"#FWDNS-ZONES"
+BUNDLE_VERSION = 1
+BUNDLE_END_MARKER = 0xFFFFFFFF
+COPY_CHUNK_SIZE = 65536
+NAMED_CONF = "/etc/bind/named.conf"
+NAMED_CONF_LOCAL = "/etc/bind/named.conf.local"
+NAMED_CONF_OPTIONS = "/etc/bind/named.conf.options"
+BIND_DEFAULTS = "/etc/default/bind9"
+# Above this many changed zones, a single ``rndc reload`` is cheaper than
+# reloading each zone individually.
+RELOAD_ALL_THRESHOLD = 64
+# Created once ``named`` answers for the bundled zones, so that the user's
+# vm_resources on the DNS server can wait for it (see the README).
+READY_FILE = "/var/run/firewheel_dns.ready"
+READY_POLL_INTERVAL = 0.5
+DNS_TYPE_SOA = 6
+DNS_CLASS_IN = 1
+
+
+def file_digest(path):
+    """
+    Hash the contents of a file.
+
+    Arguments:
+        path (str): The path to the file.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest of the file, or :py:data:`None` if
+        the file does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, "rb") as fhand:
+        for chunk in iter(lambda: fhand.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def soa_query(zone, query_id):
+    """
+    Build a DNS query for the SOA record of a zone.
+
+    Arguments:
+        zone (str): The name of the zone (empty for the root zone).
+        query_id (int): The ID of the query.
+
+    Returns:
+        bytes: The query message.
+    """
+    name = b""
+    for label in zone.strip(".").split("."):
+        if label:
+            label = label.encode("utf-8")
+            name += struct.pack(">B", len(label)) + label
+    header = struct.pack(">HHHHHH", query_id, 0, 1, 0, 0, 0)
+    return header + name + b"\0" + struct.pack(">HH", DNS_TYPE_SOA, DNS_CLASS_IN)
+
+
+def answers_soa(zone, address="127.0.0.1", port=53, timeout=1.0):
+    """
+    Check whether a DNS server answers the SOA query of a zone
+    authoritatively.
+
+    Arguments:
+        zone (str): The name of the zone (empty for the root zone).
+        address (str): The address of the DNS server.
+        port (int): The port of the DNS server.
+        timeout (float): How many seconds to wait for the response.
+
+    Returns:
+        bool: :py:data:`True` if the server answered with the zone's SOA record.
+    """
+    query_id = random.randint(0, 0xFFFF)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.sendto(soa_query(zone, query_id), (address, port))
+        response = sock.recv(512)
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+    if len(response) < 12:
+        return False
+    response_id, flags, _, answers = struct.unpack(">HHHH", response[:8])
+    # The response bit and authoritative answer bit are set, with no error
+    return (
+        response_id == query_id
+        and flags & 0x8000
+        and flags & 0x0400
+        and not flags & 0x000F
+        and answers > 0
+    )
+
+
+# pylint: disable=useless-object-inheritance
+class HashingWriter(object):
+    """
+    A binary file wrapper which hashes everything written to it.
+    """
+
+    def __init__(self, fhand):
+        """
+        Arguments:
+            fhand (file): The file to write, opened in binary mode.
+        """
+        self.fhand = fhand
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        """
+        Write data to the file.
+
+        Arguments:
+            data (bytes): The data to write.
+        """
+        self.digest.update(data)
+        self.fhand.write(data)
+
+
+def zone_digest(path):
+    """
+    Hash the contents of a zone file, except for the serial of its SOA record.
+
+    The serial is the line after the ``SOA`` line the plugin writes (see
+    ``ZoneRenderer.write_boilerplate``), so zones whose records did not
+    change have the same digest whatever their serial.
+
+    Arguments:
+        path (str): The path to the zone file.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest, or :py:data:`None` if the file
+        does not exist.
+    """
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    serial_next = False
+    serial_seen = False
+    with open(path, "rb") as fhand:
+        for line in fhand:
+            if serial_next:
+                serial_next = False
+                continue
+            if not serial_seen and b" SOA " in line and line.rstrip().endswith(b"("):
+                serial_next = serial_seen = True
+            digest.update(line)
+    return digest.hexdigest()
+
+
+def replace_if_changed(path, write, digest=None):
+    """
+    Atomically replace a file, but only if its contents would change.
+    The new contents are written to a temporary file in the same directory,
+    which is either renamed over the original file or removed.
+
+    Arguments:
+        path (str): The path to the file.
+        write (callable): Writes the new contents to the binary file object
+            it is passed.
+        digest (callable): Hashes the file at the path it is passed, to
+            decide whether the contents changed. Defaults to hashing the
+            whole contents.
+
+    Returns:
+        bool: :py:data:`True` if the file was created or changed.
+    """
+    tmp_path = "%s.fwtmp" % path
+    with open(tmp_path, "wb") as fhand:
+        writer = HashingWriter(fhand)
+        write(writer)
+    if digest is None:
+        changed = writer.digest.hexdigest() != file_digest(path)
+    else:
+        changed = digest(tmp_path) != digest(path)
+    if not changed:
+        os.remove(tmp_path)
+        return False
+    os.rename(tmp_path, path)
+    return True
+
+
+# pylint: disable=useless-object-inheritance
+class ZoneBundleReader(object):
+    """
+    Incrementally decode the body of a zone bundle created by the
+    ``dns.configure_bind`` plugin. Only one line of the bundle (and the data
+    decompressed from it) is held in memory at a time.
+    """
+
+    def __init__(self, stream):
+        """
+        Arguments:
+            stream (file): The bundle file, opened in binary mode and positioned
+                after the header line.
+        """
+        self.stream = stream
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b""
+
+    def read(self, size):
+        """
+        Read exactly ``size`` bytes of the decompressed bundle.
+
+        Arguments:
+            size (int): The number of bytes to read.
+
+        Returns:
+            bytes: The decompressed data.
+        """
+        while len(self.buffer) < size:
+            line = self.stream.readline()
+            if not line:
+                raise ValueError("The zone bundle is truncated")
+            self.buffer += self.decompressor.decompress(base64.b64decode(line.strip()))
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def copy(self, size, destination):
+        """
+        Copy ``size`` bytes of the decompressed bundle into a file.
+
+        Arguments:
+            size (int): The number of bytes to copy.
+            destination (file): The file to write, opened in binary mode.
+        """
+        while size > 0:
+            chunk = self.read(min(size, COPY_CHUNK_SIZE))
+            destination.write(chunk)
+            size -= len(chunk)
+
 
 # pylint: disable=useless-object-inheritance
 class ConfigureDNS(object):
@@ -11,6 +253,7 @@ class ConfigureDNS(object):
     """
 
     name = "configure_dns"
+    # The default number of seconds to wait for ``named`` to serve the zones
     sleep_time = 30
 
     def __init__(self, ascii_file=None, binary_file=None):
@@ -19,57 +262,359 @@ class ConfigureDNS(object):
 
         Arguments:
             ascii_file (str): The path to the configuration file, which should contain
-                a dictionary in pickle format. The dictionary should contain information
-                about the DNS zones.
+                a zone bundle (or, for older experiments, a dictionary in pickle
+                format) with the contents of the DNS zones.
             binary_file (str): This is not used, but kept for backwards compatibility.
         """
         self.ascii_file = ascii_file
+        self.options = {}
+        self.created_zones = set()
 
-    def run(self):
+    @staticmethod
+    def zone_file_location(zone):
         """
-        The primary method for setting up bind.
-        This method reads in the configuration, and places it in the bind configuration
-        file. Then, the ``bind9`` service is restarted.
+        Get the path of the file for a zone.
+
+        Arguments:
+            zone (str): The name of the zone (empty for the root zone).
+
+        Returns:
+            str: The path to the zone file.
+        """
+        if not zone:
+            return "/var/lib/bind/db.root"
+        return "/var/lib/bind/db.%s" % zone
+
+    def write_zone_file(self, zone, write):
         """
-        # Get the binary files to install BIND
-        with open(self.ascii_file, "r") as ascii_data:
-            zone_files = ascii_data.read()
+        Atomically write the file for a zone, if its contents changed.
 
-        # unpickle the dictionary
-        zone_files = pickle.loads(zone_files)
+        The zones of a primary carry a new ``serial`` on every run, so their
+        files are compared without the serial: a zone whose records did not
+        change keeps its file (and serial), and is neither reloaded nor
+        transferred to the secondaries again.
 
+        Arguments:
+            zone (str): The name of the zone.
+            write (callable): Writes the zone file to the binary file object
+                it is passed.
+
+        Returns:
+            bool: :py:data:`True` if the zone file was created or changed.
+        """
+        location = self.zone_file_location(zone)
+        if not os.path.exists(location):
+            self.created_zones.add(zone)
+        digest = zone_digest if self.options.get("serial") else None
+        return replace_if_changed(location, write, digest)
+
+    def extract_bundle(self, bundle_file, header):
+        """
+        Stream the zone files of a zone bundle into ``/var/lib/bind``.
+        Zone files whose contents are unchanged are left untouched.
+
+        Arguments:
+            bundle_file (file): The bundle file, positioned after the header line.
+            header (bytes): The header line of the bundle.
+
+        Returns:
+            tuple: The names of the zones, in the order they were bundled, and
+            the names of the zones whose files changed.
+        """
+        fields = header.split()
+        version = int(fields[1].lstrip(b"v"))
+        if version > BUNDLE_VERSION:
+            raise ValueError("Unsupported zone bundle version: %d" % version)
+        for option in fields[2:]:
+            key, value = option.decode("ascii").split("=", 1)
+            self.options[key] = value
+
+        reader = ZoneBundleReader(bundle_file)
+        zones = []
+        changed = []
+        while True:
+            (name_length,) = struct.unpack(">I", reader.read(4))
+            if name_length == BUNDLE_END_MARKER:
+                return zones, changed
+            zone = reader.read(name_length).decode("utf-8")
+            (text_length,) = struct.unpack(">Q", reader.read(8))
+            zones.append(zone)
+            if self.options.get("masters"):
+                # Secondaries receive their zone files by zone transfer
+                reader.read(text_length)
+            elif self.write_zone_file(
+                zone, lambda fhand, size=text_length: reader.copy(size, fhand)
+            ):
+                changed.append(zone)
+
+    def extract_pickle(self, pickle_file):
+        """
+        Write the zone files from a pickled dictionary into ``/var/lib/bind``.
+        This supports payloads created by older versions of the plugin.
+
+        Arguments:
+            pickle_file (file): The pickle file, opened in binary mode.
+
+        Returns:
+            tuple: The names of the zones and the names of the zones whose
+            files changed.
+        """
+        zone_files = pickle.loads(pickle_file.read())
+        changed = []
+        for zone in zone_files:
+            data = zone_files[zone].encode("utf-8")
+            if self.write_zone_file(zone, lambda fhand, data=data: fhand.write(data)):
+                changed.append(zone)
+        return list(zone_files), changed
+
+    @staticmethod
+    def address_list(addresses):
+        """
+        Format a comma separated list of addresses as a BIND address list.
+
+        Arguments:
+            addresses (str): The comma separated addresses.
+
+        Returns:
+            str: The address list, e.g. ``{ 10.0.0.1; 10.0.0.2; }``.
+        """
+        return "{ %s }" % " ".join("%s;" % address for address in addresses.split(","))
+
+    def zone_options(self, zone):
+        """
+        Get the statements of the ``named.conf.local`` block of a zone.
+
+        Secondaries (with the ``masters`` option) serve the zone as
+        ``type slave`` of their primaries. Primaries with secondaries (with the
+        ``notify`` option) allow them to transfer the zone, notify them when it
+        changes and keep the differences between versions for incremental
+        zone transfers.
+
+        Arguments:
+            zone (str): The name of the zone (empty for the root zone).
+
+        Returns:
+            str: The statements, one per line.
+        """
+        statements = ['file "%s"' % self.zone_file_location(zone)]
+        masters = self.options.get("masters")
+        notify = self.options.get("notify")
+        if masters:
+            statements.insert(0, "type slave")
+            statements.append("masters %s" % self.address_list(masters))
+        else:
+            statements.insert(0, "type master")
+            if notify:
+                statements.append("allow-transfer %s" % self.address_list(notify))
+                statements.append("also-notify %s" % self.address_list(notify))
+                statements.append("ixfr-from-differences yes")
+        return "".join("\t%s;\n" % statement for statement in statements)
+
+    def write_config(self, zones):
+        """
+        Write ``named.conf`` and ``named.conf.local`` so that bind serves
+        exactly the given zones.
+
+        Arguments:
+            zones (list): The names of the zones.
+
+        Returns:
+            bool: :py:data:`True` if either configuration file changed.
+        """
         # Do not include default zones in bind's config
-        with open("/etc/bind/named.conf", "w") as named_conf:
-            named_conf.write('include "/etc/bind/named.conf.options";\n')
-            named_conf.write('include "/etc/bind/named.conf.local";\n')
-
-        with open("/etc/bind/named.conf.local", "w") as local_conf:
-
-            for zone in zone_files:
-                # place this zone file in the right location
-                if not zone:
-                    zone_file_location = "/var/lib/bind/db.root"
-                else:
-                    zone_file_location = "/var/lib/bind/db.%s" % zone
-                with open(zone_file_location, "w") as zone_file:
-                    zone_file.write(zone_files[zone])
-
-                # add this zone as a block in
-                # named.conf.local
-                if not zone:
-                    conf = 'zone "."{\n\ttype master;\n\tfile "%s";\n};\n' % (
-                        zone_file_location
-                    )
-                else:
-                    conf = 'zone "%s"{\n\ttype master;\n\tfile "%s";\n};\n' % (
-                        zone,
-                        zone_file_location,
-                    )
-                local_conf.write(conf)
+        named_conf = (
+            'include "/etc/bind/named.conf.options";\n'
+            'include "/etc/bind/named.conf.local";\n'
+        )
+
+        local_conf = []
+        for zone in zones:
+            # add this zone as a block in
+            # named.conf.local
+            local_conf.append(
+                'zone "%s"{\n%s};\n' % (zone or ".", self.zone_options(zone))
+            )
+
+        changed = False
+        for path, contents in (
+            (NAMED_CONF, named_conf),
+            (NAMED_CONF_LOCAL, "".join(local_conf)),
+        ):
+            data = contents.encode("utf-8")
+            if replace_if_changed(path, lambda fhand, data=data: fhand.write(data)):
+                changed = True
+        return changed
+
+    def write_options(self):
+        """
+        Write ``named.conf.options`` if the bundle carries a BIND profile (in
+        its base64 encoded ``named_options`` option).
+
+        Returns:
+            bool: :py:data:`True` if the file changed.
+        """
+        named_options = self.options.get("named_options")
+        if not named_options:
+            return False
+        data = base64.b64decode(named_options)
+        return replace_if_changed(
+            NAMED_CONF_OPTIONS, lambda fhand, data=data: fhand.write(data)
+        )
+
+    def write_thread_count(self):
+        """
+        Set the number of worker threads (the ``-n`` option of ``named``) in
+        the ``OPTIONS`` of ``/etc/default/bind9`` if the bundle carries a
+        ``threads`` option.
+
+        Returns:
+            bool: :py:data:`True` if the file changed, in which case ``bind9``
+            must be restarted.
+        """
+        try:
+            threads = int(self.options.get("threads") or 0)
+        except ValueError:
+            print("ERROR: invalid threads option %s" % self.options["threads"])
+            return False
+        if threads < 1:
+            return False
+        lines = []
+        if os.path.exists(BIND_DEFAULTS):
+            with open(BIND_DEFAULTS, "r") as fhand:
+                lines = fhand.readlines()
+
+        def with_threads(arguments):
+            kept = []
+            skip = False
+            for argument in arguments:
+                if skip:
+                    skip = False
+                elif argument == "-n":
+                    skip = True
+                elif not argument.startswith("-n"):
+                    kept.append(argument)
+            return 'OPTIONS="%s"\n' % " ".join(kept + ["-n", str(threads)])
+
+        found = False
+        for position, line in enumerate(lines):
+            if line.startswith("OPTIONS="):
+                arguments = line.split("=", 1)[1].strip().strip("\"'").split()
+                lines[position] = with_threads(arguments)
+                found = True
+        if not found:
+            lines.append(with_threads(["-u", "bind"]))
+        data = "".join(lines).encode("utf-8")
+        return replace_if_changed(
+            BIND_DEFAULTS, lambda fhand, data=data: fhand.write(data)
+        )
+
+    @staticmethod
+    def named_running():
+        """
+        Check whether ``named`` is running and accepting ``rndc`` commands.
+
+        Returns:
+            bool: :py:data:`True` if ``rndc status`` succeeds.
+        """
+        try:
+            with open(os.devnull, "w") as devnull:
+                return call(["rndc", "status"], stdout=devnull, stderr=devnull) == 0
+        except OSError:
+            return False
+
+    def reload(self, changed_zones, config_changed, restart=False):
+        """
+        Make bind serve the new configuration. If possible, only the changed
+        zones are reloaded, otherwise the ``bind9`` service is restarted.
+
+        Arguments:
+            changed_zones (list): The names of the zones whose files changed.
+            config_changed (bool): Whether the set of zones (or the options) changed.
+            restart (bool): Whether ``bind9`` must be restarted, because the
+                arguments of ``named`` changed.
+        """
+        incremental = self.options.get("reload", "incremental") == "incremental"
+        if incremental and not restart and self.named_running():
+            commands = []
+            if config_changed:
+                # This also loads any new zones
+                commands.append(["rndc", "reconfig"])
+                changed_zones = [
+                    zone for zone in changed_zones if zone not in self.created_zones
+                ]
+            if len(changed_zones) > RELOAD_ALL_THRESHOLD:
+                commands.append(["rndc", "reload"])
+            else:
+                for zone in changed_zones:
+                    commands.append(["rndc", "reload", zone or "."])
+            if all(call(command) == 0 for command in commands):
+                return
+            print("ERROR: unable to reload zones, restarting bind9")
 
         # There is no passed in data, so this is safe
         call("service bind9 restart", shell=True)  # noqa: DUO116
 
+    def wait_until_ready(self, zones):
+        """
+        Wait for ``named`` to answer the SOA query of the first zone, then
+        create :py:data:`READY_FILE` (which :py:meth:`run` removed first). The ``ready`` option sets how many
+        seconds to wait (``0`` skips the check), which defaults to
+        :py:attr:`sleep_time`.
+
+        Arguments:
+            zones (list): The names of the zones, in the order they were bundled.
+
+        Returns:
+            bool: :py:data:`True` if ``named`` answered in time.
+        """
+        try:
+            timeout = int(self.options.get("ready", self.sleep_time))
+        except ValueError:
+            print("ERROR: invalid ready option %s" % self.options["ready"])
+            timeout = self.sleep_time
+        if timeout and zones:
+            deadline = time.time() + timeout
+            while not answers_soa(zones[0]):
+                if time.time() >= deadline:
+                    print(
+                        "ERROR: named did not answer for %s within %d seconds"
+                        % (zones[0] or ".", timeout)
+                    )
+                    return False
+                time.sleep(READY_POLL_INTERVAL)
+        with open(READY_FILE, "w") as fhand:
+            fhand.write("%d\n" % int(time.time()))
+        print("named is serving %d zones" % len(zones))
+        return True
+
+    def run(self):
+        """
+        The primary method for setting up bind.
+        This method reads in the configuration, and places it in the bind configuration
+        file. Then, bind is told to load the changes, either by reloading the changed
+        zones or by restarting the ``bind9`` service, and the agent waits until
+        ``named`` serves them.
+        """
+        # Nothing may wait on the previous zones while the new ones are applied
+        if os.path.exists(READY_FILE):
+            os.remove(READY_FILE)
+
+        # Place each zone file in the right location
+        with open(self.ascii_file, "rb") as ascii_data:
+            header = ascii_data.readline()
+            if header.startswith(BUNDLE_MAGIC):
+                zones, changed_zones = self.extract_bundle(ascii_data, header)
+            else:
+                ascii_data.seek(0)
+                zones, changed_zones = self.extract_pickle(ascii_data)
+
+        config_changed = self.write_config(zones)
+        if self.write_options():
+            config_changed = True
+        restart = self.write_thread_count()
+        self.reload(changed_zones, config_changed, restart)
+        self.wait_until_ready(zones)
+
 
 if __name__ == "__main__":
     configure = ConfigureDNS(sys.argv[1])
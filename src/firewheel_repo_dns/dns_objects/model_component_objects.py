@@ -1,7 +1,41 @@
+import os
+import sys
+import json
+import time
+import zlib
+import base64
+import pickle
+import struct
+import hashlib
+import tempfile
+import contextlib
+from collections import namedtuple
+
+from base_objects import Switch, VMEndpoint
 from linux.ubuntu1604 import Ubuntu1604Server
+from linux.base_objects import LinuxHost
 
 from firewheel.control.experiment_graph import require_class
 
+ZONE_BUNDLE_MAGIC = "#FWDNS-ZONES"
+ZONE_BUNDLE_VERSION = 1
+REPORT_DIRECTORY = "dns_reports"
+# The SOA values written into every zone file by dns.configure_bind
+ZONE_CONFIG = {
+    "dns_name": "DNS",
+    "boilerplate_serial": "2014080800",
+    "boilerplate_refresh": "3h",
+    "boilerplate_retry": "15M",
+    "boilerplate_expire": "3W12h",
+    "boilerplate_minimum": "2h20M",
+}
+# Change whenever the rendered zone files change, to invalidate ZoneCache entries
+ZONE_CACHE_VERSION = 1
+ZONE_CACHE_MAX_BYTES = 1 << 30
+ZONE_CACHE_MAX_ENTRIES = 512
+# The default schedule times of the vm_resources of each DNSServer
+DNS_START_TIMES = {"install_bind": -20, "configure_bind": -2}
+
 
 @require_class(Ubuntu1604Server)
 class DNSServer:
@@ -9,24 +43,1465 @@ class DNSServer:
     in the experiment graph.
     """
 
-    def __init__(self, dns_ip):
+    def __init__(self, dns_ip, start_times=None):
         """
         Create the ``dns_data`` dictionary attribute which initializes
         many DNS parameters.
 
+        The ``start_times`` key of ``dns_data`` holds the schedule time of
+        each of the server's vm_resources (see :py:data:`DNS_START_TIMES`).
+        BIND is installed as soon as the server is created, so its
+        ``install_bind`` time can only be changed with the ``start_times``
+        argument, whereas ``configure_bind`` may be changed until the
+        ``dns.configure_bind`` plugin runs.
+
         Arguments:
             dns_ip (str): The IP Address of the DNS server.
+            start_times (dict): Schedule times which replace the defaults.
         """
         self.dns_data = {}
         self.dns_data["server"] = True
         self.dns_data["hosts_tracked"] = "*"
         self.dns_data["dns_address"] = dns_ip
+        self.dns_data["reverse_prefix"] = 24
+        self.dns_data["zone_depth"] = None
+        self.dns_data["bind_reload"] = "incremental"
+        self.dns_data["zone_cache"] = None
+        self.dns_data["primaries"] = None
+        self.dns_data["bind_profile"] = None
+        self.dns_data["publish_addresses"] = None
+        self.dns_data["services"] = None
+        self.dns_data["start_times"] = dict(DNS_START_TIMES, **(start_times or {}))
+        self.dns_data["ready_timeout"] = None
         self.install_bind()
 
-    def install_bind(self, start_time=-20):
+    def get_start_time(self, vm_resource):
+        """Get the schedule time of one of the server's vm_resources.
+
+        Arguments:
+            vm_resource (str): A key of :py:data:`DNS_START_TIMES`.
+
+        Returns:
+            int: The time from ``dns_data["start_times"]``, or the default
+            time if it is missing or not an integer.
+        """
+        start_times = self.dns_data.get("start_times") or {}
+        try:
+            return int(start_times.get(vm_resource, DNS_START_TIMES[vm_resource]))
+        except (TypeError, ValueError):
+            return DNS_START_TIMES[vm_resource]
+
+    def install_bind(self, start_time=None):
         """Installs the bind9 debian packages.
 
         Arguments:
-            start_time (int): The time at which to install bind. Defaults to -20.
+            start_time (int): The time at which to install bind. Defaults to
+                the ``install_bind`` time of ``dns_data["start_times"]``.
         """
+        if start_time is None:
+            start_time = self.get_start_time("install_bind")
+        self.dns_data.setdefault("start_times", {})["install_bind"] = start_time
         self.install_debs(start_time, "bind9_xenial_debs.tgz")
+
+
+class HostEntry:
+    """A single experiment host which should be resolvable via DNS.
+
+    Attributes:
+        name (str): The fully qualified name of the host (i.e. the vertex name).
+        labels (tuple): The labels of ``name`` ordered from the top-level domain
+            down to the host label (e.g. ``("com", "acme", "host")``).
+        address (str): The primary experiment address of the host, which is
+            published by default.
+        addresses (tuple): Every experiment address of the host, starting with
+            ``address``.
+    """
+
+    __slots__ = ("address", "addresses", "labels", "name")
+
+    def __init__(self, name, address, addresses=None):
+        """
+        Arguments:
+            name (str): The fully qualified name of the host.
+            address (str): The primary experiment address of the host.
+            addresses (iterable): Every experiment address of the host.
+                Defaults to just ``address``.
+        """
+        self.name = name
+        self.labels = tuple(map(sys.intern, reversed(name.split("."))))
+        self.address = address
+        self.addresses = (address,)
+        if addresses:
+            self.addresses += tuple(a for a in dict.fromkeys(addresses) if a != address)
+
+    def __repr__(self):
+        return f"HostEntry({self.name!r}, {self.address!r})"
+
+
+class HostIndex:
+    """An index of every experiment host which needs DNS records.
+
+    The index is built with a single pass over the experiment graph so that
+    plugins which need per-server views of the hosts (e.g. one zone tree per
+    :py:class:`DNSServer`) can filter the index rather than rescanning the graph.
+    Hosts are kept in graph iteration order and are identified by their
+    position in :py:attr:`hosts`.
+
+    Attributes:
+        hosts (list): The :py:class:`HostEntry` objects, in graph order.
+        by_name (dict): Maps a host name to its position in :py:attr:`hosts`.
+        servers (list): The graph vertices decorated by :py:class:`DNSServer`.
+        vertices_scanned (int): The number of graph vertices visited while
+            building the index.
+    """
+
+    def __init__(self, hosts=None):
+        """
+        Arguments:
+            hosts (list): An optional iterable of :py:class:`HostEntry` objects
+                used to seed the index.
+        """
+        self.hosts = []
+        self.by_name = {}
+        self.servers = []
+        self.vertices_scanned = 0
+        for host in hosts or []:
+            self.add(host)
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def __iter__(self):
+        return iter(self.hosts)
+
+    def digest(self):
+        """Compute a digest of the name and addresses of every host, in order.
+
+        Returns:
+            str: The hexadecimal SHA-256 digest of the index.
+        """
+        return PayloadCache.digest(
+            "".join("\0".join((host.name, *host.addresses)) + "\n" for host in self)
+        )
+
+    def add(self, host):
+        """Add a host to the index.
+
+        Arguments:
+            host (HostEntry): The host to add.
+
+        Returns:
+            int: The position of the host within the index.
+        """
+        host_id = len(self.hosts)
+        self.hosts.append(host)
+        self.by_name.setdefault(host.name, host_id)
+        return host_id
+
+    @classmethod
+    def from_graph(cls, graph, log=None):
+        """Build the index with a single walk of the experiment graph.
+
+        Every vertex which is not a :py:class:`base_objects.Switch` and has an
+        interface connected to a switch is indexed (see :py:meth:`add_vertex`).
+        Vertices which are not connected to the experiment network
+        are ignored.
+
+        Arguments:
+            graph (firewheel.control.experiment_graph.ExperimentGraph): The
+                experiment graph.
+            log (logging.Logger): An optional logger used to report vertices
+                which could not be indexed.
+
+        Returns:
+            HostIndex: The populated index.
+        """
+        index = cls()
+        for vertex in graph.get_vertices():
+            index.vertices_scanned += 1
+            if vertex.is_decorated_by(Switch):
+                continue
+            if vertex.is_decorated_by(DNSServer):
+                index.servers.append(vertex)
+            index.add_vertex(vertex, log)
+        return index
+
+    def add_vertex(self, vertex, log=None):
+        """Index a vertex if it has an interface connected to a switch.
+
+        The address of the first such interface is the host's primary address,
+        and the addresses of the others are kept in its
+        :py:attr:`HostEntry.addresses`. Vertices which are not connected to the
+        experiment network are ignored.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The vertex, which
+                should not be a :py:class:`base_objects.Switch`.
+            log (logging.Logger): An optional logger used to report vertices
+                which could not be indexed.
+
+        Returns:
+            int: The position of the host in :py:attr:`hosts`, or :py:data:`None`
+            if the vertex was not indexed.
+        """
+        try:
+            interfaces = vertex.interfaces.interfaces
+        except AttributeError:
+            if log:
+                log.warning(
+                    "Vertex with name=%s did not have an interface, ignoring",
+                    vertex.name,
+                )
+            return None
+
+        if not interfaces:
+            return None
+
+        addresses = [
+            str(iface["address"])
+            for iface in interfaces
+            if "switch" in iface and iface.get("address")
+        ]
+        if not addresses:
+            # This VM is not part of the experiment, but that's okay
+            return None
+
+        return self.add(HostEntry(vertex.name, addresses[0], addresses))
+
+
+class DNSContext:
+    """The vertices of an experiment graph which the DNS plugins work with.
+
+    The context is built with a single walk of the graph, which checks the
+    decorations of each vertex once, and is attached to the graph so that the
+    DNS plugins which run after the first one reuse it (see :py:meth:`get`).
+
+    Attributes:
+        index (HostIndex): The hosts which need DNS records. Its ``servers``
+            are the vertices decorated by :py:class:`DNSServer`.
+        switches (list): The :py:class:`base_objects.Switch` vertices.
+        endpoints (list): A tuple of the vertex, whether it is a
+            :py:class:`DNSServer` and whether it is a
+            :py:class:`linux.base_objects.LinuxHost`, for each
+            :py:class:`base_objects.VMEndpoint`.
+        linux_hosts (list): The :py:class:`linux.base_objects.LinuxHost` vertices.
+        fingerprint (tuple): Identifies the vertices of the graph the context
+            was built from, with their names, decorations and interfaces.
+        reused (bool): Whether the last call to :py:meth:`get` reused the
+            context rather than building it.
+    """
+
+    GRAPH_ATTRIBUTE = "dns_context"
+    # The decorations which decide where a vertex is listed
+    DECORATIONS = (Switch, DNSServer, LinuxHost, VMEndpoint)
+
+    def __init__(self, vertices, log=None):
+        """
+        Arguments:
+            vertices (list): Every vertex of the experiment graph.
+            log (logging.Logger): An optional logger used to report vertices
+                which could not be indexed.
+        """
+        self.index = HostIndex()
+        self.switches = []
+        self.endpoints = []
+        self.linux_hosts = []
+        self.fingerprint = self.get_fingerprint(vertices)
+        self.reused = False
+        for vertex in vertices:
+            self.index.vertices_scanned += 1
+            if vertex.is_decorated_by(Switch):
+                self.switches.append(vertex)
+                continue
+            is_server = vertex.is_decorated_by(DNSServer)
+            if is_server:
+                self.index.servers.append(vertex)
+            is_linux = vertex.is_decorated_by(LinuxHost)
+            if is_linux:
+                self.linux_hosts.append(vertex)
+            if vertex.is_decorated_by(VMEndpoint):
+                self.endpoints.append((vertex, is_server, is_linux))
+            self.index.add_vertex(vertex, log)
+
+    @property
+    def servers(self):
+        """list: The vertices decorated by :py:class:`DNSServer`, in graph order."""
+        return self.index.servers
+
+    @property
+    def vertices_scanned(self):
+        """int: The number of vertices visited while building the context."""
+        return self.index.vertices_scanned
+
+    @classmethod
+    def describe(cls, vertex):
+        """Describe everything about a vertex which the context depends on.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The vertex.
+
+        Returns:
+            tuple: The vertex's identity, name, decorations, and the switch
+            and address of each of its interfaces.
+        """
+        try:
+            interfaces = vertex.interfaces.interfaces or ()
+        except AttributeError:
+            interfaces = ()
+        return (
+            id(vertex),
+            vertex.name,
+            tuple(vertex.is_decorated_by(decoration) for decoration in cls.DECORATIONS),
+            tuple(
+                (id(iface.get("switch")), str(iface.get("address")))
+                for iface in interfaces
+            ),
+        )
+
+    @classmethod
+    def get_fingerprint(cls, vertices):
+        """Identify the vertices of an experiment graph, in order.
+
+        The ``dns_data`` of the DNS servers is not part of the fingerprint,
+        since the plugins read it from the vertices rather than the context.
+
+        Arguments:
+            vertices (list): Every vertex of the experiment graph.
+
+        Returns:
+            tuple: The number of vertices and a hash of their descriptions
+            (see :py:meth:`describe`).
+        """
+        return len(vertices), hash(tuple(map(cls.describe, vertices)))
+
+    @classmethod
+    def get(cls, graph, log=None):
+        """Get the context of an experiment graph, building it if needed.
+
+        The context is rebuilt if vertices were added to or removed from the
+        graph since it was built, or if the name, decorations or interfaces
+        of any vertex changed, so plugins which run in between do not need
+        to call :py:meth:`invalidate`.
+
+        Arguments:
+            graph (firewheel.control.experiment_graph.ExperimentGraph): The
+                experiment graph.
+            log (logging.Logger): An optional logger used to report vertices
+                which could not be indexed.
+
+        Returns:
+            DNSContext: The context.
+        """
+        vertices = graph.get_vertices()
+        context = getattr(graph, cls.GRAPH_ATTRIBUTE, None)
+        if context is not None and context.fingerprint == cls.get_fingerprint(vertices):
+            context.reused = True
+            return context
+        context = cls(vertices, log)
+        setattr(graph, cls.GRAPH_ATTRIBUTE, context)
+        return context
+
+    @classmethod
+    def invalidate(cls, graph):
+        """Discard the context attached to an experiment graph, if any.
+
+        Arguments:
+            graph (firewheel.control.experiment_graph.ExperimentGraph): The
+                experiment graph.
+        """
+        if getattr(graph, cls.GRAPH_ATTRIBUTE, None) is not None:
+            setattr(graph, cls.GRAPH_ATTRIBUTE, None)
+
+
+class ZoneTransfers:
+    """The primary/secondary relationships between DNS servers.
+
+    A DNS server is a secondary when the ``primaries`` key of its ``dns_data``
+    lists other DNS servers, by vertex name or ``dns_address``. Secondaries
+    are configured as ``type slave`` for every zone of their first primary,
+    and receive the zones through zone transfers rather than in their own
+    zone bundle. Entries which do not name another DNS server, or which name
+    a secondary, are ignored with a warning.
+    """
+
+    def __init__(self, servers, log=None):
+        """
+        Arguments:
+            servers (list): The graph vertices decorated by :py:class:`DNSServer`.
+            log (logging.Logger): Where to warn about invalid ``primaries``.
+        """
+        self._primaries = {}
+        self._secondaries = {}
+        by_key = {}
+        requested = []
+        for vertex in servers:
+            by_key.setdefault(vertex.name, vertex)
+            by_key.setdefault(str(vertex.dns_data.get("dns_address")), vertex)
+            entries = vertex.dns_data.get("primaries")
+            if isinstance(entries, str):
+                entries = [entries]
+            if entries:
+                requested.append((vertex, entries))
+
+        candidates = {id(vertex) for vertex, _ in requested}
+        for vertex, entries in requested:
+            primaries = []
+            for entry in entries:
+                primary = by_key.get(str(entry))
+                if primary is None or id(primary) in candidates:
+                    if log:
+                        log.warning(
+                            "Ignoring primary %s of %s, which is not a primary DNS server",
+                            entry,
+                            vertex.name,
+                        )
+                elif primary not in primaries:
+                    primaries.append(primary)
+            if primaries:
+                self._primaries[id(vertex)] = primaries
+                for primary in primaries:
+                    self._secondaries.setdefault(id(primary), []).append(vertex)
+            elif log:
+                log.warning(
+                    "%s has no primaries, so it serves its own zones", vertex.name
+                )
+
+    def is_secondary(self, vertex):
+        """Check whether a DNS server is a secondary.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            bool: :py:data:`True` if the server receives its zones by zone transfer.
+        """
+        return id(vertex) in self._primaries
+
+    def primaries(self, vertex):
+        """Get the primaries of a DNS server.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            list: The primary DNS server vertices, which is empty unless the
+            server is a secondary.
+        """
+        return self._primaries.get(id(vertex), [])
+
+    def secondaries(self, vertex):
+        """Get the secondaries of a DNS server.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            list: The secondary DNS server vertices which transfer zones from it.
+        """
+        return self._secondaries.get(id(vertex), [])
+
+    def secondary_addresses(self, vertex):
+        """Get the addresses of the secondaries of a DNS server.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            list: The sorted, distinct ``dns_address`` of each secondary.
+        """
+        return sorted(
+            {str(v.dns_data.get("dns_address")) for v in self.secondaries(vertex)}
+        )
+
+
+class PayloadCache:
+    """A content-addressed cache of vm_resource payloads.
+
+    Payloads are stored under a digest of the inputs used to create them, so
+    vertices which need the same content share a single payload object instead
+    of each rendering (and holding) their own copy.
+
+    Attributes:
+        hits (int): The number of lookups which reused a cached payload.
+        misses (int): The number of lookups which created a new payload.
+    """
+
+    def __init__(self):
+        """Create an empty cache."""
+        self._payloads = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._payloads)
+
+    @staticmethod
+    def digest(*parts):
+        """Compute a stable digest of the given content.
+
+        Arguments:
+            *parts (str or bytes): The content to hash, in order.
+
+        Returns:
+            str: The hexadecimal SHA-256 digest of the content.
+        """
+        hasher = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            hasher.update(len(part).to_bytes(8, "big"))
+            hasher.update(part)
+        return hasher.hexdigest()
+
+    def get(self, key, factory):
+        """Get the payload stored under ``key``, creating it if needed.
+
+        Arguments:
+            key (str): The digest of the inputs to ``factory``.
+            factory (callable): Creates the payload when it is not cached.
+
+        Returns:
+            object: The cached payload.
+        """
+        try:
+            payload = self._payloads[key]
+        except KeyError:
+            self.misses += 1
+            payload = self._payloads[key] = factory()
+        else:
+            self.hits += 1
+        return payload
+
+    def intern(self, payload):
+        """Get the cached copy of a payload with the same content.
+
+        Arguments:
+            payload (str or bytes): The payload.
+
+        Returns:
+            str or bytes: The first payload with identical content.
+        """
+        return self.get(self.digest(payload), lambda: payload)
+
+
+class ZoneCache:
+    """A directory of rendered zone bundles which is kept between experiments.
+
+    Relaunching an experiment whose hosts and DNS settings have not changed
+    produces the same zone bundle for each DNS server, so bundles are stored
+    under a fingerprint of everything they were rendered from (see
+    ``dns.populate_zones``) and reused when the fingerprint matches. Each
+    bundle is a ``<fingerprint>.bundle`` file, whose modification time is
+    updated whenever it is used. Once the cache holds more than ``max_bytes``
+    or ``max_entries`` bundles, the least recently used bundles are removed.
+
+    Several experiments may share a cache directory: bundles are written to a
+    temporary file which is renamed into place, and bundles which disappear
+    while the cache is read are treated as missing.
+    """
+
+    SUFFIX = ".bundle"
+
+    def __init__(
+        self,
+        directory,
+        max_bytes=ZONE_CACHE_MAX_BYTES,
+        max_entries=ZONE_CACHE_MAX_ENTRIES,
+    ):
+        """
+        Arguments:
+            directory (str): The cache directory. It is created when the first
+                bundle is stored.
+            max_bytes (int): The maximum total size of the cached bundles.
+            max_entries (int): The maximum number of cached bundles.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+    def path(self, key):
+        """Get the path of the bundle stored under a fingerprint.
+
+        Arguments:
+            key (str): The fingerprint.
+
+        Returns:
+            str: The path of the bundle.
+        """
+        return os.path.join(self.directory, f"{key}{self.SUFFIX}")
+
+    def get(self, key):
+        """Get the bundle stored under a fingerprint, marking it as used.
+
+        Arguments:
+            key (str): The fingerprint.
+
+        Returns:
+            str: The zone bundle, or :py:data:`None` if it is not cached.
+        """
+        path = self.path(key)
+        try:
+            with open(path, encoding="ascii") as bundle_file:
+                bundle = bundle_file.read()
+            os.utime(path)
+        except (OSError, UnicodeDecodeError):
+            return None
+        return bundle if is_zone_bundle(bundle) else None
+
+    def put(self, key, bundle):
+        """Store a bundle under a fingerprint, then evict old bundles if needed.
+
+        Arguments:
+            key (str): The fingerprint.
+            bundle (str): The zone bundle.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", dir=self.directory)
+        try:
+            with os.fdopen(fd, "w", encoding="ascii") as bundle_file:
+                bundle_file.write(bundle)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used bundles until the cache is within its limits.
+
+        Returns:
+            int: The number of bundles which were removed.
+        """
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if not entry.name.endswith(self.SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort(reverse=True)
+        total = 0
+        removed = 0
+        for position, (_, size, path) in enumerate(entries):
+            total += size
+            # Always keep the most recently used bundle
+            if position and (total > self.max_bytes or position >= self.max_entries):
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+                    removed += 1
+        return removed
+
+
+class ZoneBundleWriter:
+    """Write zone files into a compact, versioned zone bundle.
+
+    A zone bundle is an ASCII document, so that it can be passed to a VM as a
+    vm_resource argument. The first line holds :py:data:`ZONE_BUNDLE_MAGIC`
+    and the format version (e.g. ``#FWDNS-ZONES v1``). The remaining lines are
+    the base64 encoding of a zlib compressed stream of entries, where each
+    entry is a zone name and the text of its zone file, both UTF-8 encoded and
+    prefixed by their length (a big-endian 32-bit and 64-bit unsigned integer,
+    respectively). A zone name length of ``0xFFFFFFFF`` marks the end of the
+    bundle. Each base64 line can be decoded independently, which allows the
+    bundle to be extracted one line at a time.
+
+    The header line may also carry ``key=value`` options which tell
+    ``configure_bind_agent.py`` how to apply the zones (e.g. ``reload=restart``).
+    """
+
+    LINE_BYTES = 57
+    END_MARKER = 0xFFFFFFFF
+
+    def __init__(self, stream, level=6, options=None):
+        """
+        Arguments:
+            stream (io.TextIOBase): The writable text stream for the bundle.
+            level (int): The zlib compression level.
+            options (dict): Options for the agent to write into the header line.
+        """
+        self.stream = stream
+        self.entries = 0
+        self.size = 0
+        self._compressor = zlib.compressobj(level)
+        self._pending = b""
+        header = [ZONE_BUNDLE_MAGIC, f"v{ZONE_BUNDLE_VERSION}"]
+        header.extend(
+            f"{key}={value}" for key, value in sorted((options or {}).items())
+        )
+        self.stream.write(" ".join(header) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data):
+        """Compress data and write every complete base64 line.
+
+        Arguments:
+            data (bytes): The uncompressed data.
+        """
+        self.size += len(data)
+        self._emit(self._compressor.compress(data))
+
+    def _emit(self, compressed, final=False):
+        """Write compressed data to the stream as base64 lines.
+
+        Arguments:
+            compressed (bytes): The compressed data.
+            final (bool): Whether to write any incomplete trailing line.
+        """
+        pending = self._pending + compressed
+        usable = (
+            len(pending) if final else len(pending) - len(pending) % self.LINE_BYTES
+        )
+        for start in range(0, usable, self.LINE_BYTES):
+            chunk = pending[start : start + self.LINE_BYTES]
+            self.stream.write(base64.b64encode(chunk).decode("ascii"))
+            self.stream.write("\n")
+        self._pending = pending[usable:]
+
+    def add(self, zone, text):
+        """Add a zone file to the bundle.
+
+        Arguments:
+            zone (str): The name of the zone (``""`` for the root zone).
+            text (str): The contents of the zone file.
+        """
+        name = zone.encode("utf-8")
+        data = text.encode("utf-8")
+        self._write(struct.pack(">I", len(name)) + name + struct.pack(">Q", len(data)))
+        self._write(data)
+        self.entries += 1
+
+    def close(self):
+        """Terminate the bundle and flush all remaining data to the stream."""
+        self._write(struct.pack(">I", self.END_MARKER))
+        self._emit(self._compressor.flush(), final=True)
+
+
+def is_zone_bundle(payload):
+    """Check whether a payload is a zone bundle.
+
+    Arguments:
+        payload (str): The payload (or the beginning of it).
+
+    Returns:
+        bool: :py:data:`True` if the payload is a zone bundle rather than a
+        pickled dictionary of zone files.
+    """
+    return payload.startswith(ZONE_BUNDLE_MAGIC)
+
+
+def parse_zone_bundle_header(line):
+    """Parse the header line of a zone bundle.
+
+    Arguments:
+        line (str): The first line of the bundle.
+
+    Returns:
+        tuple: The format version (int) and a dictionary of the header options.
+
+    Raises:
+        ValueError: If the line is not the header of a supported zone bundle.
+    """
+    header = line.split()
+    if len(header) < 2 or not is_zone_bundle(header[0]):
+        raise ValueError("The stream is not a zone bundle")
+    version = int(header[1].lstrip("v"))
+    if version > ZONE_BUNDLE_VERSION:
+        raise ValueError(f"Unsupported zone bundle version: {header[1]}")
+    return version, dict(option.split("=", 1) for option in header[2:])
+
+
+def iter_zone_bundle(stream):
+    """Read the zone files from a zone bundle, one line of the bundle at a time.
+
+    Arguments:
+        stream (io.TextIOBase): A readable text stream of the bundle.
+
+    Yields:
+        tuple: The zone name and the text of its zone file.
+
+    Raises:
+        ValueError: If the stream is not a supported zone bundle or is truncated.
+    """
+    parse_zone_bundle_header(stream.readline())
+
+    decompressor = zlib.decompressobj()
+    buffer = bytearray()
+
+    def read(size):
+        while len(buffer) < size:
+            line = stream.readline()
+            if not line:
+                raise ValueError("The zone bundle is truncated")
+            buffer.extend(decompressor.decompress(base64.b64decode(line)))
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    while True:
+        (name_length,) = struct.unpack(">I", read(4))
+        if name_length == ZoneBundleWriter.END_MARKER:
+            return
+        zone = read(name_length).decode("utf-8")
+        (text_length,) = struct.unpack(">Q", read(8))
+        yield zone, read(text_length).decode("utf-8")
+
+
+class Record(namedtuple("Record", ("type", "data", "owner"), defaults=(None,))):
+    """A DNS resource record in a :py:class:`ZoneTree`.
+
+    Attributes:
+        type (str): The type of the record (e.g. ``"A"``).
+        data (str): The data of the record (e.g. ``"10.0.0.1"``).
+        owner (str): The owner name of the record, relative to the zone it is
+            written in, or :py:data:`None` for the name the record is stored
+            under (see :py:class:`ZoneTree`).
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_entry(cls, entry):
+        """Convert an entry of a zone dictionary to a record.
+
+        Arguments:
+            entry (tuple): A ``(type, data)`` or ``(owner, type, data)`` tuple,
+                or a :py:class:`Record`.
+
+        Returns:
+            Record: The record.
+        """
+        if isinstance(entry, cls):
+            return entry
+        if len(entry) == 3:
+            owner, record_type, data = entry
+            return cls(sys.intern(record_type), data, owner)
+        record_type, data = entry
+        return cls(sys.intern(record_type), data)
+
+    def as_entry(self):
+        """Convert the record to an entry of a zone dictionary.
+
+        Returns:
+            tuple: A ``(type, data)`` or ``(owner, type, data)`` tuple.
+        """
+        if self.owner is None:
+            return (self.type, self.data)
+        return (self.owner, self.type, self.data)
+
+
+class ZoneTree:
+    """A compact tree of DNS domains and their records.
+
+    Each :py:class:`ZoneTree` is a domain (the root of the tree being the root
+    domain). Its :py:attr:`children` map a label to either a child domain
+    (another :py:class:`ZoneTree`) or, for a name which is not a domain (e.g. a
+    host), a tuple of its :py:class:`Record` objects. The records of the domain
+    itself are held in :py:attr:`records`.
+
+    A record whose ``owner`` is :py:data:`None` belongs to the name it is
+    stored under. Otherwise, the owner is relative to the zone the record is
+    written in: the parent domain for the records of a host, and the domain
+    itself for the records in :py:attr:`records`.
+
+    Labels are interned, and records are immutable, so the same records (and,
+    as long as they are not modified, the same subtrees) can be shared between
+    trees. Keys of :py:attr:`children` may hold several labels (e.g. the
+    ``0.0.10`` reverse zones), and are matched as such by :py:meth:`lookup`
+    and :py:meth:`insert`.
+
+    Zone dictionaries, the original form of the zone data, are nested
+    dictionaries keyed by label whose leaves are lists of ``(type, data)`` or
+    ``(owner, type, data)`` tuples, with the records of a domain stored under
+    its ``"@"`` key. They are converted with :py:meth:`from_dict` (or
+    :py:meth:`coerce`) and :py:meth:`to_dict`.
+
+    Attributes:
+        children (dict): Maps a label to a child :py:class:`ZoneTree` or a
+            tuple of records.
+        records (tuple): The records of the domain itself.
+    """
+
+    __slots__ = ("children", "records")
+
+    def __init__(self, children=None, records=()):
+        """
+        Arguments:
+            children (dict): The children of the domain.
+            records (iterable): The records of the domain itself.
+        """
+        self.children = {} if children is None else children
+        self.records = tuple(records)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __contains__(self, label):
+        return label in self.children
+
+    def __getitem__(self, label):
+        return self.children[label]
+
+    def __eq__(self, other):
+        if not isinstance(other, ZoneTree):
+            return NotImplemented
+        return self.records == other.records and self.children == other.children
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (ZoneTree, (self.children, self.records))
+
+    def __repr__(self):
+        return f"ZoneTree({self.children!r}, {self.records!r})"
+
+    def get(self, label, default=None):
+        """Get a child of the domain.
+
+        Arguments:
+            label (str): The label of the child.
+            default (object): The value to return if there is no such child.
+
+        Returns:
+            ZoneTree or tuple: The child domain or records.
+        """
+        return self.children.get(label, default)
+
+    def items(self):
+        """Get the children of the domain.
+
+        Returns:
+            dict_items: The label and child domain or records of each child.
+        """
+        return self.children.items()
+
+    def copy(self):
+        """Create a shallow copy of the domain.
+
+        Returns:
+            ZoneTree: A domain with a copy of :py:attr:`children`.
+        """
+        return ZoneTree(dict(self.children), self.records)
+
+    def match(self, labels, position=0):
+        """Find the key of the child which holds (the start of) a name.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first.
+            position (int): The number of labels which belong to this domain.
+
+        Returns:
+            tuple: The key and the number of labels it holds. If there is no
+            such child, the key for the next label is returned.
+        """
+        children = self.children
+        label = labels[position]
+        if label in children:
+            return label, 1
+        for end in range(position + 2, len(labels) + 1):
+            key = ".".join(reversed(labels[position:end]))
+            if key in children:
+                return key, end - position
+        return label, 1
+
+    def lookup(self, labels):
+        """Find the domain or records for a name.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first.
+
+        Returns:
+            ZoneTree or tuple: The domain or the records, or :py:data:`None` if
+            the name is not in the tree.
+        """
+        node = self
+        position = 0
+        while position < len(labels):
+            if not isinstance(node, ZoneTree):
+                return None
+            key, width = node.match(labels, position)
+            node = node.children.get(key)
+            position += width
+        return node
+
+    def _own(self, key, owned):
+        """Get a child domain which may be modified.
+
+        Arguments:
+            key (str): The key of the child domain.
+            owned (set): The ids of the domains which may be modified, or
+                :py:data:`None` if every domain may be.
+
+        Returns:
+            ZoneTree: The child domain, copied if it may not be modified.
+        """
+        child = self.children[key]
+        if owned is not None and id(child) not in owned:
+            child = self.children[key] = child.copy()
+            owned.add(id(child))
+        return child
+
+    def descend(self, labels, owned=None):
+        """Find the domain which holds a name, creating any missing domains.
+
+        A name which holds records is turned into a domain when a name beneath
+        it is added. The records which have their own owner name are relative
+        to the parent domain, so they are moved to its :py:attr:`records`.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first.
+            owned (set): To copy on write, the ids of the domains which may be
+                modified (including this one). Any other domain on the path is
+                copied, and the id of the copy is added to the set.
+
+        Returns:
+            tuple: The domain which holds the name and the name's key within it.
+        """
+        node = self
+        position = 0
+        while True:
+            key, width = node.match(labels, position)
+            position += width
+            if position == len(labels):
+                return node, key
+            node = node._domain(key, owned)
+
+    def _domain(self, key, owned):
+        """Get a child domain which may be modified, creating it if needed.
+
+        Arguments:
+            key (str): The key of the child.
+            owned (set): The ids of the domains which may be modified, as for
+                :py:meth:`descend`.
+
+        Returns:
+            ZoneTree: The child domain.
+        """
+        child = self.children.get(key)
+        if isinstance(child, ZoneTree):
+            return self._own(key, owned)
+        records = child or ()
+        domain = self.children[sys.intern(key)] = ZoneTree(
+            records=[record for record in records if record.owner is None]
+        )
+        if owned is not None:
+            owned.add(id(domain))
+        self.records += tuple(record for record in records if record.owner is not None)
+        return domain
+
+    def domain(self, labels, owned=None):
+        """Get the domain for a name, creating any missing domains.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first.
+            owned (set): The ids of the domains which may be modified, as for
+                :py:meth:`descend`.
+
+        Returns:
+            ZoneTree: The domain.
+        """
+        if not labels:
+            return self
+        node, key = self.descend(labels, owned)
+        return node._domain(key, owned)
+
+    def add(self, key, records, owned=None):
+        """Add records to the domain or one of its children, skipping duplicates.
+
+        Records added to a child domain are stored in its :py:attr:`records`,
+        except for those which have their own owner name. Those are relative
+        to this domain, so they are stored in this domain's :py:attr:`records`.
+
+        Arguments:
+            key (str): The key of the child, or :py:data:`None` for the domain
+                itself.
+            records (iterable): The :py:class:`Record` objects.
+            owned (set): The ids of the domains which may be modified, as for
+                :py:meth:`descend`.
+
+        Returns:
+            int: The number of records which were added.
+        """
+        added = 0
+        child = None if key is None else self.children.get(key)
+        if isinstance(child, ZoneTree):
+            records = tuple(records)
+            added = self._own(key, owned).add(
+                None, [record for record in records if record.owner is None]
+            )
+            records = [record for record in records if record.owner is not None]
+            key = None
+
+        existing = self.records if key is None else child or ()
+        present = set(existing)
+        new = []
+        for record in records:
+            if record not in present:
+                present.add(record)
+                new.append(record)
+        if key is None:
+            self.records = existing + tuple(new)
+        else:
+            self.children[sys.intern(key)] = existing + tuple(new)
+        return added + len(new)
+
+    def insert(self, labels, records, owned=None):
+        """Add records to a name, creating any missing domains.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first. An
+                empty tuple adds the records to this domain.
+            records (iterable): The :py:class:`Record` objects.
+            owned (set): The ids of the domains which may be modified, as for
+                :py:meth:`descend`.
+
+        Returns:
+            int: The number of records which were added.
+        """
+        if not labels:
+            return self.add(None, records)
+        node, key = self.descend(labels, owned)
+        return node.add(key, records, owned)
+
+    def walk(self, origin=""):
+        """Walk every domain of the tree, depth first.
+
+        Arguments:
+            origin (str): The fully qualified name of this domain.
+
+        Yields:
+            tuple: The fully qualified name of each domain (``""`` for the root,
+            otherwise ending with a dot) and the domain, parents first.
+        """
+        stack = [(origin, self)]
+        while stack:
+            domain, node = stack.pop()
+            yield domain, node
+            stack.extend(
+                (f"{label}.{domain}", child)
+                for label, child in reversed(node.children.items())
+                if isinstance(child, ZoneTree)
+            )
+
+    def iter_records(self):
+        """Iterate over every record of the tree with its fully qualified name.
+
+        Yields:
+            tuple: The fully qualified owner name (ending with a dot, except for
+            the root, which is ``"."``) and the :py:class:`Record`.
+        """
+
+        def qualify(owner, origin):
+            if owner.endswith("."):
+                return owner
+            if owner == "@":
+                return origin or "."
+            return f"{owner}.{origin}"
+
+        for domain, node in self.walk():
+            for record in node.records:
+                yield qualify(record.owner or "@", domain), record
+            for label, child in node.children.items():
+                if isinstance(child, ZoneTree):
+                    continue
+                for record in child:
+                    yield qualify(record.owner or label, domain), record
+
+    def count(self):
+        """Count the domains and records of the tree.
+
+        Returns:
+            tuple: The number of domains (excluding this one) and records.
+        """
+        domains = 0
+        records = 0
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            records += len(node.records)
+            for child in node.children.values():
+                if isinstance(child, ZoneTree):
+                    domains += 1
+                    pending.append(child)
+                else:
+                    records += len(child)
+        return domains, records
+
+    def digest(self, memo=None):
+        """Compute a digest of the content of the tree.
+
+        Trees with the same domains and records have the same digest. The
+        digest of each domain is stored in ``memo``, so that subtrees which are
+        shared between trees are only hashed once.
+
+        Arguments:
+            memo (dict): The digests of domains computed so far, keyed by
+                :py:func:`id`. The domains must not be modified while it is in
+                use.
+
+        Returns:
+            str: The hexadecimal SHA-256 digest of the tree.
+        """
+        if memo is None:
+            memo = {}
+        cached = memo.get(id(self))
+        if cached is not None and cached[0] is self:
+            return cached[1]
+        # Records are converted to plain tuples, which are much faster to pickle
+        children = [
+            (
+                label,
+                child.digest(memo)
+                if isinstance(child, ZoneTree)
+                else tuple(map(tuple, child)),
+            )
+            for label, child in self.children.items()
+        ]
+        content = (tuple(map(tuple, self.records)), children)
+        digest = PayloadCache.digest(pickle.dumps(content, pickle.HIGHEST_PROTOCOL))
+        memo[id(self)] = (self, digest)
+        return digest
+
+    @classmethod
+    def from_dict(cls, zones, _memo=None):
+        """Convert a zone dictionary to a tree.
+
+        Subtrees and record lists which are shared within the dictionary are
+        also shared within the tree.
+
+        Arguments:
+            zones (dict): The zone dictionary.
+
+        Returns:
+            ZoneTree: The tree.
+        """
+        memo = {} if _memo is None else _memo
+        tree = cls()
+        for label, value in (zones or {}).items():
+            converted = memo.get(id(value))
+            if converted is None:
+                if isinstance(value, dict):
+                    converted = cls.from_dict(value, memo)
+                else:
+                    converted = tuple(
+                        dict.fromkeys(Record.from_entry(entry) for entry in value)
+                    )
+                memo[id(value)] = converted
+            if label == "@":
+                tree.records += converted
+            else:
+                tree.children[sys.intern(label)] = converted
+        return tree
+
+    @classmethod
+    def coerce(cls, zones):
+        """Get the tree for zone data which may be a zone dictionary.
+
+        Arguments:
+            zones (ZoneTree or dict): The zone data, or :py:data:`None`.
+
+        Returns:
+            ZoneTree: ``zones`` itself if it is already a tree.
+        """
+        if isinstance(zones, ZoneTree):
+            return zones
+        return cls.from_dict(zones)
+
+    def to_dict(self):
+        """Convert the tree to a zone dictionary.
+
+        Returns:
+            dict: The zone dictionary, with the records of each domain under
+            its ``"@"`` key.
+        """
+        zones = {}
+        if self.records:
+            zones["@"] = [record.as_entry() for record in self.records]
+        for label, child in self.children.items():
+            if isinstance(child, ZoneTree):
+                zones[label] = child.to_dict()
+            else:
+                zones[label] = [record.as_entry() for record in child]
+        return zones
+
+
+def count_zone_tree(zones):
+    """Count the domains and records in a zone tree.
+
+    Arguments:
+        zones (ZoneTree or dict): A :py:class:`ZoneTree` or DNS zone dictionary
+            (see ``dns.populate_zones``).
+
+    Returns:
+        tuple: The number of domains (i.e. interior nodes, excluding the root)
+        and the number of records.
+    """
+    if isinstance(zones, ZoneTree):
+        return zones.count()
+    domains = 0
+    records = 0
+    pending = [zones or {}]
+    while pending:
+        subtree = pending.pop()
+        for entries in subtree.values():
+            if isinstance(entries, dict):
+                domains += 1
+                pending.append(entries)
+            else:
+                records += len(entries)
+    return domains, records
+
+
+class PluginMetrics:
+    """Timers and counters describing a single run of a DNS plugin.
+
+    Totals for the whole run are kept in :py:attr:`timers` and
+    :py:attr:`counters`, and the same measurements can be recorded for each
+    DNS server so that a pathological server stands out in a large experiment.
+
+    Attributes:
+        plugin (str): The name of the plugin (e.g. ``"configure_bind"``).
+        timers (dict): The total seconds spent in each named stage.
+        counters (dict): The total of each named counter.
+        servers (dict): The timers and counters of each DNS server, keyed by
+            the server's name.
+    """
+
+    def __init__(self, plugin):
+        """
+        Arguments:
+            plugin (str): The name of the plugin.
+        """
+        self.plugin = plugin
+        self.timers = {}
+        self.counters = {}
+        self.servers = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage, server=None):
+        """Time a stage of the plugin, adding the elapsed time to its total.
+
+        Arguments:
+            stage (str): The name of the stage.
+            server (str): The DNS server the stage is for, if any. The time is
+                then also added to the server's breakdown.
+
+        Yields:
+            None: Control returns to the timed block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timers[stage] = self.timers.get(stage, 0.0) + elapsed
+            if server is not None:
+                timers = self.server(server).setdefault("timers", {})
+                timers[stage] = timers.get(stage, 0.0) + elapsed
+
+    def server(self, name):
+        """Get the breakdown of a DNS server, creating it if needed.
+
+        Arguments:
+            name (str): The name of the DNS server.
+
+        Returns:
+            dict: The server's breakdown.
+        """
+        return self.servers.setdefault(name, {})
+
+    def count(self, counter, amount=1, server=None):
+        """Add to a counter.
+
+        Arguments:
+            counter (str): The name of the counter.
+            amount (int): The amount to add.
+            server (str): The DNS server the amount is for, if any. The amount
+                is then also added to the server's breakdown.
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+        if server is not None:
+            counters = self.server(server).setdefault("counters", {})
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def summary(self):
+        """Get the totals of the run.
+
+        Returns:
+            dict: The timers (in seconds) and counters of the run.
+        """
+        return {
+            "plugin": self.plugin,
+            "timers": {stage: round(secs, 6) for stage, secs in self.timers.items()},
+            "counters": dict(self.counters),
+        }
+
+    def as_dict(self):
+        """Get every measurement of the run, including the per-server breakdowns.
+
+        Returns:
+            dict: The summary of the run with a ``"servers"`` key added.
+        """
+        report = self.summary()
+        report["servers"] = {}
+        for name, breakdown in self.servers.items():
+            server = dict(breakdown)
+            if "timers" in server:
+                server["timers"] = {
+                    stage: round(secs, 6) for stage, secs in server["timers"].items()
+                }
+            report["servers"][name] = server
+        return report
+
+    def log_summary(self, log):
+        """Log the totals of the run, and each server's breakdown at debug level.
+
+        Arguments:
+            log (logging.Logger): The plugin's logger.
+        """
+        log.info("DNS metrics: %s", json.dumps(self.summary(), sort_keys=True))
+        for name, breakdown in self.as_dict()["servers"].items():
+            log.debug("DNS metrics for %s: %s", name, json.dumps(breakdown))
+
+    def write_report(self, path=None):
+        """Write every measurement of the run to a JSON file.
+
+        Arguments:
+            path (str): The file to write. Defaults to a file named after the
+                plugin in :py:data:`REPORT_DIRECTORY`.
+
+        Returns:
+            str: The path of the report.
+        """
+        if path is None:
+            os.makedirs(REPORT_DIRECTORY, exist_ok=True)
+            path = os.path.join(REPORT_DIRECTORY, f"{self.plugin}.json")
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.as_dict(), report_file, indent=2, sort_keys=True)
+            report_file.write("\n")
+        return path
+
+    def finish(self, log, report=""):
+        """Log the run's summary and, if requested, write its JSON report.
+
+        Arguments:
+            log (logging.Logger): The plugin's logger.
+            report (str): The plugin's ``report`` argument. Like the ``debug``
+                argument of ``dns.configure_bind``, the report is written when
+                the value is ``'True'`` or ``'true'``.
+        """
+        self.log_summary(log)
+        if report.startswith(("T", "t")):
+            log.info("Wrote DNS metrics to %s", self.write_report())
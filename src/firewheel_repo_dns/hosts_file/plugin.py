@@ -0,0 +1,153 @@
+from dns.dns_objects import DNSContext, PluginMetrics
+
+from firewheel.control.experiment_graph import AbstractPlugin
+
+HOSTS_SCOPES = ("all", "domain")
+# The default schedule time of hosts_file_agent.py
+HOSTS_FILE_START_TIME = -99
+
+
+class HostsFileRenderer:
+    """Render the hosts file entries of the experiment's hosts.
+
+    Each entry is an ``<address> <name>`` line, in the order of the
+    :py:class:`dns.dns_objects.HostIndex`. With the ``"all"`` scope, every
+    host receives every entry. With the ``"domain"`` scope, each host only
+    receives the entries of the hosts in its own domain (i.e. the hosts whose
+    names only differ in their first label), which keeps the files small in
+    experiments with many domains.
+
+    Hosts which receive the same entries share the same fragment object.
+    """
+
+    def __init__(self, index, scope="all"):
+        """
+        Arguments:
+            index (dns.dns_objects.HostIndex): The hosts to resolve.
+            scope (str): Either ``"all"`` or ``"domain"``.
+
+        Raises:
+            ValueError: If the scope is unknown.
+        """
+        if scope not in HOSTS_SCOPES:
+            raise ValueError(f"Unknown hosts file scope: {scope}")
+        self.index = index
+        self.scope = scope
+        self._fragments = {}
+
+    @staticmethod
+    def domain(name):
+        """Get the domain of a host name.
+
+        Arguments:
+            name (str): The fully qualified host name.
+
+        Returns:
+            str: The name without its first label (empty for single labels).
+        """
+        return name.partition(".")[2]
+
+    def fragments(self):
+        """Render the fragment for each domain (or for every host).
+
+        Returns:
+            dict: Maps a domain (or ``None`` for the ``"all"`` scope) to its
+            hosts file fragment.
+        """
+        if self._fragments:
+            return self._fragments
+        lines = {}
+        for host in self.index:
+            key = self.domain(host.name) if self.scope == "domain" else None
+            lines.setdefault(key, []).append(f"{host.address}\t{host.name}\n")
+        self._fragments = {key: "".join(entries) for key, entries in lines.items()}
+        return self._fragments
+
+    def fragment(self, name):
+        """Get the hosts file fragment for a host.
+
+        Arguments:
+            name (str): The name of the host.
+
+        Returns:
+            str: The fragment, which is empty if no hosts share its domain.
+        """
+        key = self.domain(name) if self.scope == "domain" else None
+        return self.fragments().get(key, "")
+
+
+class HostsFile(AbstractPlugin):
+    """This plugin lets hosts resolve each other's names through their hosts
+    file, rather than through a :py:class:`dns.dns_objects.DNSServer`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Constructor for HostsFile
+
+        Arguments:
+            *args: extra args to pass to AbstractPlugin constructor
+            **kwargs: extra keyword args to pass to AbstractPlugin constructor
+        """
+        super(HostsFile, self).__init__(*args, **kwargs)
+        self.metrics = None
+
+    def run(self, scope="all", report="", start_time=""):
+        """
+        Schedule the hosts file entries of every host on each Linux host.
+
+        Arguments:
+            scope(str): Which entries each host receives, either ``"all"`` (the
+                default) or ``"domain"``. See :py:class:`HostsFileRenderer`.
+            report(str): Write the plugin's timers and counters to a JSON file
+                (see :py:class:`dns.dns_objects.PluginMetrics`). Value should be
+                'True' or 'true' to enable
+            start_time(str): The schedule time of ``hosts_file_agent.py``.
+                Defaults to -99.
+        """
+        self.metrics = PluginMetrics("hosts_file")
+        scope = (scope or "all").lower()
+        if scope not in HOSTS_SCOPES:
+            self.log.warning("Unknown hosts file scope %s, using all", scope)
+            scope = "all"
+        try:
+            start = int(start_time or HOSTS_FILE_START_TIME)
+        except ValueError:
+            self.log.warning(
+                "Invalid start_time %s, using %d", start_time, HOSTS_FILE_START_TIME
+            )
+            start = HOSTS_FILE_START_TIME
+
+        with self.metrics.timer("index"):
+            context = DNSContext.get(self.g, self.log)
+        if context.reused:
+            self.metrics.count("context_reused")
+        else:
+            self.metrics.count("vertices_scanned", context.vertices_scanned)
+        self.metrics.count("hosts_indexed", len(context.index))
+
+        renderer = HostsFileRenderer(context.index, scope)
+        with self.metrics.timer("render"):
+            fragments = renderer.fragments()
+        self.metrics.count("distinct_payloads", len(fragments))
+        self.metrics.count("distinct_payload_bytes", sum(map(len, fragments.values())))
+        with self.metrics.timer("schedule"):
+            self.schedule(context.linux_hosts, renderer, start)
+        self.metrics.finish(self.log, report)
+
+    def schedule(self, linux_hosts, renderer, start_time=HOSTS_FILE_START_TIME):
+        """
+        Add the hosts file agent to the schedule of each Linux host.
+
+        Only Linux hosts are configured, since Windows images do not have
+        python installed by default.
+
+        Arguments:
+            linux_hosts (list): The Linux host vertices.
+            renderer (HostsFileRenderer): Renders the fragment of each host.
+            start_time (int): The schedule time of the agent.
+        """
+        for vertex in linux_hosts:
+            fragment = renderer.fragment(vertex.name)
+            vertex.add_vm_resource(start_time, "hosts_file_agent.py", fragment, None)
+            self.metrics.count("hosts_configured")
+            self.metrics.count("payload_bytes", len(fragment))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from platform import system
+
+LINUX_HOSTS = "/etc/hosts"
+WINDOWS_HOSTS = r"C:\Windows\System32\drivers\etc\hosts"
+BEGIN_MARKER = "# BEGIN FIREWHEEL HOSTS\n"
+END_MARKER = "# END FIREWHEEL HOSTS\n"
+
+
+def replace_file(path, contents):
+    """
+    Atomically replace the contents of a file, via a temporary file in the
+    same directory which is renamed over the original file.
+
+    Arguments:
+        path (str): The path to the file.
+        contents (str): The new contents of the file.
+    """
+    tmp_path = "%s.fwtmp" % path
+    with open(tmp_path, "w") as fhand:
+        fhand.write(contents)
+    if os.name == "nt" and os.path.exists(path):
+        # Windows can not rename over an existing file
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def merge_entries(current, entries):
+    """
+    Replace the FIREWHEEL block of a hosts file with new entries. The block
+    is appended if the file does not have one yet, and anything outside of
+    the block is kept as it is.
+
+    Arguments:
+        current (str): The current contents of the hosts file.
+        entries (str): The new entries, one ``<address> <name>`` per line.
+
+    Returns:
+        str: The new contents of the hosts file.
+    """
+    lines = current.splitlines(True)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    if entries and not entries.endswith("\n"):
+        entries += "\n"
+    block = [BEGIN_MARKER, entries, END_MARKER]
+
+    try:
+        begin = lines.index(BEGIN_MARKER)
+        end = lines.index(END_MARKER, begin)
+    except ValueError:
+        lines.extend(block)
+    else:
+        lines[begin : end + 1] = block
+    return "".join(lines)
+
+
+def set_hosts(path, entries_file):
+    """
+    Write the entries into the hosts file, unless they are already there.
+
+    Arguments:
+        path (str): The path to the hosts file.
+        entries_file (str): The path to the file holding the entries.
+    """
+    with open(entries_file, "r") as fhand:
+        entries = fhand.read()
+    current = ""
+    if os.path.exists(path):
+        with open(path, "r") as fhand:
+            current = fhand.read()
+    contents = merge_entries(current, entries)
+    if contents != current:
+        replace_file(path, contents)
+
+
+if __name__ == "__main__":
+    if system() == "Windows":
+        set_hosts(WINDOWS_HOSTS, sys.argv[1])
+    else:
+        set_hosts(LINUX_HOSTS, sys.argv[1])
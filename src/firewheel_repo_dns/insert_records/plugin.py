@@ -1,7 +1,397 @@
-from dns.dns_objects import DNSServer
+import os
+import csv
+import sys
+import json
+
+from dns.dns_objects import Record, ZoneTree, DNSContext, PluginMetrics, count_zone_tree
 
 from firewheel.control.experiment_graph import AbstractPlugin
 
+RECORD_CLASSES = ("IN", "CH", "HS", "CS")
+# The records whose data hold domain names, and the position of the name
+NAME_FIELDS = {"CNAME": 0, "DNAME": 0, "NS": 0, "PTR": 0, "MX": 1, "SRV": 3}
+
+
+def _strip_comment(line):
+    """Remove a ``;`` comment from a zone file line, ignoring quoted text.
+
+    Arguments:
+        line (str): The line.
+
+    Returns:
+        str: The line without its comment.
+    """
+    quoted = False
+    for position, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ";" and not quoted:
+            return line[:position]
+    return line
+
+
+def _strip_parentheses(line):
+    """Replace the parentheses of a zone file line with spaces, ignoring quoted text.
+
+    Arguments:
+        line (str): The line, without its comment.
+
+    Returns:
+        tuple: The line without its parentheses, and the number of
+        parentheses it opened minus the number it closed.
+    """
+    quoted = False
+    depth = 0
+    chars = list(line)
+    for position, char in enumerate(chars):
+        if char == '"':
+            quoted = not quoted
+        elif char in "()" and not quoted:
+            depth += 1 if char == "(" else -1
+            chars[position] = " "
+    return "".join(chars), depth
+
+
+def _invalid(message, log=None):
+    """Report an invalid entry of a record file.
+
+    Arguments:
+        message (str): Describes the entry.
+        log (logging.Logger): Where to warn that the entry is skipped. Without
+            a logger, the entry is an error.
+
+    Raises:
+        ValueError: If there is no logger.
+    """
+    if log is None:
+        raise ValueError(message)
+    log.warning("%s, skipping it", message)
+
+
+def _absolute_name(name, origin):
+    """Make a (possibly relative) zone file name absolute.
+
+    Arguments:
+        name (str): The name, where ``@`` is the origin and names without a
+            trailing dot are relative to the origin.
+        origin (str): The current origin, without a trailing dot.
+
+    Returns:
+        str: The fully qualified name, without a trailing dot.
+    """
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name[:-1]
+    return f"{name}.{origin}" if origin else name
+
+
+def _qualify_data(record_type, data, origin):
+    """Make the domain name in a record's data fully qualified.
+
+    Records are moved into zones with a different origin than the file they
+    were read from, so relative names in CNAME, DNAME, NS, PTR, MX and SRV
+    records are qualified with the file's origin.
+
+    Arguments:
+        record_type (str): The type of the record.
+        data (str): The data of the record.
+        origin (str): The origin of the record, without a trailing dot.
+
+    Returns:
+        str: The data of the record.
+    """
+    field = NAME_FIELDS.get(record_type)
+    if field is None:
+        return data
+    fields = data.split()
+    if len(fields) <= field or fields[field].endswith("."):
+        return data
+    fields[field] = _absolute_name(fields[field], origin) + "."
+    return " ".join(fields)
+
+
+def iter_zone_file_records(path, origin="", log=None):
+    """Read the records of a BIND style zone file, one at a time.
+
+    The ``$ORIGIN`` and ``$TTL`` directives, omitted owner names, comments and
+    records split over several lines with parentheses are supported.
+    Parentheses within quoted text (e.g. of TXT records) are kept. TTLs and
+    classes are discarded, as are SOA records, since each zone is given its
+    own SOA record by ``dns.configure_bind``.
+
+    Arguments:
+        path (str): The path to the zone file.
+        origin (str): The initial origin of the file.
+        log (logging.Logger): Where to warn about unsupported directives (such
+            as ``$INCLUDE``) and lines without a record type, which are then
+            skipped. Without a logger, they are errors.
+
+    Yields:
+        tuple: The fully qualified name (without a trailing dot), type and data
+        of each record.
+
+    Raises:
+        ValueError: If the file contains an unsupported directive or a line
+            without a record type, and there is no logger.
+    """
+    origin = origin.rstrip(".")
+    owner = origin
+    pending = ""
+    depth = 0
+    with open(path, encoding="utf-8") as zone_file:
+        for number, line in enumerate(zone_file, 1):
+            line, change = _strip_parentheses(_strip_comment(line.rstrip("\n")))
+            depth += change
+            pending = f"{pending} {line}" if pending else line
+            if depth > 0:
+                continue
+            line = pending
+            pending = ""
+            depth = 0
+            if not line.strip():
+                continue
+
+            if line.startswith("$"):
+                directive, _, value = line.replace("\t", " ").partition(" ")
+                if directive.upper() == "$ORIGIN":
+                    origin = _absolute_name(value.strip(), origin)
+                elif directive.upper() != "$TTL":
+                    _invalid(f"{path}:{number}: Unsupported directive {directive}", log)
+                continue
+
+            if not line[0].isspace():
+                name, _, line = line.replace("\t", " ").partition(" ")
+                owner = _absolute_name(name, origin)
+            fields = line.split(None, 1)
+            while fields and (
+                fields[0][0].isdigit() or fields[0].upper() in RECORD_CLASSES
+            ):
+                fields = fields[1].split(None, 1) if len(fields) > 1 else []
+            if not fields:
+                _invalid(f"{path}:{number}: Missing record type", log)
+                continue
+            record_type = fields[0].upper()
+            if record_type == "SOA":
+                continue
+            data = fields[1].strip() if len(fields) > 1 else ""
+            yield owner, record_type, _qualify_data(record_type, data, origin)
+
+
+def iter_csv_records(path, log=None):
+    """Read the records of a CSV file, one at a time.
+
+    Each row holds the fully qualified name, type and data of a record. An
+    optional ``name,type,data`` header row, blank rows and rows beginning with
+    ``#`` are skipped.
+
+    Arguments:
+        path (str): The path to the CSV file.
+        log (logging.Logger): Where to warn about invalid rows, which are then
+            skipped. Without a logger, they are errors.
+
+    Yields:
+        tuple: The name (without a trailing dot), type and data of each record.
+
+    Raises:
+        ValueError: If a row does not have three columns, and there is no
+            logger.
+    """
+    with open(path, newline="", encoding="utf-8") as csv_file:
+        for number, row in enumerate(csv.reader(csv_file), 1):
+            if not row or row[0].startswith("#"):
+                continue
+            if number == 1 and [cell.strip().lower() for cell in row] == [
+                "name",
+                "type",
+                "data",
+            ]:
+                continue
+            if len(row) != 3:
+                _invalid(f"{path}:{number}: Expected name,type,data", log)
+                continue
+            name, record_type, data = (cell.strip() for cell in row)
+            yield name.rstrip("."), record_type.upper(), data
+
+
+def iter_jsonl_records(path, log=None):
+    """Read the records of a JSON Lines file, one at a time.
+
+    Each line is an object with the ``name``, ``type`` and ``data`` of a
+    record. Blank lines are skipped.
+
+    Arguments:
+        path (str): The path to the JSON Lines file.
+        log (logging.Logger): Where to warn about invalid lines, which are then
+            skipped. Without a logger, they are errors.
+
+    Yields:
+        tuple: The name (without a trailing dot), type and data of each record.
+
+    Raises:
+        ValueError: If a line is not a valid record, and there is no logger.
+    """
+    with open(path, encoding="utf-8") as jsonl_file:
+        for number, line in enumerate(jsonl_file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                record = (
+                    str(record["name"]).rstrip("."),
+                    str(record["type"]).upper(),
+                    str(record["data"]),
+                )
+            except (ValueError, KeyError, TypeError) as exp:
+                _invalid(f"{path}:{number}: Invalid record: {exp}", log)
+                continue
+            yield record
+
+
+RECORD_FORMATS = {
+    "zone": iter_zone_file_records,
+    "csv": iter_csv_records,
+    "jsonl": iter_jsonl_records,
+}
+RECORD_FORMAT_EXTENSIONS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+
+def iter_record_file(source, log=None):
+    """Read the records of an addon record file, one at a time.
+
+    Arguments:
+        source (str or dict): The path to the file, or a dictionary with the
+            ``path`` of the file and optionally its ``format`` (``"zone"``,
+            ``"csv"`` or ``"jsonl"``) and, for zone files, its ``origin``. By
+            default, the format is chosen by the file extension (``.csv``,
+            ``.jsonl`` or ``.ndjson``), and any other file is read as a zone file.
+        log (logging.Logger): Where to warn about invalid records, which are
+            then skipped. Without a logger, they are errors.
+
+    Returns:
+        iterator: The name, type and data of each record.
+
+    Raises:
+        ValueError: If the format is unknown.
+    """
+    if isinstance(source, str):
+        source = {"path": source}
+    path = source["path"]
+    record_format = source.get("format") or RECORD_FORMAT_EXTENSIONS.get(
+        os.path.splitext(path)[1].lower(), "zone"
+    )
+    if record_format not in RECORD_FORMATS:
+        raise ValueError(f"Unknown addon record format {record_format} for {path}")
+    if record_format == "zone":
+        return iter_zone_file_records(path, source.get("origin", ""), log)
+    return RECORD_FORMATS[record_format](path, log)
+
+
+class ZoneTreeMerger:
+    """Deep-merge records into a zone tree, copying it as needed.
+
+    Zone trees (and their subtrees) may be shared between DNS servers, so each
+    domain is copied the first time the merger modifies it (see the ``owned``
+    argument of :py:meth:`dns.dns_objects.ZoneTree.insert`) and the copies are
+    kept in an index, keyed by the labels of their names. Records for names in
+    the same domain are then added without walking the tree again.
+
+    Names are matched to the existing keys of the tree, including keys which
+    hold several labels (such as the ``0.0.10`` reverse zones created by
+    ``dns.populate_zones``). A name which already holds records is turned into
+    a domain when records are added beneath it.
+
+    Attributes:
+        zones (dns.dns_objects.ZoneTree): The merged zone tree.
+        added (int): The number of records which were added.
+    """
+
+    def __init__(self, zones):
+        """
+        Arguments:
+            zones (dns.dns_objects.ZoneTree or dict): The zone tree (or zone
+                dictionary) to merge records into. It is not modified.
+        """
+        self.zones = ZoneTree.coerce(zones).copy()
+        self.added = 0
+        self._owned = {id(self.zones)}
+        self._index = {(): self.zones}
+
+    def _domain(self, labels):
+        """Get the (copied) domain for a name, creating it if needed.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first.
+
+        Returns:
+            dns.dns_objects.ZoneTree: The domain.
+        """
+        domain = self._index.get(labels)
+        if domain is None:
+            domain = self._index[labels] = self.zones.domain(labels, self._owned)
+        return domain
+
+    def insert(self, labels, records):
+        """Add records to a name.
+
+        Arguments:
+            labels (tuple): The labels of the name, top-level domain first.
+            records (iterable): The :py:class:`dns.dns_objects.Record` objects.
+
+        Returns:
+            int: The number of records which were added.
+        """
+        if not labels:
+            added = self.zones.add(None, records)
+        else:
+            key = labels[-1]
+            node = self._index.get(labels[:-1])
+            if node is None:
+                node, key = self.zones.descend(labels, self._owned)
+                if key == labels[-1]:
+                    self._index[labels[:-1]] = node
+            added = node.add(key, records, self._owned)
+        self.added += added
+        return added
+
+    def add_records(self, records):
+        """Add a stream of records.
+
+        Arguments:
+            records (iterable): The name, type and data of each record.
+
+        Returns:
+            int: The number of records which were added.
+        """
+        added = self.added
+        for name, record_type, data in records:
+            labels = tuple(reversed(name.split("."))) if name else ()
+            self.insert(labels, (Record(sys.intern(record_type), data),))
+        return self.added - added
+
+    def merge(self, tree, labels=()):
+        """Deep-merge another zone tree.
+
+        Arguments:
+            tree (dns.dns_objects.ZoneTree or dict): The zone tree (or zone
+                dictionary) to merge.
+            labels (tuple): The labels of the name ``tree`` belongs to.
+
+        Returns:
+            int: The number of records which were added.
+        """
+        added = self.added
+        tree = ZoneTree.coerce(tree)
+        if tree.records:
+            self.added += self._domain(labels).add(None, tree.records)
+        for key, child in tree.items():
+            child_labels = (*labels, *reversed(key.split(".")))
+            if isinstance(child, ZoneTree):
+                self.merge(child, child_labels)
+            else:
+                self.insert(child_labels, child)
+        return self.added - added
+
 
 class InsertRecords(AbstractPlugin):
     """Plugin to insert extra records into the zones data"""
@@ -14,30 +404,72 @@ class InsertRecords(AbstractPlugin):
             **kwargs: extra keyword args to pass to AbstractPlugin constructor
         """
         super(InsertRecords, self).__init__(*args, **kwargs)
+        self.metrics = None
 
-    def run(self):
-        """Function to run the InsertDNS plugin"""
+    def run(self, report=""):
+        """Function to run the InsertDNS plugin
 
-        for vertex in self.g.get_vertices():
-            # Look for zones and special records on dns key
-            if vertex.is_decorated_by(DNSServer):
+        Arguments:
+            report(str): Write the plugin's timers and counters to a JSON file
+                (see :py:class:`dns.dns_objects.PluginMetrics`). Value should be
+                'True' or 'true' to enable
+        """
+        self.metrics = PluginMetrics("insert_records")
+        context = DNSContext.get(self.g, self.log)
+        if context.reused:
+            self.metrics.count("context_reused")
+        else:
+            self.metrics.count("vertices_scanned", context.vertices_scanned)
+        # Look for zones and special records on dns key
+        for vertex in context.servers:
+            self.metrics.count("servers")
+            with self.metrics.timer("insert", server=vertex.name):
                 self.add_records(vertex)
+        self.metrics.finish(self.log, report)
 
     def add_records(self, vertex):
         """Add dns records to the zone data.
 
+        Records are taken from the ``addon_records`` (a
+        :py:class:`dns.dns_objects.ZoneTree` or zone dictionary) and the
+        ``addon_record_files`` (see :py:func:`iter_record_file`) in the
+        vertex's ``dns_data``, and are deep-merged into its zones. Record
+        files are streamed, so they are never held in memory. Invalid records
+        are skipped with a warning, as are files which can not be read.
+
         Arguments:
             vertex(firewheel.control.experiment_graph.Vertex): The graph vertex to add the records to
         """
         addon_records = vertex.dns_data.get("addon_records")
+        addon_record_files = vertex.dns_data.get("addon_record_files") or []
+        if isinstance(addon_record_files, (str, dict)):
+            addon_record_files = [addon_record_files]
         zones = vertex.dns_data.get("zones")
-        if zones and addon_records:
-            # this means that we have some records to add to the zone data
-
-            # Merge special records at top-level-domain level.
-            for tld in addon_records:
-                if zones.get(tld):
-                    zones[tld].update(addon_records[tld])
-                else:
-                    zones[tld] = addon_records[tld]
-            vertex.dns_data["zones"] = zones
+        if zones is None or not (addon_records or addon_record_files):
+            return
+
+        # Zone trees may be shared between DNS servers, so the merger copies
+        # each domain before modifying it.
+        merger = ZoneTreeMerger(zones)
+        if addon_records:
+            merger.merge(addon_records)
+            if self.metrics is not None:
+                domains, _ = count_zone_tree(addon_records)
+                self.metrics.count("domains_inserted", domains, server=vertex.name)
+        for source in addon_record_files:
+            added = merger.added
+            try:
+                merger.add_records(iter_record_file(source, self.log))
+            except (OSError, ValueError) as exp:
+                self.log.warning(
+                    "Unable to read addon records for %s from %s: %s",
+                    vertex.name,
+                    source,
+                    exp,
+                )
+            added = merger.added - added
+            self.log.debug("Added %d records to %s from %s", added, vertex.name, source)
+        vertex.dns_data["zones"] = merger.zones
+
+        if self.metrics is not None:
+            self.metrics.count("records_inserted", merger.added, server=vertex.name)
@@ -1,121 +1,1004 @@
-from base_objects import Switch
-from dns.dns_objects import DNSServer
+import os
+import re
+import sys
+import json
+import bisect
+import fnmatch
+import ipaddress
+
+from dns.dns_objects import (
+    ZONE_CONFIG,
+    ZONE_CACHE_VERSION,
+    Record,
+    ZoneTree,
+    ZoneCache,
+    DNSContext,
+    PayloadCache,
+    PluginMetrics,
+    ZoneTransfers,
+    count_zone_tree,
+)
 
 from firewheel.control.experiment_graph import AbstractPlugin
 
 
+class _ZoneNode:
+    """A node of the label trie which backs :py:class:`ZoneBuilder`.
+
+    Attributes:
+        children (dict): Maps a label to the child :py:class:`_ZoneNode`.
+        owners (list): ``(host_id, records)`` tuples for the hosts whose name
+            (or PTR name) ends at this node, in graph order.
+        size (int): The number of owners registered at or below this node.
+        tree (dns.dns_objects.ZoneTree or tuple): The cached zone subtree
+            containing every host below this node, or the records of a host.
+    """
+
+    __slots__ = ("children", "owners", "size", "tree")
+
+    def __init__(self):
+        self.children = {}
+        self.owners = []
+        self.size = 0
+        self.tree = None
+
+
+def address_records(addresses):
+    """Get the address records of a name.
+
+    Arguments:
+        addresses (iterable): The IPv4 and IPv6 addresses of the name.
+
+    Returns:
+        tuple: An ``A`` or ``AAAA`` :py:class:`dns.dns_objects.Record` for
+        each address.
+    """
+    return tuple(
+        Record("AAAA" if ":" in address else "A", address) for address in addresses
+    )
+
+
+class AddressSelector:
+    """Choose which of a host's addresses are published in its address records.
+
+    The selection is set by the ``publish_addresses`` key of a DNS server's
+    ``dns_data``, which may be:
+
+    * :py:data:`None` or ``"first"`` - Only the host's primary address, i.e. the
+      address of its first interface connected to a switch (the default).
+    * ``"all"`` - Every experiment address of the host, so multi-homed hosts get
+      an address record for each interface.
+    * A CIDR range, or a list of them - The host's addresses within the given
+      networks. Hosts without such an address publish their primary address.
+
+    Every published address also receives a PTR record.
+    """
+
+    MODES = ("first", "all")
+
+    def __init__(self, publish_addresses=None):
+        """
+        Arguments:
+            publish_addresses (str or list): The addresses to publish.
+
+        Raises:
+            ValueError: If an entry is neither a mode nor a CIDR range.
+        """
+        self.mode = "first"
+        self.networks = ()
+        if not publish_addresses:
+            return
+        if isinstance(publish_addresses, str):
+            if publish_addresses.lower() in self.MODES:
+                self.mode = publish_addresses.lower()
+                return
+            publish_addresses = [publish_addresses]
+        networks = []
+        for entry in publish_addresses:
+            try:
+                networks.append(ipaddress.ip_network(str(entry), strict=False))
+            except ValueError as exp:
+                raise ValueError(
+                    f"Invalid network in publish_addresses: {entry}"
+                ) from exp
+        self.mode = "networks"
+        self.networks = tuple(networks)
+
+    @property
+    def key(self):
+        """tuple: Identifies the selection, for caching the zones built with it."""
+        return (self.mode, *map(str, self.networks))
+
+    def select(self, host):
+        """Get the addresses to publish for a host.
+
+        Arguments:
+            host (dns.dns_objects.HostEntry): The host.
+
+        Returns:
+            tuple: The addresses, starting with the primary one if it is selected.
+        """
+        if self.mode == "first" or len(host.addresses) == 1:
+            return (host.address,)
+        if self.mode == "all":
+            return host.addresses
+        selected = tuple(
+            address
+            for address in host.addresses
+            if any(ipaddress.ip_address(address) in net for net in self.networks)
+        )
+        return selected or (host.address,)
+
+
+class ReverseZoneBuilder:
+    """Lay out the PTR records of IPv4 hosts in ``in-addr.arpa`` zones.
+
+    PTR records are grouped into one zone per network of ``prefix_length``
+    bits, with the octets in the standard reversed order. Octet aligned
+    prefixes (8, 16 or 24) produce zones such as ``0.10.in-addr.arpa`` which
+    hold the remaining octets as record names (e.g. ``5.0``). Prefixes 25 to 31
+    follow :rfc:`2317`: the PTR records are placed in a classless zone (e.g.
+    ``0-26.0.0.10.in-addr.arpa``) beneath the /24 zone, which holds a CNAME for
+    each address pointing into the classless zone. A ``-`` is used instead of
+    a ``/`` in classless zone names (as the RFC permits) so that the zone
+    names can also be used as file names.
+    """
+
+    PREFIX_LENGTHS = (8, 16, 24, 25, 26, 27, 28, 29, 30, 31)
+
+    def __init__(self, prefix_length=24):
+        """
+        Arguments:
+            prefix_length (int): The length of the network prefix of each zone.
+
+        Raises:
+            ValueError: If the prefix length is not supported.
+        """
+        prefix_length = int(prefix_length)
+        if prefix_length not in self.PREFIX_LENGTHS:
+            raise ValueError(
+                f"Unsupported reverse zone prefix length: {prefix_length}. "
+                f"Use one of {self.PREFIX_LENGTHS}"
+            )
+        self.prefix_length = prefix_length
+
+    def records(self, address, name):
+        """Get the reverse records for a host.
+
+        Arguments:
+            address (str): The IPv4 address of the host.
+            name (str): The fully qualified name of the host.
+
+        Returns:
+            list: ``(labels, records)`` tuples, where ``labels`` names the record
+            in the zone tree (top-level domain first) and ``records`` is a tuple
+            of :py:class:`dns.dns_objects.Record` objects. Hosts without an IPv4
+            address have no reverse records.
+        """
+        octets = address.split(".")
+        if len(octets) != 4:
+            return []
+        zone_octets = min(self.prefix_length // 8, 3)
+        zone_label = sys.intern(".".join(reversed(octets[:zone_octets])))
+        host_label = ".".join(reversed(octets[zone_octets:]))
+        ptr = (Record("PTR", f"{name}."),)
+        if self.prefix_length <= 24:
+            return [(("arpa", "in-addr", zone_label, host_label), ptr)]
+
+        block_size = 1 << (32 - self.prefix_length)
+        block_label = sys.intern(
+            f"{int(octets[3]) // block_size * block_size}-{self.prefix_length}"
+        )
+        cname = f"{host_label}.{block_label}.{zone_label}.in-addr.arpa."
+        return [
+            (("arpa", "in-addr", zone_label, host_label), (Record("CNAME", cname),)),
+            (("arpa", "in-addr", zone_label, block_label, host_label), ptr),
+        ]
+
+
+class ZoneBuilder:
+    """Derive per-server zone trees from a :py:class:`dns.dns_objects.HostIndex`.
+
+    The builder arranges every indexed host (both its forward name and its
+    reverse records) into a single label trie. Zones for a given DNS server are then
+    produced by walking only the trie paths of the hosts the server tracks.
+    Any subtree whose hosts are all tracked is replaced with a shared, cached
+    copy of the complete subtree, and servers which track exactly the same
+    hosts receive the same :py:class:`dns.dns_objects.ZoneTree`. Consumers must
+    therefore treat the returned trees as read-only and copy any domain they
+    need to modify (e.g. with the ``owned`` argument of
+    :py:meth:`dns.dns_objects.ZoneTree.insert`).
+    """
+
+    def __init__(self, index, log=None, reverse=None, addresses=None):
+        """
+        Arguments:
+            index (dns.dns_objects.HostIndex): The hosts which can be published.
+            log (logging.Logger): An optional logger for conflicting names.
+            reverse (ReverseZoneBuilder): Lays out the PTR records. Defaults to
+                /24 reverse zones.
+            addresses (AddressSelector): Chooses the addresses published for
+                each host. Defaults to the primary address of each host.
+        """
+        self.index = index
+        self.log = log
+        self.reverse = reverse or ReverseZoneBuilder()
+        self.addresses = addresses or AddressSelector()
+        self.root = _ZoneNode()
+        self._paths = []
+        self._cache = {}
+        for host_id, host in enumerate(index.hosts):
+            published = self.addresses.select(host)
+            paths = [self._insert(host_id, host.labels, address_records(published))]
+            for address in published:
+                for labels, records in self.reverse.records(address, host.name):
+                    paths.append(self._insert(host_id, labels, records))
+            self._paths.append(tuple(paths))
+
+    def _insert(self, host_id, labels, records):
+        """Register a host's records at the trie node named by ``labels``.
+
+        Arguments:
+            host_id (int): The position of the host in the index.
+            labels (tuple): The labels of the name, top-level domain first.
+            records (tuple): The records published at the name.
+
+        Returns:
+            tuple: The trie nodes from the root down to the record's node.
+        """
+        node = self.root
+        path = [node]
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                child = _ZoneNode()
+                node.children[label] = child
+            node = child
+            path.append(node)
+        node.owners.append((host_id, records))
+        for visited in path:
+            visited.size += 1
+        return tuple(path)
+
+    def _full_tree(self, node):
+        """Get the (cached) subtree which contains every host below ``node``.
+
+        Arguments:
+            node (_ZoneNode): The trie node.
+
+        Returns:
+            dns.dns_objects.ZoneTree or tuple: The zone subtree or the records
+            of a host.
+        """
+        if node.tree is None:
+            if node.children:
+                node.tree = ZoneTree(
+                    {
+                        label: self._full_tree(child)
+                        for label, child in node.children.items()
+                    }
+                )
+            else:
+                node.tree = node.owners[0][1]
+        return node.tree
+
+    def _build(self, node, counts, selected):
+        """Build the subtree of ``node`` restricted to the selected hosts.
+
+        Arguments:
+            node (_ZoneNode): The trie node.
+            counts (dict): The number of selected owners at or below each node.
+            selected (set): The selected host ids.
+
+        Returns:
+            dns.dns_objects.ZoneTree or tuple: The zone subtree or the records
+            of a host.
+        """
+        if counts[node] == node.size:
+            return self._full_tree(node)
+        if node.children:
+            return ZoneTree(
+                {
+                    label: self._build(child, counts, selected)
+                    for label, child in node.children.items()
+                    if child in counts
+                }
+            )
+        for host_id, records in node.owners:
+            if host_id in selected:
+                return records
+        return None
+
+    def build(self, host_ids=None):
+        """Create the zone tree for a set of hosts.
+
+        Arguments:
+            host_ids (iterable): The ids of the hosts to include. :py:data:`None`
+                includes every host in the index.
+
+        Returns:
+            dns.dns_objects.ZoneTree: The DNS zone tree.
+        """
+        if host_ids is None:
+            if not self.root.children:
+                return ZoneTree()
+            return self._full_tree(self.root)
+
+        selected = frozenset(host_ids)
+        zones = self._cache.get(selected)
+        if zones is not None:
+            return zones
+
+        counts = {}
+        for host_id in selected:
+            for path in self._paths[host_id]:
+                for node in path:
+                    counts[node] = counts.get(node, 0) + 1
+
+        zones = self._build(self.root, counts, selected) if counts else ZoneTree()
+        self._cache[selected] = zones
+        return zones
+
+    def warn_conflicts(self):
+        """Log every host whose name is also used as a domain by other hosts.
+
+        Such hosts cannot be represented in the zone tree, so the domain
+        takes precedence and the host's record is omitted.
+        """
+        if not self.log:
+            return
+        stack = [((), self.root)]
+        while stack:
+            labels, node = stack.pop()
+            if node.children and node.owners:
+                self.log.warning(
+                    "The name %s is also a domain; omitting its records",
+                    ".".join(reversed(labels)),
+                )
+            stack.extend(
+                ((*labels, label), child) for label, child in node.children.items()
+            )
+
+
+class HostMatcher:
+    """A compiled form of a DNS server's ``hosts_tracked`` attribute.
+
+    ``hosts_tracked`` may be ``"*"`` (every host) or a collection whose entries
+    are any mix of:
+
+    * Host names (e.g. ``"web.acme.com"``), which are matched with a set lookup.
+    * Suffix patterns (e.g. ``"*.corp.acme.com"``), which match every host
+      beneath the given domain and are checked with one set lookup per label.
+    * Other glob patterns (e.g. ``"b?-*.acme.com"``), which are combined into a
+      single regular expression.
+    * CIDR ranges (e.g. ``"10.1.0.0/16"``), which are matched against each of
+      the host's published addresses (see :py:class:`AddressSelector`) using a
+      sorted index of merged address intervals.
+
+    A single string is treated as a collection with one entry. Entries
+    containing a ``/`` which are not valid CIDR ranges are skipped, and listed
+    in :py:attr:`invalid`.
+    """
+
+    GLOB_CHARS = frozenset("*?[")
+
+    def __init__(self, hosts_tracked):
+        """
+        Arguments:
+            hosts_tracked (str or list): The hosts tracked by the DNS server.
+        """
+        self.matches_all = not hosts_tracked or hosts_tracked == "*"
+        self.invalid = []
+        self.names = set()
+        self.suffixes = set()
+        self.patterns = None
+        self._ranges = {}
+
+        if self.matches_all:
+            return
+
+        if isinstance(hosts_tracked, str):
+            hosts_tracked = [hosts_tracked]
+
+        globs = []
+        networks = {}
+        for entry in hosts_tracked:
+            entry = str(entry)
+            if "/" in entry:
+                try:
+                    network = ipaddress.ip_network(entry, strict=False)
+                except ValueError:
+                    self.invalid.append(entry)
+                    continue
+                networks.setdefault(network.version, []).append(
+                    (int(network.network_address), int(network.broadcast_address))
+                )
+            elif entry == "*":
+                self.matches_all = True
+                return
+            elif entry.startswith("*.") and not self.GLOB_CHARS & set(entry[2:]):
+                self.suffixes.add(entry[1:])
+            elif self.GLOB_CHARS & set(entry):
+                globs.append(fnmatch.translate(entry))
+            else:
+                self.names.add(entry)
+
+        if globs:
+            self.patterns = re.compile("|".join(f"(?:{glob})" for glob in globs))
+
+        # Merge overlapping ranges so that a bisection finds the only candidate.
+        for version, ranges in networks.items():
+            ranges.sort()
+            merged = [list(ranges[0])]
+            for start, end in ranges[1:]:
+                if start <= merged[-1][1] + 1:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self._ranges[version] = (
+                [start for start, _ in merged],
+                [end for _, end in merged],
+            )
+
+    @property
+    def uses_addresses(self):
+        """bool: Whether hosts are matched by address as well as by name."""
+        return bool(self._ranges)
+
+    @property
+    def names_only(self):
+        """bool: Whether only exact host names are being matched."""
+        return not (self.matches_all or self.suffixes or self.patterns or self._ranges)
+
+    def match_address(self, address):
+        """Check whether an address falls within one of the tracked CIDR ranges.
+
+        Arguments:
+            address (ipaddress.IPv4Address or ipaddress.IPv6Address): The address.
+
+        Returns:
+            bool: :py:data:`True` if the address is tracked.
+        """
+        ranges = self._ranges.get(address.version)
+        if not ranges:
+            return False
+        starts, ends = ranges
+        position = bisect.bisect_right(starts, int(address)) - 1
+        return position >= 0 and int(address) <= ends[position]
+
+    def match(self, name, addresses=()):
+        """Check whether a host is tracked.
+
+        Arguments:
+            name (str): The fully qualified name of the host.
+            addresses (tuple): The published addresses of the host, as
+                :py:mod:`ipaddress` objects, used to match CIDR ranges.
+
+        Returns:
+            bool: :py:data:`True` if the host is tracked.
+        """
+        if self.matches_all or name in self.names:
+            return True
+        if self.suffixes:
+            position = name.find(".")
+            while position != -1:
+                if name[position:] in self.suffixes:
+                    return True
+                position = name.find(".", position + 1)
+        if self.patterns and self.patterns.match(name):
+            return True
+        return any(self.match_address(address) for address in addresses)
+
+    def select(self, index, addresses=None):
+        """Find the tracked hosts of an index.
+
+        Arguments:
+            index (dns.dns_objects.HostIndex): The hosts to filter.
+            addresses (list): The parsed published addresses of each host in
+                ``index``. Only needed when CIDR ranges are tracked, and
+                defaults to the primary address of each host.
+
+        Returns:
+            list: The ids of the tracked hosts, or :py:data:`None` if every
+            host is tracked.
+        """
+        if self.matches_all:
+            return None
+        if self.names_only:
+            return [index.by_name[name] for name in self.names if name in index.by_name]
+        if self.uses_addresses and addresses is None:
+            addresses = [(ipaddress.ip_address(host.address),) for host in index]
+        return [
+            host_id
+            for host_id, host in enumerate(index.hosts)
+            if self.match(host.name, addresses[host_id] if self.uses_addresses else ())
+        ]
+
+
+# Addresses and networks in dns_data, which are fingerprinted as strings
+ADDRESS_TYPES = (
+    ipaddress.IPv4Address,
+    ipaddress.IPv6Address,
+    ipaddress.IPv4Network,
+    ipaddress.IPv6Network,
+)
+# Keys of dns_data which are written by the DNS plugins, rather than configuring
+# them, or which do not change the zone bundle
+ZONE_CACHE_IGNORED_KEYS = frozenset(
+    ("zones", "zone_cache", "zone_cache_key", "zone_bundle", "start_times")
+)
+
+
 class PopulateZones(AbstractPlugin):
     """This plugin builds the zone graphs needed for DNS.
-    The plugin first walks the entire graph, building a graph of
-    the zone data for the system, and installs that on
-    the master dns server (usually named DNS).
-    It then walks the graph to find each in-experiment node marked
-    as a dns server and uses a similar process to add zone data for it.
-    In each case, it puts the zone graphs on each dns server node
-    of the Firewheel graph.
+    The plugin first walks the entire graph once, indexing every host
+    connected to the experiment network together with its address.
+    It then uses that index to derive the zone graph for each
+    in-experiment node marked as a dns server, restricted to the hosts
+    that server tracks. In each case, it puts the zone graphs on each
+    dns server node of the Firewheel graph.
+
+    DNS servers with a ``zone_cache`` directory in their ``dns_data`` skip
+    building their zones when ``dns.configure_bind`` has already rendered
+    the same zones in an earlier experiment (see
+    :py:class:`dns.dns_objects.ZoneCache`).
     """
 
-    def run(self):
-        """Function to invoke the ConfigureDNS plugin."""
+    def __init__(self, *args, **kwargs):
+        """Constructor for PopulateZones
+
+        Arguments:
+            *args: extra args to pass to AbstractPlugin constructor
+            **kwargs: extra keyword args to pass to AbstractPlugin constructor
+        """
+        super(PopulateZones, self).__init__(*args, **kwargs)
+        self.index = None
+        self.zone_builders = {}
+        self.metrics = None
+        self._addresses = {}
+        self._index_digest = None
+        self.transfers = None
+
+    def run(self, report=""):
+        """Function to invoke the ConfigureDNS plugin.
+
+        Arguments:
+            report(str): Write the plugin's timers and counters to a JSON file
+                (see :py:class:`dns.dns_objects.PluginMetrics`). Value should be
+                'True' or 'true' to enable
+        """
+        self.metrics = PluginMetrics("populate_zones")
+        with self.metrics.timer("index"):
+            context = self.build_index()
+        if context.reused:
+            self.metrics.count("context_reused")
+        else:
+            self.metrics.count("vertices_scanned", context.vertices_scanned)
+        self.metrics.count("hosts_indexed", len(self.index))
+
+        # Servers often share a zone tree, so only count each one once
+        tree_counts = {}
 
         # Create zones for in-experiment dns servers
-        for vertex in self.g.get_vertices():
+        for vertex in self.index.servers:
             # Look for dns key {'dns':{"server" "dns.ssn.gov",
             #                          "hosts_tracked": ...}}
-            if vertex.is_decorated_by(DNSServer):
-                name = vertex.name
-                hosts_tracked = vertex.dns_data.get("hosts_tracked")
-                if not hosts_tracked:
-                    hosts_tracked = "*"
-                zones = self.populate_zones(name, hosts_tracked)
-                self.log.debug("Zones for %s:", name)
-                self.log.debug(zones)
-                vertex.dns_data["zones"] = zones
+            name = vertex.name
+            if self.transfers.is_secondary(vertex):
+                # Secondaries receive their zones by zone transfer
+                vertex.dns_data["zones"] = None
+                self.metrics.count("secondaries")
+                continue
+            if vertex.dns_data.get("zone_cache"):
+                with self.metrics.timer("cache", server=name):
+                    cached = self.load_cached_bundle(vertex)
+                if cached:
+                    self.metrics.count("cache_hits", server=name)
+                    continue
+                self.metrics.count("cache_misses", server=name)
+            hosts_tracked = vertex.dns_data.get("hosts_tracked")
+            if not hosts_tracked:
+                hosts_tracked = "*"
+            reverse_prefix = self.get_reverse_prefix(vertex)
+            addresses = self.get_address_selector(vertex)
+            with self.metrics.timer("trie"):
+                self.get_zone_builder(reverse_prefix, addresses)
+            with self.metrics.timer("zones", server=name):
+                zones = self.populate_zones(
+                    name, hosts_tracked, reverse_prefix, addresses
+                )
+            if vertex.dns_data.get("services"):
+                with self.metrics.timer("services", server=name):
+                    zones = self.add_services(vertex, zones, addresses)
+            self.log.debug("Zones for %s:", name)
+            self.log.debug(zones)
+            vertex.dns_data["zones"] = zones
 
-    def populate_zones(self, dns_server_name, hosts_tracked):
+            counts = tree_counts.get(id(zones))
+            if counts is None:
+                counts = tree_counts[id(zones)] = count_zone_tree(zones)
+            self.metrics.count("servers")
+            self.metrics.count("domains", counts[0], server=name)
+            self.metrics.count("records", counts[1], server=name)
+        self.metrics.count("distinct_zone_trees", len(tree_counts))
+        self.metrics.finish(self.log, report)
+
+    def build_index(self):
+        """Get the index of the hosts which need DNS records.
+
+        The index is taken from the graph's :py:class:`dns.dns_objects.DNSContext`,
+        which is only built (with a single walk of the graph) if no other DNS
+        plugin has built it yet.
+
+        Returns:
+            dns.dns_objects.DNSContext: The context holding the index.
         """
-        Walk the graph building a dictionary which specifies the zones in the graph.
+        context = DNSContext.get(self.g, self.log)
+        self.index = context.index
+        self._addresses = {}
+        self._index_digest = None
+        self.transfers = ZoneTransfers(self.index.servers, self.log)
+        self.zone_builders = {}
+        return context
 
-        The many level dictionary allows the generation function to easily
-        figure out the contents of potential A records and glue records.
+    def get_cache_key(self, vertex):
+        """Compute the fingerprint of the zone bundle of a DNS server.
+
+        The fingerprint covers everything the bundle is rendered from: every
+        indexed host, the server's ``dns_data`` (including its
+        ``addon_records``, and the size and modification time of its
+        ``addon_record_files``), the addresses of its secondaries (see
+        :py:class:`dns.dns_objects.ZoneTransfers`), the SOA values of the zones and
+        :py:data:`dns.dns_objects.ZONE_CACHE_VERSION`. Settings are normalized
+        first (see :py:meth:`_normalize_setting`), so the fingerprint is the
+        same in every process.
 
         Arguments:
-            dns_server_name (str): The name of the DNS server
-            hosts_tracked (list): The hosts that the DNS server is tracking
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
 
         Returns:
-            dict: The DNS zone dictionary.
+            str: The fingerprint.
+
+        Raises:
+            TypeError: If a setting can not be fingerprinted.
         """
+        if self.index is None:
+            self.build_index()
+        if self._index_digest is None:
+            self._index_digest = self.index.digest()
 
-        zones = {}
-        self.log.debug(
-            "PTRs requested for %s = %s", dns_server_name, str(hosts_tracked)
+        settings = {}
+        for key, value in vertex.dns_data.items():
+            if key in ZONE_CACHE_IGNORED_KEYS or value is None:
+                continue
+            if key == "addon_records" and value:
+                value = ZoneTree.coerce(value).digest({})
+            elif key == "addon_record_files" and value:
+                if isinstance(value, (str, dict)):
+                    value = [value]
+                value = [self._file_fingerprint(source) for source in value]
+            settings[key] = self._normalize_setting(value)
+        secondaries = self.transfers.secondary_addresses(vertex)
+        if secondaries:
+            settings["secondaries"] = secondaries
+        fingerprint = json.dumps(
+            [ZONE_CACHE_VERSION, self._index_digest, ZONE_CONFIG, settings],
+            sort_keys=True,
         )
+        return PayloadCache.digest(fingerprint)
 
-        vertices = self.g.get_vertices()
-        for vertex in vertices:
-            if not vertex.is_decorated_by(Switch):
-                full_name = vertex.name
-                name = full_name.split(".")
-                name.reverse()
-                try:
-                    interfaces = vertex.interfaces.interfaces
-                except AttributeError:
-                    self.log.warning(
-                        "Vertex with name=%s did not have an interface, ignoring",
-                        vertex.name,
+    @classmethod
+    def _normalize_setting(cls, value):
+        """Convert a ``dns_data`` setting into JSON with a stable order.
+
+        Sets (whose order depends on the hash seed of the process) become
+        sorted lists, tuples become lists and addresses become strings.
+
+        Arguments:
+            value: The setting.
+
+        Returns:
+            The setting, made of JSON values only.
+
+        Raises:
+            TypeError: If the setting holds any other type of value, whose
+            representation may differ between processes.
+        """
+        if value is None or isinstance(value, (str, int, float)):
+            return value
+        if isinstance(value, dict):
+            return {
+                str(key): cls._normalize_setting(item) for key, item in value.items()
+            }
+        if isinstance(value, (list, tuple)):
+            return [cls._normalize_setting(item) for item in value]
+        if isinstance(value, (set, frozenset)):
+            items = [cls._normalize_setting(item) for item in value]
+            return sorted(items, key=lambda item: json.dumps(item, sort_keys=True))
+        if isinstance(value, ADDRESS_TYPES):
+            return str(value)
+        raise TypeError(f"Can not fingerprint a setting of type {type(value).__name__}")
+
+    @staticmethod
+    def _file_fingerprint(source):
+        """Identify the contents of a record file without reading it.
+
+        Arguments:
+            source (str or dict): An entry of ``addon_record_files``.
+
+        Returns:
+            list: The entry, followed by the file's size and modification time
+            (or :py:data:`None` if the file does not exist).
+        """
+        path = source.get("path") if isinstance(source, dict) else source
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):
+            return [source, None]
+        return [source, stat.st_size, stat.st_mtime_ns]
+
+    def load_cached_bundle(self, vertex):
+        """Look up the zone bundle of a DNS server in its zone cache.
+
+        The server's fingerprint is stored in the ``zone_cache_key`` key of its
+        ``dns_data``, so that ``dns.configure_bind`` can store the bundle it
+        renders. If the bundle is cached, it is stored in the ``zone_bundle``
+        key and the server's ``zones`` are set to :py:data:`None`, so
+        ``dns.insert_records`` and ``dns.configure_bind`` skip the server.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            bool: :py:data:`True` if the bundle was cached.
+        """
+        try:
+            key = self.get_cache_key(vertex)
+        except TypeError as exp:
+            self.log.warning("%s, not caching the zones of %s", exp, vertex.name)
+            vertex.dns_data["zone_cache_key"] = None
+            vertex.dns_data["zone_bundle"] = None
+            return False
+        vertex.dns_data["zone_cache_key"] = key
+        bundle = ZoneCache(vertex.dns_data["zone_cache"]).get(key)
+        vertex.dns_data["zone_bundle"] = bundle
+        if bundle is None:
+            return False
+        self.log.debug("Using cached zones for %s (%s)", vertex.name, key)
+        vertex.dns_data["zones"] = None
+        return True
+
+    def get_reverse_prefix(self, vertex):
+        """Get the prefix length of a DNS server's reverse zones.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            int: The server's ``reverse_prefix``, or 24 if it is invalid (see
+            :py:class:`ReverseZoneBuilder`).
+        """
+        reverse_prefix = vertex.dns_data.get("reverse_prefix", 24)
+        try:
+            return ReverseZoneBuilder(reverse_prefix).prefix_length
+        except (TypeError, ValueError):
+            self.log.warning(
+                "Invalid reverse_prefix %s for %s, using 24",
+                reverse_prefix,
+                vertex.name,
+            )
+            return 24
+
+    def get_address_selector(self, vertex):
+        """Get the selection of the addresses a DNS server publishes for each host.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+
+        Returns:
+            AddressSelector: The selection from the server's
+            ``publish_addresses``, or the primary address of each host if it is
+            invalid.
+        """
+        try:
+            return AddressSelector(vertex.dns_data.get("publish_addresses"))
+        except ValueError as exp:
+            self.log.warning(
+                "%s, publishing the primary address of each host on %s",
+                exp,
+                vertex.name,
+            )
+            return AddressSelector()
+
+    def get_zone_builder(self, reverse_prefix=24, addresses=None):
+        """Get the zone builder which lays out reverse zones with a given prefix.
+
+        Arguments:
+            reverse_prefix (int): The prefix length of the reverse zones.
+            addresses (AddressSelector): Chooses the addresses published for
+                each host. Defaults to the primary address of each host.
+
+        Returns:
+            ZoneBuilder: The zone builder.
+        """
+        if self.index is None:
+            self.build_index()
+        addresses = addresses or AddressSelector()
+        key = (int(reverse_prefix), addresses.key)
+        zone_builder = self.zone_builders.get(key)
+        if zone_builder is None:
+            zone_builder = ZoneBuilder(
+                self.index, self.log, ReverseZoneBuilder(key[0]), addresses
+            )
+            if not self.zone_builders:
+                # Forward names are the same for every builder, so only warn once
+                zone_builder.warn_conflicts()
+            self.zone_builders[key] = zone_builder
+        return zone_builder
+
+    def add_services(self, vertex, zones, addresses=None):
+        """Add the records of a DNS server's service names to its zones.
+
+        The ``services`` key of the server's ``dns_data`` maps each service
+        name to the pool of hosts behind it (see :py:meth:`service_records`).
+        The zones may be shared with other servers, so they are copied as
+        they are modified. SRV records are added to the domain below their
+        underscore labels, rather than creating a domain (and hence a zone)
+        for each of those labels.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The DNS server.
+            zones (dns.dns_objects.ZoneTree): The server's zones.
+            addresses (AddressSelector): Chooses the addresses published for
+                the hosts of each pool.
+
+        Returns:
+            dns.dns_objects.ZoneTree: The zones, including the service records.
+        """
+        zones = zones.copy()
+        owned = {id(zones)}
+        for name, pool in (vertex.dns_data.get("services") or {}).items():
+            records = self.service_records(name, pool, addresses)
+            if not records:
+                continue
+            labels = tuple(reversed(name.rstrip(".").split(".")))
+            if records[0].owner is None:
+                added = zones.insert(labels, records, owned)
+            else:
+                domain = labels[: len(labels) - records[0].owner.count(".") - 1]
+                added = zones.domain(domain, owned).add(None, records)
+            if self.metrics is not None:
+                self.metrics.count("services", server=vertex.name)
+                self.metrics.count("service_records", added, server=vertex.name)
+        return zones
+
+    def service_records(self, name, pool, addresses=None):
+        """Get the records of a service name backed by a pool of hosts.
+
+        A pool is a list of host (vertex) names or addresses, a dictionary
+        mapping each of them to a weight, or a dictionary with the pool under
+        its ``members`` key and, for SRV services, the ``port`` and optionally
+        the ``priority`` of the service.
+
+        Service names starting with an underscore (e.g. ``_http._tcp.acme.com``)
+        are SRV services: each member gets an SRV record with its weight, so
+        clients spread their connections across the members in proportion to
+        their weights (see :rfc:`2782`). Any other name gets an address record
+        for the published addresses of each member, which BIND rotates between
+        answers so clients are spread across the members round-robin. Address
+        records can not carry weights, so members with a weight of ``0`` are
+        left out and the other weights are ignored.
+
+        Arguments:
+            name (str): The fully qualified service name.
+            pool (list or dict): The members of the service.
+            addresses (AddressSelector): Chooses the addresses published for
+                each member.
+
+        Returns:
+            tuple: The :py:class:`dns.dns_objects.Record` objects of the
+            service, which is empty if it is invalid.
+        """
+        port = None
+        priority = 0
+        if isinstance(pool, dict) and "members" in pool:
+            port = pool.get("port")
+            priority = pool.get("priority", 0)
+            pool = pool["members"]
+        if isinstance(pool, str):
+            pool = [pool]
+        members = pool.items() if isinstance(pool, dict) else [(m, 1) for m in pool]
+
+        try:
+            if name.startswith("_"):
+                if port is None:
+                    self.log.warning("The SRV service %s has no port, ignoring", name)
+                    return ()
+                labels = name.split(".")
+                while len(labels) > 1 and labels[1].startswith("_"):
+                    labels[:2] = [f"{labels[0]}.{labels[1]}"]
+                return tuple(
+                    Record(
+                        "SRV",
+                        f"{int(priority)} {int(weight)} {int(port)} "
+                        f"{member.rstrip('.')}.",
+                        labels[0],
                     )
-                    continue
-                address = None
+                    for member, weight in members
+                )
+            members = [(member, int(weight)) for member, weight in members]
+        except (TypeError, ValueError):
+            self.log.warning("Invalid weight, port or priority for %s, ignoring", name)
+            return ()
 
-                # pull address
-                if not interfaces:
+        if any(weight not in {0, 1} for _, weight in members):
+            self.log.warning(
+                "Address records of %s can not be weighted, using round-robin", name
+            )
+        addresses = addresses or AddressSelector()
+        records = []
+        for member, weight in members:
+            if not weight:
+                continue
+            try:
+                published = (str(ipaddress.ip_address(member)),)
+            except ValueError:
+                host_id = self.index.by_name.get(member)
+                if host_id is None:
+                    self.log.warning(
+                        "%s of service %s is not a host, ignoring", member, name
+                    )
                     continue
+                published = addresses.select(self.index.hosts[host_id])
+            records.extend(address_records(published))
+        return tuple(records)
 
-                if vertex.is_decorated_by(DNSServer):
-                    # continue
-                    pass
+    def populate_zones(
+        self, dns_server_name, hosts_tracked, reverse_prefix=24, addresses=None
+    ):
+        """
+        Build a zone tree which specifies the zones in the graph.
 
-                for iface in interfaces:
-                    if "switch" in iface:
-                        address = iface["address"]
-                        break
+        The tree of domains allows the generation function to easily
+        figure out the contents of potential A records and glue records.
+        Zone trees (and their subtrees) are shared between DNS servers
+        which track the same hosts, so they should not be modified in place.
 
-                if not address:
-                    # This VM is not part of the experiment, but that's okay
-                    continue
+        Arguments:
+            dns_server_name (str): The name of the DNS server
+            hosts_tracked (list): The hosts that the DNS server is tracking.
+                See :py:class:`HostMatcher` for the supported entries.
+            reverse_prefix (int): The prefix length of the reverse zones.
+                See :py:class:`ReverseZoneBuilder`.
+            addresses (AddressSelector): Chooses the addresses published for
+                each host. Defaults to the primary address of each host.
 
-                # Skip any machines this server doesn't care about.
-                if hosts_tracked == "*" or full_name in hosts_tracked:
-                    pass
-                else:
-                    continue
+        Returns:
+            dns.dns_objects.ZoneTree: The DNS zone tree.
+        """
+        zone_builder = self.get_zone_builder(reverse_prefix, addresses)
 
-                # populate the dictionary
-                current_location = zones
-                for name_index, component in enumerate(name):
-                    if component not in current_location:
-                        if name_index == (len(name) - 1):
-                            current_location[component] = [("A", address)]
-                        else:
-                            current_location[component] = {}
-                        current_location = current_location[component]
-                    else:
-                        current_location = current_location[component]
-
-                # Create the PTR record
-                ptr_addr = f"arpa.in-addr.{address}"
-                ptr_addr = ptr_addr.split(".")
-
-                current_location = zones
-                for ptr_addr_index, component in enumerate(ptr_addr):
-                    if component not in current_location:
-                        if ptr_addr_index == (len(ptr_addr) - 1):
-                            current_location[component] = [("PTR", f"{full_name}.")]
-                        else:
-                            current_location[component] = {}
-                        current_location = current_location[component]
-                    else:
-                        current_location = current_location[component]
+        self.log.debug(
+            "PTRs requested for %s = %s", dns_server_name, str(hosts_tracked)
+        )
 
-        return zones
+        matcher = HostMatcher(hosts_tracked)
+        for entry in matcher.invalid:
+            self.log.warning(
+                "Invalid CIDR range %s in hosts_tracked of %s, ignoring it",
+                entry,
+                dns_server_name,
+            )
+        if matcher.matches_all:
+            return zone_builder.build()
+        published = None
+        if matcher.uses_addresses:
+            # Match the addresses the server publishes for each host
+            selector = zone_builder.addresses
+            published = self._addresses.get(selector.key)
+            if published is None:
+                published = self._addresses[selector.key] = [
+                    tuple(map(ipaddress.ip_address, selector.select(host)))
+                    for host in self.index
+                ]
+        return zone_builder.build(matcher.select(self.index, published))
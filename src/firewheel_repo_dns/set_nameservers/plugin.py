@@ -1,9 +1,153 @@
-from base_objects import Switch, VMEndpoint
-from dns.dns_objects import DNSServer
-from linux.base_objects import LinuxHost
+import hashlib
+import logging
+from collections import deque
+
+from dns.dns_objects import DNSContext, PluginMetrics
 
 from firewheel.control.experiment_graph import AbstractPlugin
 
+ASSIGNMENT_STRATEGIES = ("ordered", "nearest", "hash", "rotate")
+# The resolver only uses the first three nameservers in resolv.conf
+MAX_NAMESERVERS = 3
+# The default schedule time of set_nameservers_agent.py
+SET_NAMESERVERS_START_TIME = -99
+
+
+class NameserverAssigner:
+    """Choose the ordered list of nameservers for each host.
+
+    The following strategies are supported:
+
+    * ``"ordered"`` - Every host uses every DNS server, in graph order.
+    * ``"nearest"`` - Hosts use the DNS servers with the fewest hops through
+      :py:class:`base_objects.Switch` vertices first. Servers at the same
+      distance are ordered as with ``"hash"``, so hosts spread their queries
+      across them.
+    * ``"hash"`` - Servers are ordered by a hash of the server address and
+      the host name (i.e. rendezvous hashing), so each host consistently
+      prefers a pseudo-random server and adding a server only moves the
+      hosts which now prefer it.
+    * ``"rotate"`` - Each successive host starts one server further along
+      the list of DNS servers.
+
+    With every strategy except ``"ordered"``, hosts are given at most
+    ``count`` nameservers.
+    """
+
+    def __init__(self, servers, strategy="ordered", count=MAX_NAMESERVERS):
+        """
+        Arguments:
+            servers (list): The DNS server vertices, in graph order.
+            strategy (str): The assignment strategy.
+            count (int): The maximum number of nameservers for each host.
+
+        Raises:
+            ValueError: If the strategy is unknown or ``count`` is not positive.
+        """
+        if strategy not in ASSIGNMENT_STRATEGIES:
+            raise ValueError(f"Unknown nameserver assignment strategy: {strategy}")
+        if count < 1:
+            raise ValueError("Hosts must be assigned at least one nameserver")
+        self.servers = servers
+        self.addresses = tuple(str(v.dns_data.get("dns_address")) for v in servers)
+        self.strategy = strategy
+        self.count = count
+        self.distances = [{} for _ in servers]
+        self._rotation = 0
+
+    def compute_distances(self, vertices):
+        """Find the distance from each DNS server to every vertex.
+
+        The graph is traversed through the ``switch`` of each vertex's
+        interfaces, with a breadth-first search from each DNS server.
+        Distances are measured in graph edges, so a host on the same switch
+        as a server is two edges away.
+
+        Arguments:
+            vertices (iterable): Every vertex which is connected to a switch.
+                The switches themselves do not need to be included.
+        """
+        neighbors = {}
+        for vertex in vertices:
+            try:
+                interfaces = vertex.interfaces.interfaces
+            except AttributeError:
+                continue
+            for iface in interfaces:
+                switch = iface.get("switch")
+                if switch is None:
+                    continue
+                neighbors.setdefault(id(vertex), []).append(switch)
+                neighbors.setdefault(id(switch), []).append(vertex)
+
+        for server, distances in zip(self.servers, self.distances):
+            distances[id(server)] = 0
+            pending = deque([server])
+            while pending:
+                vertex = pending.popleft()
+                distance = distances[id(vertex)] + 1
+                for neighbor in neighbors.get(id(vertex), ()):
+                    if id(neighbor) not in distances:
+                        distances[id(neighbor)] = distance
+                        pending.append(neighbor)
+
+    @staticmethod
+    def weight(address, name):
+        """Compute the rendezvous hashing weight of a DNS server for a host.
+
+        Arguments:
+            address (str): The address of the DNS server.
+            name (str): The name of the host.
+
+        Returns:
+            int: The weight; servers with larger weights are preferred.
+        """
+        digest = hashlib.sha256(f"{address}\0{name}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def assign(self, vertex):
+        """Choose the nameservers for a vertex.
+
+        Arguments:
+            vertex (firewheel.control.experiment_graph.Vertex): The host or switch.
+
+        Returns:
+            tuple: The addresses of the nameservers, most preferred first.
+        """
+        if self.strategy == "ordered" or not self.addresses:
+            return self.addresses
+
+        if self.strategy == "rotate":
+            start = self._rotation % len(self.addresses)
+            self._rotation += 1
+            order = self.addresses[start:] + self.addresses[:start]
+        elif self.strategy == "hash":
+            order = sorted(
+                self.addresses,
+                key=lambda address: self.weight(address, vertex.name),
+                reverse=True,
+            )
+        else:
+            unreachable = float("inf")
+            ranked = sorted(
+                (
+                    distances.get(id(vertex), unreachable),
+                    -self.weight(address, vertex.name),
+                    address,
+                )
+                for address, distances in zip(self.addresses, self.distances)
+            )
+            order = [address for _, _, address in ranked]
+
+        nameservers = []
+        for address in order:
+            # Several servers may share an address
+            if address not in nameservers:
+                nameservers.append(address)
+            if len(nameservers) == self.count:
+                break
+        return tuple(nameservers)
+
 
 class SetNameservers(AbstractPlugin):
     """This plugin sets the DNS nameservers for each host in the
@@ -18,44 +162,215 @@ class SetNameservers(AbstractPlugin):
             **kwargs: extra keyword args to pass to AbstractPlugin constructor
         """
         super(SetNameservers, self).__init__(*args, **kwargs)
+        self.metrics = None
 
-    def run(self):
+    def run(
+        self, strategy="ordered", nameservers="", report="", start_time="", wait=""
+    ):
         """
         Set the nameservers of each VM in the experiment.
+
+        Arguments:
+            strategy(str): How the nameservers of each host are chosen. One of
+                ``"ordered"`` (the default), ``"nearest"``, ``"hash"`` or
+                ``"rotate"``. See :py:class:`NameserverAssigner`.
+            nameservers(str): The maximum number of nameservers for each host,
+                for every strategy except ``"ordered"``. Defaults to 3.
+            report(str): Write the plugin's timers and counters to a JSON file
+                (see :py:class:`dns.dns_objects.PluginMetrics`). Value should be
+                'True' or 'true' to enable
+            start_time(str): The schedule time of ``set_nameservers_agent.py``.
+                Defaults to -99.
+            wait(str): How many seconds each Linux host waits for one of its
+                nameservers to answer, after setting them. Defaults to 0, which
+                does not wait. See :py:meth:`assign_nameservers`.
+        """
+        self.metrics = PluginMetrics("set_nameservers")
+        with self.metrics.timer("classify"):
+            servers, switches, endpoints = self.classify_vertices()
+        self.metrics.count("servers", len(servers))
+
+        assigner = self.get_assigner(servers, strategy, nameservers)
+        if assigner.strategy == "nearest":
+            with self.metrics.timer("distances"):
+                assigner.compute_distances(vertex for vertex, _, _ in endpoints)
+        start_time, wait = self.get_schedule(start_time, wait)
+        with self.metrics.timer("assign"):
+            self.assign_nameservers(switches, endpoints, assigner, start_time, wait)
+        self.metrics.finish(self.log, report)
+
+    def classify_vertices(self):
+        """Find the vertices which need nameservers.
+
+        They are taken from the graph's :py:class:`dns.dns_objects.DNSContext`,
+        which is only built (with a single walk of the graph) if no other DNS
+        plugin has built it yet.
+
+        Returns:
+            tuple: The DNS server vertices, the switch vertices and, for each
+            VM endpoint, a tuple of the vertex, whether it is a DNS server and
+            whether it is a Linux host. Each list is in graph order.
         """
-        dns_ips = []
-        for v in self.g.get_vertices():
-            if v.is_decorated_by(DNSServer):
-                dns_ips.append(str(v.dns_data.get("dns_address")))
-        for v in self.g.get_vertices():
-            if v.is_decorated_by(Switch):
-                # Set the dns1 option in each switch
-                dns = dns_ips
-                v["dns1"] = ""
-                if 0:
-                    v["dns1"] = dns[0]
-                v["dns2"] = ""
-
-            if v.is_decorated_by(VMEndpoint):
-                # Add it to the host's schedule
-                # See if the node has application data to override
-                # the default name server
-                ns_conf = None
-                if v.is_decorated_by(DNSServer):
-                    ns_conf = v.dns_data.get("nameserver_address")
-                if ns_conf:
-                    ns_conf = str(ns_conf)
-                else:
-                    ns_conf = "\n".join(dns_ips)
+        context = DNSContext.get(self.g, self.log)
+        if context.reused:
+            self.metrics.count("context_reused")
+        else:
+            self.metrics.count("vertices_scanned", context.vertices_scanned)
+        return context.servers, context.switches, context.endpoints
+
+    def get_assigner(self, servers, strategy="ordered", nameservers=""):
+        """Create the nameserver assigner requested by the plugin's arguments.
+
+        Invalid arguments are logged and replaced with their defaults.
+
+        Arguments:
+            servers (list): The DNS server vertices, in graph order.
+            strategy (str): The assignment strategy.
+            nameservers (str): The maximum number of nameservers for each host.
+
+        Returns:
+            NameserverAssigner: The assigner.
+        """
+        strategy = (strategy or "ordered").lower()
+        if strategy not in ASSIGNMENT_STRATEGIES:
+            self.log.warning(
+                "Unknown nameserver assignment strategy %s, using ordered", strategy
+            )
+            strategy = "ordered"
+        try:
+            count = int(nameservers or MAX_NAMESERVERS)
+        except ValueError:
+            count = 0
+        if count < 1:
+            self.log.warning(
+                "Invalid number of nameservers %s, using %d",
+                nameservers,
+                MAX_NAMESERVERS,
+            )
+            count = MAX_NAMESERVERS
+        return NameserverAssigner(servers, strategy, count)
+
+    def get_schedule(self, start_time="", wait=""):
+        """Get how the agent is scheduled from the plugin's arguments.
+
+        Invalid arguments are logged and replaced with their defaults.
+
+        Arguments:
+            start_time (str): The schedule time of the agent.
+            wait (str): How many seconds hosts wait for their nameservers.
+
+        Returns:
+            tuple: The schedule time and the number of seconds to wait.
+        """
+        try:
+            start = int(start_time or SET_NAMESERVERS_START_TIME)
+        except ValueError:
+            self.log.warning(
+                "Invalid start_time %s, using %d",
+                start_time,
+                SET_NAMESERVERS_START_TIME,
+            )
+            start = SET_NAMESERVERS_START_TIME
+        try:
+            seconds = int(wait or 0)
+        except ValueError:
+            seconds = -1
+        if seconds < 0:
+            self.log.warning("Invalid wait %s, not waiting for nameservers", wait)
+            seconds = 0
+        return start, seconds
+
+    def assign_nameservers(
+        self,
+        switches,
+        endpoints,
+        assigner,
+        start_time=SET_NAMESERVERS_START_TIME,
+        wait=0,
+    ):
+        """
+        Set the nameservers of each switch and VM in the experiment.
+
+        Hosts are grouped by their list of nameservers, and every host in a
+        group is given the same payload object.
+
+        With ``wait``, the payload of each Linux host which is not a DNS server
+        starts with ``# wait=<seconds>`` and ``# zone=<domain>`` lines, so the
+        agent waits until one of the nameservers answers the SOA query of the
+        host's domain, i.e. its name without the first label. Since the negative
+        time vm_resources of a VM run one after another, the host's later
+        vm_resources then start as soon as its DNS servers are configured.
+        DNS servers never wait, as their own zones may not be configured yet.
+
+        Arguments:
+            switches (list): The switch vertices.
+            endpoints (list): The VM endpoints, as returned by
+                :py:meth:`classify_vertices`.
+            assigner (NameserverAssigner): Chooses the nameservers of each vertex.
+            start_time (int): The schedule time of the agent.
+            wait (int): How many seconds hosts wait for their nameservers.
+        """
+        for v in switches:
+            # Set the dns1 and dns2 options in each switch
+            dns = assigner.assign(v)
+            v["dns1"] = dns[0] if dns else ""
+            v["dns2"] = dns[1] if len(dns) > 1 else ""
+
+        # The line separated addresses for each distinct nameserver list
+        nameserver_lists = {}
+        # The agent payload for each distinct nameserver list (and domain)
+        payloads = {}
+        # The number of hosts using each nameserver first, and using each payload
+        primaries = {}
+        scheduled = {}
+        log_hosts = self.log.isEnabledFor(logging.DEBUG)
+        for v, is_server, is_linux in endpoints:
+            # Add it to the host's schedule
+            # See if the node has application data to override
+            # the default name server
+            override = None
+            if is_server:
+                override = v.dns_data.get("nameserver_address")
+            if override:
+                dns_ips = tuple(str(override).split("\n"))
+            else:
+                dns_ips = assigner.assign(v)
+            ns_conf = nameserver_lists.get(dns_ips)
+            if ns_conf is None:
+                ns_conf = nameserver_lists[dns_ips] = "\n".join(dns_ips)
+            if not override:
+                if log_hosts:
                     self.log.debug(
                         "set nameservers from dns_ips for %s to %s",
                         v.name,
                         ",".join(dns_ips),
                     )
-                    v.dns_nameservers = ns_conf
-                # Only run the set_nameservers_agent.py python script on
-                # LinuxHosts since Windows images do not have python installed
-                # by default. Windows does per interface DNS server settings and
-                # will pick up the servers from self.dns_nameservers in configure_ips
-                if v.is_decorated_by(LinuxHost):
-                    v.add_vm_resource(-99, "set_nameservers_agent.py", ns_conf, None)
+                v.dns_nameservers = ns_conf
+                if dns_ips:
+                    primaries[dns_ips[0]] = primaries.get(dns_ips[0], 0) + 1
+            # Only run the set_nameservers_agent.py python script on
+            # LinuxHosts since Windows images do not have python installed
+            # by default. Windows does per interface DNS server settings and
+            # will pick up the servers from self.dns_nameservers in configure_ips
+            if is_linux:
+                key = dns_ips
+                if wait and not is_server:
+                    key = (dns_ips, v.name.partition(".")[2])
+                payload = payloads.get(key)
+                if payload is None:
+                    payload = ns_conf
+                    if key is not dns_ips:
+                        payload = f"# wait={wait}\n# zone={key[1]}\n{ns_conf}"
+                    payloads[key] = payload
+                v.add_vm_resource(start_time, "set_nameservers_agent.py", payload, None)
+                scheduled[key] = scheduled.get(key, 0) + 1
+
+        self.metrics.count("distinct_payloads", len(payloads))
+        for key, hosts in scheduled.items():
+            self.metrics.count("hosts_configured", hosts)
+            self.metrics.count("payload_bytes", hosts * len(payloads[key]))
+        server_names = {}
+        for server, address in zip(assigner.servers, assigner.addresses):
+            server_names.setdefault(address, server.name)
+        for address, hosts in primaries.items():
+            self.metrics.count("primary_for_hosts", hosts, server=server_names[address])
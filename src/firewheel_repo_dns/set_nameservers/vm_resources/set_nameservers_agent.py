@@ -3,10 +3,89 @@
 import os
 import sys
 import json
+import time
+import random
+import socket
+import struct
 from abc import ABCMeta, abstractmethod
 from platform import system
 from subprocess import call
 
+NETPLAN_CONFIG = "/etc/netplan/firewheel.yaml"
+NETPLAN_BINARIES = ("/usr/sbin/netplan", "/sbin/netplan", "/usr/bin/netplan")
+RESOLVCONF_HEAD = "/etc/resolvconf/resolv.conf.d/head"
+WAIT_POLL_INTERVAL = 0.5
+DNS_TYPE_SOA = 6
+DNS_CLASS_IN = 1
+# A nameserver which answers with NOERROR or NXDOMAIN serves the zone
+READY_RCODES = (0, 3)
+
+
+def replace_file(path, contents):
+    """
+    Atomically replace the contents of a file, via a temporary file in the
+    same directory which is renamed over the original file.
+
+    Arguments:
+        path (str): The path to the file.
+        contents (str): The new contents of the file.
+    """
+    tmp_path = "%s.fwtmp" % path
+    with open(tmp_path, "w") as fhand:
+        fhand.write(contents)
+    os.rename(tmp_path, path)
+
+
+def soa_query(zone, query_id):
+    """
+    Build a DNS query for the SOA record of a zone.
+
+    Arguments:
+        zone (str): The name of the zone (empty for the root zone).
+        query_id (int): The ID of the query.
+
+    Returns:
+        bytes: The query message.
+    """
+    name = b""
+    for label in zone.strip(".").split("."):
+        if label:
+            label = label.encode("utf-8")
+            name += struct.pack(">B", len(label)) + label
+    header = struct.pack(">HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    return header + name + b"\0" + struct.pack(">HH", DNS_TYPE_SOA, DNS_CLASS_IN)
+
+
+def nameserver_answers(address, zone, timeout=1.0):
+    """
+    Check whether a nameserver answers the SOA query of a zone.
+
+    Arguments:
+        address (str): The address of the nameserver.
+        zone (str): The name of the zone (empty for the root zone).
+        timeout (float): How many seconds to wait for the response.
+
+    Returns:
+        bool: :py:data:`True` if the nameserver answered without an error.
+    """
+    query_id = random.randint(0, 0xFFFF)
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.sendto(soa_query(zone, query_id), (address, 53))
+        response = sock.recv(512)
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+    if len(response) < 12:
+        return False
+    response_id, flags = struct.unpack(">HH", response[:4])
+    return (
+        response_id == query_id and flags & 0x8000 and flags & 0x000F in READY_RCODES
+    )
+
 
 class SetNameservers:
     """
@@ -24,16 +103,46 @@ class SetNameservers:
         Arguments:
             args (list): The arguments passed into the VMR. The first argument
                 should be a path to a file containing line separated list of the
-                name servers.
+                name servers, optionally preceded by ``# key=value`` option lines.
         """
         ascii_file = args[1]
 
         self.nameservers = []
+        self.options = {}
         with open(ascii_file, "r") as fhand:
             for server in fhand:
-                self.nameservers.append(server.strip())
+                server = server.strip()
+                if server.startswith("#"):
+                    key, _, value = server.lstrip("# ").partition("=")
+                    self.options[key] = value
+                elif server:
+                    self.nameservers.append(server)
 
         self.set_nameservers()
+        self.wait_for_nameservers()
+
+    def wait_for_nameservers(self):
+        """
+        Wait until one of the name servers answers the SOA query of the
+        ``zone`` option, for at most the ``wait`` option's number of seconds.
+        Later VM resources then only start once the name servers are ready.
+        """
+        timeout = int(self.options.get("wait") or 0)
+        if not timeout or not self.nameservers:
+            return
+        zone = self.options.get("zone", "")
+        deadline = time.time() + timeout
+        while True:
+            for address in self.nameservers:
+                if nameserver_answers(address, zone):
+                    return
+            if time.time() >= deadline:
+                print(
+                    "ERROR: no name server answered for %s within %d seconds"
+                    % (zone or ".", timeout)
+                )
+                return
+            time.sleep(WAIT_POLL_INTERVAL)
 
     @abstractmethod
     def set_nameservers(self):
@@ -46,38 +155,85 @@ class SetNameserversLinuxResolvConf(SetNameservers):
     """
     This class sets the name servers for Linux based computers by either
     updating ``resolveconf`` or setting it in the netplan configuration.
+    The configuration is only rewritten (and applied) if the name servers
+    differ from the ones already configured, so running the agent again
+    is cheap and does not duplicate any entries.
     """
 
+    @staticmethod
+    def netplan_enabled():
+        """
+        Check whether the network is configured by netplan, without running it.
+
+        Returns:
+            bool: :py:data:`True` if netplan is installed and FIREWHEEL created
+            a netplan configuration for the VM.
+        """
+        if not os.path.exists(NETPLAN_CONFIG):
+            return False
+        return any(os.path.exists(path) for path in NETPLAN_BINARIES)
+
     def set_nameservers(self):
         """
         Set's the name servers and restarts the service.
         """
-        # Check if netplan is installed
-        try:
-            netplan_enabled = call(["netplan", "info"]) == 0
-        except OSError:
-            netplan_enabled = False
-        if netplan_enabled:
-            with open("/etc/netplan/firewheel.yaml") as f_hand:
-                fw_netplan = json.load(f_hand)
-            ethernets = fw_netplan["network"]["ethernets"]
-            for interface in ethernets.keys():
-                ethernets[interface]["nameservers"] = {"addresses": self.nameservers}
-            with open("/etc/netplan/firewheel.yaml", "w") as f_hand:
-                json.dump(fw_netplan, f_hand, indent=4)
-            if call(["netplan", "apply"]) != 0:
-                print("ERROR applying firewheel netplan configuration")
+        if self.netplan_enabled():
+            self.set_netplan_nameservers()
         else:
-            base_path = "/etc/resolvconf/resolv.conf.d"
-            if not os.path.exists(base_path):
-                os.makedirs(base_path)
-            with open(os.path.join(base_path, "head"), "a") as resolv_conf:
-                for address in self.nameservers:
-                    server = "nameserver %s\n" % address
-                    resolv_conf.write(server)
-            if call(["/usr/sbin/service", "resolvconf", "restart"]) != 0:
-                print("ERROR: unable to restart resolvconf")
-                os.remove(os.path.join(base_path, "head"))
+            self.set_resolvconf_nameservers()
+
+    def set_netplan_nameservers(self):
+        """
+        Set the name servers of every interface in the FIREWHEEL netplan
+        configuration, and apply it if it changed.
+        """
+        with open(NETPLAN_CONFIG) as f_hand:
+            fw_netplan = json.load(f_hand)
+        changed = False
+        ethernets = fw_netplan["network"]["ethernets"]
+        for interface in ethernets.keys():
+            nameservers = ethernets[interface].setdefault("nameservers", {})
+            if nameservers.get("addresses") != self.nameservers:
+                nameservers["addresses"] = self.nameservers
+                changed = True
+        if not changed:
+            return
+        replace_file(NETPLAN_CONFIG, json.dumps(fw_netplan, indent=4))
+        if call(["netplan", "apply"]) != 0:
+            print("ERROR applying firewheel netplan configuration")
+
+    def set_resolvconf_nameservers(self):
+        """
+        Set the name servers in the ``resolvconf`` head file, replacing any
+        name servers which are already listed there, and restart ``resolvconf``
+        if the file changed.
+        """
+        base_path = os.path.dirname(RESOLVCONF_HEAD)
+        if not os.path.exists(base_path):
+            os.makedirs(base_path)
+
+        current = ""
+        if os.path.exists(RESOLVCONF_HEAD):
+            with open(RESOLVCONF_HEAD, "r") as resolv_conf:
+                current = resolv_conf.read()
+        # Keep anything else in the file, such as comments or search domains
+        lines = [
+            line
+            for line in current.splitlines(True)
+            if line.split()[:1] != ["nameserver"]
+        ]
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        for address in self.nameservers:
+            lines.append("nameserver %s\n" % address)
+        contents = "".join(lines)
+        if contents == current:
+            return
+
+        replace_file(RESOLVCONF_HEAD, contents)
+        if call(["/usr/sbin/service", "resolvconf", "restart"]) != 0:
+            print("ERROR: unable to restart resolvconf")
+            os.remove(RESOLVCONF_HEAD)
 
 
 class SetNameserversWindows(SetNameservers):
@@ -87,21 +243,23 @@ class SetNameserversWindows(SetNameservers):
 
     def set_nameservers(self):
         """
-        Set's the name servers.
+        Set's the name servers of every IP enabled network adapter with a
+        single PowerShell invocation. Adapters which already use the name
+        servers, in the same order, are left untouched.
         """
-        address_list_str = ""
-        count_addrs = 0
-        for address in self.nameservers:
-            if count_addrs == 0:
-                address_list_str = '"%s"' % address
-            else:
-                address_list_str.append(', "%s"' % address)
-            count_addrs = count_addrs + 1
+        address_list_str = ", ".join('"%s"' % address for address in self.nameservers)
 
         objs = "(Get-WmiObject Win32_NetworkAdapterConfiguration -Filter \"ipenabled = 'true'\")"
-        meth = "SetDNSServerSearchOrder(%s)" % address_list_str
-        cmd = "foreach($NIC in %s) {$NIC.%s}" % (objs, meth)
-        if call(["powershell", cmd]) != 0:
+        cmd = (
+            "$servers = [string[]]@(%s); $failed = 0; "
+            "foreach($NIC in %s) {"
+            "$current = [string[]]@($NIC.DNSServerSearchOrder); "
+            "if (($current -join ',') -ne ($servers -join ',')) {"
+            "if ($NIC.SetDNSServerSearchOrder($servers).ReturnValue -ne 0) {$failed = 1}"
+            "}"
+            "}; exit $failed"
+        ) % (address_list_str, objs)
+        if call(["powershell", "-NoProfile", "-NonInteractive", "-Command", cmd]) != 0:
             print("ERROR: could not set dnsserver")
 
 